@@ -0,0 +1,301 @@
+"""
+generate_data.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Generates a synthetic dataset that looks like the real methylation data.
+Writes barcode files, a group info file, promoter annotations
+and a config.ini that points to all of them.
+Used by run_benchmarks.py to time the backend at genome scale.
+
+run:
+python3 bench/generate_data.py --out bench/data --cpgs 1000000 --samples 10
+"""
+
+import os
+import argparse
+import numpy as np
+import polars as pl
+
+# Lengths of the human chromosomes (hg38)
+CHROMOSOME_LENGTHS: dict[str, int] = {
+    "chr1": 248956422, "chr2": 242193529, "chr3": 198295559,
+    "chr4": 190214555, "chr5": 181538259, "chr6": 170805979,
+    "chr7": 159345973, "chr8": 145138636, "chr9": 138394717,
+    "chr10": 133797422, "chr11": 135086622, "chr12": 133275309,
+    "chr13": 114364328, "chr14": 107043718, "chr15": 101991189,
+    "chr16": 90338345, "chr17": 83257441, "chr18": 80373285,
+    "chr19": 58617616, "chr20": 64444167, "chr21": 46709983,
+    "chr22": 50818468, "chrX": 156040895, "chrY": 57227415}
+
+GROUP_NAMES: list[str] = ["A53J", "A53D", "A53C", "0.1% (H)", "10% (F)", "BZ", "DMSO", "Cell"]
+
+
+def split_over_chromosomes(n_items: int) -> dict[str, int]:
+    """Splits an amount of items over the chromosomes
+
+    Every chromosome gets a share that fits its length.
+
+    Parameters
+    ----------
+    n_items : int
+            Amount of items to divide
+
+    Returns
+    -------
+    dict
+        chromosome name as key, amount of items as value
+
+    """
+    lengths = np.array(list(CHROMOSOME_LENGTHS.values()), dtype=np.float64)
+    shares = np.floor(lengths / lengths.sum() * n_items).astype(np.int64)
+    # Give the rest to chr1, so the total is exact
+    shares[0] += n_items - shares.sum()
+    return dict(zip(CHROMOSOME_LENGTHS, shares.tolist()))
+
+
+def cpg_positions(chromosome: str, n_sites: int, rng: np.random.Generator) -> np.ndarray:
+    """Creates sorted CpG positions for one chromosome
+
+    Parameters
+    ----------
+    chromosome : str
+            Name of the chromosome
+    n_sites : int
+            Amount of CpG sites
+    rng : np.random.Generator
+            Random generator to use
+
+    Returns
+    -------
+    np.ndarray
+        Sorted and unique start positions
+
+    """
+    length = CHROMOSOME_LENGTHS[chromosome]
+    n_sites = min(n_sites, length - 2)
+    positions = rng.choice(length - 2, size=n_sites, replace=False) if n_sites > length // 4 \
+        else np.unique(rng.integers(0, length - 2, size=n_sites))
+    return np.sort(positions).astype(np.int64)
+
+
+def methylation_values(n_sites: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """Creates frac and valid values
+
+    Real methylation fractions are bimodal (mostly 0 or 1),
+    coverage is overdispersed, so a negative binomial is used.
+
+    Parameters
+    ----------
+    n_sites : int
+            Amount of values to create
+    rng : np.random.Generator
+            Random generator to use
+
+    Returns
+    -------
+    tuple
+        frac and valid arrays
+
+    """
+    high = rng.random(n_sites) < 0.7
+    frac = np.where(high, rng.beta(8, 1.5, n_sites), rng.beta(1.5, 8, n_sites))
+    valid = rng.negative_binomial(4, 0.2, n_sites) + 1
+    return np.round(frac, 4), valid
+
+
+def write_barcode_file(path: str, sites: dict[str, np.ndarray], site_fraction: float,
+                       rng: np.random.Generator) -> int:
+    """Writes one barcode file
+
+    The file has the same layout as the real analysis files:
+    tab separated, no header, chr with a suffix and an unused last column.
+
+    Parameters
+    ----------
+    path : str
+            Where to write the file
+    sites : dict
+            chromosome name as key, CpG positions as value
+    site_fraction : float
+            Fraction of the CpG sites this sample has data for
+    rng : np.random.Generator
+            Random generator to use
+
+    Returns
+    -------
+    int
+        Amount of rows written
+
+    """
+    written = 0
+    with open(path, mode="wb") as out_file:
+        for chromosome, positions in sites.items():
+            keep = positions[rng.random(positions.size) < site_fraction]
+            if keep.size == 0:
+                continue
+            frac, valid = methylation_values(keep.size, rng)
+            chunk = pl.DataFrame({"chr": f"{chromosome}_CG0",
+                                  "start": keep,
+                                  "end": keep + 1,
+                                  "frac": frac,
+                                  "valid": valid,
+                                  "name": "."})
+            chunk.write_csv(out_file, separator="\t", include_header=False)
+            written += keep.size
+    return written
+
+
+def write_promoters(path: str, n_genes: int, rng: np.random.Generator) -> pl.DataFrame:
+    """Writes the promoter annotation file
+
+    Parameters
+    ----------
+    path : str
+            Where to write the file
+    n_genes : int
+            Amount of genes to create
+    rng : np.random.Generator
+            Random generator to use
+
+    Returns
+    -------
+    pl.DataFrame
+        The promoter annotation (chr, start, end, gene_name)
+
+    """
+    frames = []
+    gene_n = 0
+    for chromosome, amount in split_over_chromosomes(n_genes).items():
+        if amount == 0:
+            continue
+        starts = np.sort(rng.integers(0, CHROMOSOME_LENGTHS[chromosome] - 10000, size=amount))
+        lengths = rng.integers(1000, 9000, size=amount)
+        names = [f"GENE{number:06d}" for number in range(gene_n, gene_n + amount)]
+        gene_n += amount
+        frames.append(pl.DataFrame({"chr": chromosome,
+                                    "start": starts,
+                                    "end": starts + lengths,
+                                    "gene_name": names}))
+    promoters = pl.concat(frames)
+    promoters.write_csv(path)
+    return promoters
+
+
+def write_groups(path: str, n_samples: int) -> None:
+    """Writes the group info file
+
+    Uses the same header as the real file, including the leading space.
+
+    Parameters
+    ----------
+    path : str
+            Where to write the file
+    n_samples : int
+            Amount of barcodes
+
+    Returns
+    -------
+    None
+
+    """
+    with open(path, mode="w", encoding="utf-8") as group_file:
+        group_file.write("barcode, description\n")
+        for barcode in range(1, n_samples + 1):
+            group_file.write(f"{barcode}, {GROUP_NAMES[(barcode - 1) % len(GROUP_NAMES)]}\n")
+
+
+def write_config(out_dir: str) -> str:
+    """Writes a config.ini for the generated data
+
+    Parameters
+    ----------
+    out_dir : str
+            Folder that contains the generated data
+
+    Returns
+    -------
+    str
+        Path to the config file
+
+    """
+    out_dir = os.path.abspath(out_dir)
+    path = os.path.join(out_dir, "config.ini")
+    with open(path, mode="w", encoding="utf-8") as config_file:
+        config_file.write("[PATHS]\n"
+                          f"data_folder = {out_dir}/barcodes\n"
+                          f"annotated_bed = {out_dir}/annotated_bed.bed\n"
+                          f"group_data = {out_dir}/group_info.csv\n"
+                          f"top_genes = {out_dir}/gene_variation.csv\n"
+                          f"info_page = {out_dir}/use_page.md\n")
+    return path
+
+
+def generate(out_dir: str, n_cpgs: int, n_samples: int, n_genes: int = 20000,
+             site_fraction: float = 0.8, seed: int = 42) -> str:
+    """Generates a full synthetic dataset
+
+    Parameters
+    ----------
+    out_dir : str
+            Folder to write everything to
+    n_cpgs : int
+            Amount of unique CpG sites in the genome
+    n_samples : int
+            Amount of barcodes (samples)
+    n_genes : int
+            Amount of promoters to annotate
+    site_fraction : float
+            Fraction of the CpG sites every sample has data for
+    seed : int
+            Seed for the random generator
+
+    Returns
+    -------
+    str
+        Path to the config file of the dataset
+
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(out_dir, "barcodes"), exist_ok=True)
+
+    sites = {chromosome: cpg_positions(chromosome, amount, rng)
+             for chromosome, amount in split_over_chromosomes(n_cpgs).items()
+             if amount > 0}
+
+    total = 0
+    for barcode in range(1, n_samples + 1):
+        path = os.path.join(out_dir, "barcodes", f"barcode{barcode}_cpg.csv")
+        total += write_barcode_file(path, sites, site_fraction, rng)
+        print(f"Wrote {path}")
+
+    write_promoters(os.path.join(out_dir, "annotated_bed.bed"), n_genes, rng)
+    write_groups(os.path.join(out_dir, "group_info.csv"), n_samples)
+    print(f"Generated {total} rows for {n_samples} samples")
+    return write_config(out_dir)
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(description="Generate synthetic methylation data")
+    parser.add_argument("--out", default="bench/data", help="output folder")
+    parser.add_argument("--cpgs", type=int, default=1_000_000,
+                        help="amount of unique CpG sites (1M - 500M)")
+    parser.add_argument("--samples", type=int, default=10,
+                        help="amount of barcodes (10 - 500)")
+    parser.add_argument("--genes", type=int, default=20000,
+                        help="amount of promoters")
+    parser.add_argument("--site-fraction", type=float, default=0.8,
+                        help="fraction of the CpG sites every sample covers")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    config_path = generate(args.out, args.cpgs, args.samples, args.genes,
+                           args.site_fraction, args.seed)
+    print(f"Config written to {config_path}")
+
+
+if __name__ == "__main__":
+    main()
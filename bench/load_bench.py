@@ -0,0 +1,599 @@
+"""
+load_bench.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Load test of the website. Starts the app (with src/serve.py) or uses a running one,
+and opens simulated users that each have their own websocket session.
+Every user picks filters like a real user would (genes, chromosomes, a range or nothing),
+presses "Filter data!" and waits until the new tabs are shown, then thinks for a while
+and does it again.
+Records the submit latency (p50/p95/p99), the throughput, how many submits got the
+"server is busy" page, and the memory (RSS) and cpu use of every server process.
+Results are written as json, and can be compared with an older result file.
+
+A submit is done when the loading indicator of the tabs goes away.
+All users run in one event loop, with many users the load test itself can use a full cpu.
+
+run:
+python3 bench/load_bench.py --users 50 --duration 120 --num-procs 4
+python3 bench/load_bench.py --config bench/data/config.ini --users 100 -- --reuse-sessions
+python3 bench/load_bench.py --url http://localhost:5100/ui --pid 1234 --users 20
+python3 bench/load_bench.py --users 50 --compare bench/results/load-old.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import asyncio
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+import urllib.request
+import numpy as np
+import panel.models  # noqa: F401, the client has to know the panel models
+from tornado.websocket import websocket_connect
+from bokeh.document import Document
+from bokeh.document.events import MessageSentEvent
+from bokeh.events import ButtonClick
+from bokeh.models import Button, MultiChoice, Spinner
+from bokeh.protocol import Protocol
+from bokeh.protocol.receiver import Receiver
+from bokeh.client.websocket import WebSocketClientConnectionWrapper
+from bokeh.util.token import generate_jwt_token, generate_session_id
+
+SRC_FOLDER: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+DEFAULT_MIX: str = "genes=0.4,chromosome=0.3,range=0.2,all=0.1"
+BUSY_TEXT: str = "server is busy"
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """Reads the mix of filters, like genes=0.4,chromosome=0.3,range=0.2,all=0.1
+
+    Parameters
+    ----------
+    mix : str
+            Kind of filter and weight, comma separated
+
+    Returns
+    -------
+    dict
+        kind as key, weight as value
+
+    Raises
+    ------
+    ValueError
+        When a kind is unknown
+    """
+    weights = {}
+    for part in mix.split(","):
+        kind, weight = part.split("=")
+        if kind.strip() not in ("genes", "chromosome", "range", "all"):
+            raise ValueError(f"unknown filter kind {kind!r}")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+def pick_filters(options: dict, mix: dict[str, float], rng: random.Random) -> dict:
+    """Picks the filters of one submit
+
+    Parameters
+    ----------
+    options : dict
+            chromosomes, groups, genes and highest_start of the app
+    mix : dict
+            From parse_mix
+    rng : random.Random
+            Random numbers of the user
+
+    Returns
+    -------
+    dict
+        kind, and the values of the chromosome, group, gene and range widgets
+    """
+    kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+    filters = {"kind": kind, "chromosome:": [], "group:": [], "genes:": [],
+               "range start": 0, "range end": 0}
+    if options["groups"] and rng.random() < 0.3:
+        filters["group:"] = rng.sample(options["groups"], rng.randint(1, len(options["groups"])))
+    if kind == "genes" and options["genes"]:
+        filters["genes:"] = rng.sample(options["genes"], min(rng.randint(1, 5),
+                                                             len(options["genes"])))
+    elif kind == "chromosome" and options["chromosomes"]:
+        filters["chromosome:"] = rng.sample(options["chromosomes"],
+                                            min(rng.randint(1, 2), len(options["chromosomes"])))
+    elif kind == "range" and options["chromosomes"]:
+        width = int(10 ** rng.uniform(4, 7))
+        start = rng.randint(0, max(options["highest_start"] - width, 0))
+        filters["chromosome:"] = [rng.choice(options["chromosomes"])]
+        filters["range start"], filters["range end"] = start, start + width
+    return filters
+
+
+class SimulatedUser:
+    """One websocket session that submits filters"""
+
+    def __init__(self, url: str, mix: dict[str, float], think: float, timeout: float,
+                 seed: int):
+        """Creates a user, nothing is opened yet
+
+        Parameters
+        ----------
+        url : str
+                http url of the app
+        mix : dict
+                From parse_mix
+        think : float
+                Mean seconds between the end of a submit and the next one
+        timeout : float
+                Max seconds a submit can take
+        seed : int
+                Seed of the random filters
+        """
+        self.websocket_url = url.replace("http", "ws", 1).rstrip("/") + "/ws"
+        self.mix = mix
+        self.think = think
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.protocol = Protocol()
+        self.receiver = Receiver(self.protocol)
+        self.document = Document()
+        self.socket = None
+        self.wrapper = None
+        self.widgets: dict = {}
+        self.loading: set[str] = set()
+        self.submits: list[dict] = []
+
+    async def receive(self):
+        """Waits for the next message of the server, None when the connection closed"""
+        while True:
+            fragment = await self.socket.read_message()
+            if fragment is None:
+                return None
+            message = await self.receiver.consume(fragment)
+            if message is not None:
+                return message
+
+    async def open(self) -> float:
+        """Opens the session and pulls the document
+
+        Returns
+        -------
+        float
+            Seconds until the page was there
+        """
+        start = time.perf_counter()
+        session_id = generate_session_id()
+        self.socket = await websocket_connect(
+            self.websocket_url, subprotocols=["bokeh", generate_jwt_token(session_id)],
+            max_message_size=512 * 1024 * 1024)
+        self.wrapper = WebSocketClientConnectionWrapper(self.socket)
+        await self.receive()  # ACK
+        await self.protocol.create("PULL-DOC-REQ").send(self.wrapper)
+        reply = await self.receive()
+        while reply is not None and reply.msgtype != "PULL-DOC-REPLY":
+            reply = await self.receive()
+        if reply is None:
+            raise ConnectionError("closed by the server")
+        reply.push_to_document(self.document)
+
+        for model in self.document.models:
+            if isinstance(model, Button) and model.label == "Filter data!":
+                self.widgets["button"] = model
+            elif isinstance(model, MultiChoice):
+                self.widgets[model.title] = model
+            elif isinstance(model, Spinner) and model.title in ("range start", "range end"):
+                self.widgets[model.title] = model
+        return time.perf_counter() - start
+
+    def options(self) -> dict:
+        """Gets the choices of the widgets"""
+        return {"chromosomes": list(self.widgets["chromosome:"].options),
+                "groups": list(self.widgets["group:"].options),
+                "genes": list(self.widgets["genes:"].options),
+                "highest_start": int(self.widgets["range start"].high or 0)}
+
+    def apply(self, message) -> bool:
+        """Applies a patch of the server, and checks if the tabs are done loading
+
+        Returns
+        -------
+        bool
+            True when no part of the page is loading anymore
+        """
+        for event in message.content.get("events", []):
+            if event.get("kind") == "ModelChanged" and event.get("attr") == "css_classes":
+                model = event["model"]["id"]
+                if "pn-loading" in event["new"]:
+                    self.loading.add(model)
+                else:
+                    self.loading.discard(model)
+        message.apply_to_document(self.document, self)
+        return not self.loading
+
+    async def submit(self, filters: dict) -> dict:
+        """Sets the widgets, presses the button and waits for the new tabs
+
+        Parameters
+        ----------
+        filters : dict
+                From pick_filters
+
+        Returns
+        -------
+        dict
+            kind, latency in seconds, busy and timed_out
+        """
+        changes = []
+        self.document.on_change(changes.append)
+        for title in ("chromosome:", "group:", "genes:"):
+            self.widgets[title].value = filters[title]
+        for title in ("range start", "range end"):
+            self.widgets[title].value = filters[title]
+        self.document.callbacks.send_event(ButtonClick(self.widgets["button"]))
+        self.document.remove_on_change(changes.append)
+
+        start = time.perf_counter()
+        await self.protocol.create("PATCH-DOC", [event for event in changes
+                                                 if isinstance(event, MessageSentEvent)
+                                                 or hasattr(event, "attr")]).send(self.wrapper)
+        busy = False
+        started = False
+        try:
+            while True:
+                message = await asyncio.wait_for(
+                    self.receive(), self.timeout - (time.perf_counter() - start))
+                if message is None:
+                    raise ConnectionError("closed by the server")
+                if message.msgtype != "PATCH-DOC":
+                    continue
+                busy = busy or BUSY_TEXT in str(message.content)
+                done = self.apply(message)
+                started = started or bool(self.loading)
+                if started and done:
+                    break
+            timed_out = False
+        except asyncio.TimeoutError:
+            timed_out = True
+        return {"kind": filters["kind"], "latency_s": time.perf_counter() - start,
+                "busy": busy, "timed_out": timed_out}
+
+    async def run(self, until: float) -> None:
+        """Submits filters until the end time
+
+        Parameters
+        ----------
+        until : float
+                time.perf_counter() at which to stop
+        """
+        try:
+            open_s = await self.open()
+            self.submits.append({"kind": "open", "latency_s": open_s,
+                                 "busy": False, "timed_out": False})
+            options = self.options()
+            while time.perf_counter() < until:
+                await asyncio.sleep(min(self.rng.expovariate(1 / self.think) if self.think else 0,
+                                        max(until - time.perf_counter(), 0)))
+                if time.perf_counter() >= until:
+                    break
+                self.submits.append(await self.submit(pick_filters(options, self.mix, self.rng)))
+        except (OSError, ConnectionError) as error:
+            self.submits.append({"kind": "error", "error": repr(error)})
+        finally:
+            if self.socket is not None:
+                self.socket.close()
+
+
+def process_tree(pid: int) -> list[int]:
+    """Gets a process and all of its children (the panel serve workers)"""
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat", encoding="utf-8") as stat:
+                    parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(parent, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo += children.get(current, [])
+    return tree
+
+
+def process_usage(pid: int) -> dict[str, float] | None:
+    """Gets the rss in bytes and the used cpu seconds of a process, None when it is gone"""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status", encoding="utf-8") as status:
+            rss = next(int(line.split()[1]) * 1024 for line in status
+                       if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {"rss": rss, "cpu_s": (int(fields[11]) + int(fields[12])) / ticks}
+
+
+async def monitor(pid: int | None, samples: dict, interval: float = 1.0) -> None:
+    """Samples the rss and cpu of the server processes until cancelled
+
+    Parameters
+    ----------
+    pid : int or None
+            Main process of the server, nothing is sampled without it
+    samples : dict
+            Filled with pid as key and a list of samples as value
+    interval : float
+            Seconds between samples
+    """
+    while pid is not None:
+        now = time.perf_counter()
+        for process in process_tree(pid):
+            usage = process_usage(process)
+            if usage is not None:
+                samples.setdefault(process, []).append({"t": now, **usage})
+        await asyncio.sleep(interval)
+
+
+def summarise(submits: list[dict], samples: dict, wall_s: float) -> dict:
+    """Computes the latency percentiles, throughput and process usage
+
+    Parameters
+    ----------
+    submits : list
+            Submits of all users
+    samples : dict
+            From monitor
+    wall_s : float
+            Seconds the load test ran
+
+    Returns
+    -------
+    dict
+        The summary, also written to the result json
+    """
+    done = [submit for submit in submits if submit["kind"] not in ("open", "error")
+            and not submit["timed_out"]]
+    opens = [submit["latency_s"] for submit in submits if submit["kind"] == "open"]
+
+    def percentiles(latencies: list[float]) -> dict[str, float | None]:
+        if not latencies:
+            return {"p50_s": None, "p95_s": None, "p99_s": None, "max_s": None}
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+        return {"p50_s": p50, "p95_s": p95, "p99_s": p99, "max_s": max(latencies)}
+
+    processes = {}
+    for pid, series in samples.items():
+        elapsed = series[-1]["t"] - series[0]["t"]
+        cpu_s = series[-1]["cpu_s"] - series[0]["cpu_s"]
+        processes[str(pid)] = {"peak_rss_bytes": max(sample["rss"] for sample in series),
+                               "cpu_s": cpu_s,
+                               "cpu_utilisation": cpu_s / elapsed if elapsed > 0 else 0.0}
+    return {"submits": len(done),
+            "busy": sum(submit["busy"] for submit in done),
+            "timed_out": sum(submit.get("timed_out", False) for submit in submits),
+            "errors": sum(submit["kind"] == "error" for submit in submits),
+            "throughput_per_s": len(done) / wall_s if wall_s > 0 else 0.0,
+            "latency": percentiles([submit["latency_s"] for submit in done]),
+            "latency_per_kind": {kind: percentiles([submit["latency_s"] for submit in done
+                                                    if submit["kind"] == kind])
+                                 for kind in sorted({submit["kind"] for submit in done})},
+            "open": percentiles(opens),
+            "total_peak_rss_bytes": sum(process["peak_rss_bytes"]
+                                        for process in processes.values()),
+            "processes": processes}
+
+
+async def run_load(url: str, pid: int | None, users: int, duration: float, ramp: float,
+                   think: float, timeout: float, mix: dict[str, float], seed: int) -> dict:
+    """Runs the simulated users against the app
+
+    Parameters
+    ----------
+    url : str
+            http url of the app
+    pid : int or None
+            Main process of the server, to measure its memory and cpu
+    users : int
+            Amount of simulated users
+    duration : float
+            Seconds to keep submitting
+    ramp : float
+            Seconds over which the users start
+    think : float
+            Mean seconds between submits of a user
+    timeout : float
+            Max seconds a submit can take
+    mix : dict
+            From parse_mix
+    seed : int
+            Seed of the random filters
+
+    Returns
+    -------
+    dict
+        From summarise, with every submit
+    """
+    samples: dict = {}
+    sampler = asyncio.create_task(monitor(pid, samples))
+    start = time.perf_counter()
+    until = start + duration
+
+    async def start_user(number: int, user: SimulatedUser):
+        await asyncio.sleep(ramp * number / max(users, 1))
+        await user.run(until)
+
+    simulated = [SimulatedUser(url, mix, think, timeout, seed + number) for number in range(users)]
+    await asyncio.gather(*(start_user(number, user) for number, user in enumerate(simulated)))
+    wall_s = time.perf_counter() - start
+    sampler.cancel()
+
+    submits = [submit for user in simulated for submit in user.submits]
+    return {**summarise(submits, samples, wall_s), "wall_s": wall_s, "all_submits": submits}
+
+
+def start_app(port: int, num_procs: int, config_path: str | None,
+              extra: list[str]) -> tuple[subprocess.Popen, str | None]:
+    """Starts the app with the launcher
+
+    Parameters
+    ----------
+    port : int
+            Port of the app
+    num_procs : int
+            Amount of worker processes
+    config_path : str or None
+            config.ini to use instead of data/config.ini
+    extra : list
+            Arguments for panel serve
+
+    Returns
+    -------
+    tuple
+        The server process, and the temporary folder it runs in (None without config_path)
+    """
+    folder = None
+    cwd = os.path.join(SRC_FOLDER, "..")
+    if config_path:
+        # The app reads data/config.ini from the folder it runs in
+        folder = tempfile.mkdtemp(prefix="load_test_")
+        os.makedirs(os.path.join(folder, "data"))
+        shutil.copy(config_path, os.path.join(folder, "data", "config.ini"))
+        cwd = folder
+    command = [sys.executable, os.path.join(SRC_FOLDER, "serve.py"), "--port", str(port),
+               "--num-procs", str(num_procs), "--", *extra]
+    server = subprocess.Popen(command, cwd=cwd, start_new_session=True)
+    return server, folder
+
+
+def wait_for_app(url: str, server: subprocess.Popen | None, timeout: float = 600) -> None:
+    """Waits until the app answers
+
+    Raises
+    ------
+    RuntimeError
+        When the server stopped or did not answer in time
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"the server stopped with exit code {server.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(1)
+    raise RuntimeError(f"{url} did not answer in {timeout} seconds")
+
+
+def compare(result: dict, baseline_path: str, threshold: float) -> list[str]:
+    """Compares a result with an older result file
+
+    Parameters
+    ----------
+    result : dict
+            Summary of this run
+    baseline_path : str
+            Path to an older result json
+    threshold : float
+            Allowed growth, 1.2 means 20% slower, 20% less throughput or 20% more memory
+
+    Returns
+    -------
+    list
+        Descriptions of every regression that was found
+    """
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        old = json.load(baseline_file)["result"]
+    regressions = []
+    for metric in ("p50_s", "p95_s", "p99_s"):
+        before, after = old["latency"][metric], result["latency"][metric]
+        if before and after and after / before > threshold:
+            regressions.append(f"latency {metric}: {before:.4g} -> {after:.4g}")
+    if result["throughput_per_s"] and old["throughput_per_s"] / result["throughput_per_s"] > threshold:
+        regressions.append(f"throughput: {old['throughput_per_s']:.4g} -> "
+                           f"{result['throughput_per_s']:.4g}")
+    before, after = old["total_peak_rss_bytes"], result["total_peak_rss_bytes"]
+    if before and after and after / before > threshold:
+        regressions.append(f"total_peak_rss_bytes: {before:.4g} -> {after:.4g}")
+    return regressions
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(description="Load test the website with simulated users")
+    parser.add_argument("--url", help="url of a running app, it is started when not given")
+    parser.add_argument("--pid", type=int, help="main process of a running app, for rss and cpu")
+    parser.add_argument("--config", help="config.ini of the data, defaults to data/config.ini")
+    parser.add_argument("--port", type=int, default=5150)
+    parser.add_argument("--num-procs", type=int, default=1)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds to start all users")
+    parser.add_argument("--think", type=float, default=2, help="mean seconds between submits")
+    parser.add_argument("--timeout", type=float, default=120, help="max seconds of a submit")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of the kinds of filters")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench/results",
+                        help="folder to write the result json to")
+    parser.add_argument("--compare", help="older result json to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="allowed slowdown before it counts as a regression")
+    args, extra = parser.parse_known_args()
+    extra = [argument for argument in extra if argument != "--"]
+
+    server, folder, pid = None, None, args.pid
+    url = args.url or f"http://localhost:{args.port}/ui"
+    if args.url is None:
+        server, folder = start_app(args.port, args.num_procs, args.config, extra)
+        pid = server.pid
+    try:
+        wait_for_app(url, server)
+        result = asyncio.run(run_load(url, pid, args.users, args.duration, args.ramp,
+                                      args.think, args.timeout, parse_mix(args.mix), args.seed))
+    finally:
+        if server is not None:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    submits = result.pop("all_submits")
+    print(json.dumps({key: value for key, value in result.items() if key != "processes"},
+                     indent=2))
+
+    os.makedirs(args.out, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    out_path = os.path.join(args.out, f"load-{stamp}.json")
+    with open(out_path, mode="w", encoding="utf-8") as out_file:
+        json.dump({"created": stamp,
+                   "settings": {**vars(args), "panel_args": extra},
+                   "machine": {"python": platform.python_version(),
+                               "platform": platform.platform(),
+                               "cpus": os.cpu_count()},
+                   "result": result,
+                   "submits": submits}, out_file, indent=2)
+    print(f"Results written to {out_path}")
+
+    if args.compare:
+        regressions = compare(result, args.compare, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+run_benchmarks.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Times the hot paths of the backend and measures their memory use.
+Every benchmark runs in its own process, so the peak memory of one
+benchmark does not leak into the next one.
+Results are written as json, and can be compared with an older result file
+to catch regressions before deploying.
+
+run:
+python3 bench/run_benchmarks.py --config bench/data/config.ini
+python3 bench/run_benchmarks.py --generate --cpgs 1000000 --samples 10
+python3 bench/run_benchmarks.py --config bench/data/config.ini --compare bench/results/old.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import datetime
+import statistics
+import configparser
+import multiprocessing
+from queue import Empty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import backend as be  # noqa: E402
+import gene_ranking as gr  # noqa: E402
+import generate_data  # noqa: E402
+import instrumentation as instr  # noqa: E402
+
+
+def read_config(path: str) -> configparser.ConfigParser:
+    """Reads the config of the dataset to benchmark
+
+    Parameters
+    ----------
+    path : str
+            Path to a config.ini
+
+    Returns
+    -------
+    configparser.ConfigParser
+        ConfigParser object that contains config.ini information
+
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(f"config file: {path} not found")
+    return config
+
+
+def reset_peak_memory() -> None:
+    """Resets the peak memory (VmHWM) of this process
+
+    Only works on linux, other systems keep the peak since process start.
+
+    """
+    try:
+        with open("/proc/self/clear_refs", mode="w", encoding="utf-8") as refs:
+            refs.write("5")
+    except OSError:
+        pass
+
+
+def memory_usage() -> dict[str, int]:
+    """Gets the current and peak memory use of this process in bytes
+
+    Returns
+    -------
+    dict
+        rss and peak_rss in bytes
+
+    """
+    usage = {"rss": 0, "peak_rss": 0}
+    try:
+        with open("/proc/self/status", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    usage["rss"] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    usage["peak_rss"] = int(line.split()[1]) * 1024
+    except OSError:
+        import resource
+        usage["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return usage
+
+
+def pick_genes(annotated_bed, n_genes: int) -> list[str]:
+    """Picks genes spread over the promoter file
+
+    Parameters
+    ----------
+    annotated_bed : pl.DataFrame
+            Contains the promoter sites
+    n_genes : int
+            Amount of genes to pick
+
+    Returns
+    -------
+    list
+        gene names
+
+    """
+    genes = annotated_bed["gene_name"].unique(maintain_order=True)
+    step = max(len(genes) // n_genes, 1)
+    return genes.gather_every(step).head(n_genes).to_list()
+
+
+def setup_read_data(config):
+    """Nothing to prepare, read_data does all of the work"""
+    return (config,)
+
+
+def setup_loaded(config):
+    """Loads the main data and promoters once, outside of the timing"""
+    main_data = be.read_data.__wrapped__(config)
+    annotated_bed = be.load_bed_file(config)
+    return main_data, annotated_bed
+
+
+def bench_read_data(config):
+    """read_data without the panel cache"""
+    return be.read_data.__wrapped__(config)
+
+
+def bench_filter_genes(main_data, annotated_bed):
+    """filter_genes with 5 genes, the maximum the ui allows"""
+    return be.filter_genes(pick_genes(annotated_bed, 5), main_data, annotated_bed)
+
+
+def bench_count_methylation_data(main_data, _annotated_bed):
+    """count_methylation_data on the full table"""
+    return be.count_methylation_data(main_data)
+
+
+def bench_plot_plots(main_data, annotated_bed):
+    """plot_plots on a 5 gene selection, with scatter"""
+    genes = pick_genes(annotated_bed, 5)
+    filtered = be.filter_genes(genes, main_data, annotated_bed)
+    return asyncio.run(be.plot_plots(filtered, genes))
+
+
+def bench_build_gene_ranking(main_data, annotated_bed):
+    """build_gene_ranking of all genes and groups"""
+    return gr.build_gene_ranking([gr.gene_sums(main_data, annotated_bed)])
+
+
+def setup_gene_ranking(config):
+    """Builds the gene ranking once, outside of the timing"""
+    main_data, annotated_bed = setup_loaded(config)
+    return (gr.build_gene_ranking([gr.gene_sums(main_data, annotated_bed)]),)
+
+
+def bench_top_genes(ranking):
+    """top_genes, 20 genes of half of the groups"""
+    return gr.top_genes(ranking, "frac variance", 20,
+                        groups=ranking.samples[:max(len(ranking.samples) // 2, 2)])
+
+
+BENCHMARKS = {
+    "read_data": (setup_read_data, bench_read_data),
+    "filter_genes": (setup_loaded, bench_filter_genes),
+    "count_methylation_data": (setup_loaded, bench_count_methylation_data),
+    "plot_plots": (setup_loaded, bench_plot_plots),
+    "build_gene_ranking": (setup_loaded, bench_build_gene_ranking),
+    "top_genes": (setup_gene_ranking, bench_top_genes),
+}
+
+
+def run_one(name: str, config_path: str, repeats: int, queue) -> None:
+    """Runs a single benchmark, meant to run in a child process
+
+    Parameters
+    ----------
+    name : str
+            Name of the benchmark in BENCHMARKS
+    config_path : str
+            Path to the config of the dataset
+    repeats : int
+            How many times the hot path is timed
+    queue : multiprocessing.Queue
+            Where the result is put
+
+    """
+    setup, bench = BENCHMARKS[name]
+    try:
+        args = setup(read_config(config_path))
+        baseline = memory_usage()["rss"]
+        timings = []
+        peaks = []
+        rows = None
+        for _ in range(repeats):
+            reset_peak_memory()
+            start = time.perf_counter()
+            result = bench(*args)
+            timings.append(time.perf_counter() - start)
+            peaks.append(memory_usage()["peak_rss"] - baseline)
+            rows = instr.row_count(result)
+            del result
+
+        queue.put({"name": name,
+                   "repeats": repeats,
+                   "min_s": min(timings),
+                   "median_s": statistics.median(timings),
+                   "mean_s": statistics.fmean(timings),
+                   "stdev_s": statistics.stdev(timings) if repeats > 1 else 0.0,
+                   "peak_mem_bytes": max(peaks),
+                   "rows_out": rows})
+    except Exception as error:  # pylint: disable=broad-except
+        queue.put({"name": name, "error": repr(error)})
+
+
+def run_benchmarks(config_path: str, names: list[str], repeats: int) -> list[dict]:
+    """Runs the benchmarks, every one in a new process
+
+    A process that dies without a result (crashed or killed for memory)
+    is reported as an error, the other benchmarks still run.
+    The processes are spawned, not forked: a fork of a process that already
+    used the polars thread pool (--generate) deadlocks in its first query.
+
+    Parameters
+    ----------
+    config_path : str
+            Path to the config of the dataset
+    names : list
+            Names of the benchmarks to run
+    repeats : int
+            How many times every hot path is timed
+
+    Returns
+    -------
+    list
+        A dict with the results for every benchmark
+
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in names:
+        queue = context.Queue()
+        process = context.Process(target=run_one, args=(name, config_path, repeats, queue))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                if not process.is_alive():
+                    # The result can arrive just before the process exits
+                    try:
+                        result = queue.get(timeout=1)
+                    except Empty:
+                        result = {"name": name,
+                                  "error": f"process exited with code {process.exitcode}"}
+        process.join()
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[str]:
+    """Compares results with an older result file
+
+    Parameters
+    ----------
+    results : list
+            Results of this run
+    baseline_path : str
+            Path to an older result json
+    threshold : float
+            Allowed slowdown/memory growth, 1.2 means 20%
+
+    Returns
+    -------
+    list
+        Descriptions of every regression that was found
+
+    """
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = {result["name"]: result
+                    for result in json.load(baseline_file)["results"]}
+
+    regressions = []
+    for result in results:
+        old = baseline.get(result["name"])
+        if old is None or "error" in old or "error" in result:
+            continue
+        for metric in ("median_s", "peak_mem_bytes"):
+            if old[metric] > 0 and result[metric] / old[metric] > threshold:
+                regressions.append(f"{result['name']} {metric}: "
+                                   f"{old[metric]:.4g} -> {result[metric]:.4g}")
+    return regressions
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(description="Benchmark the backend hot paths")
+    parser.add_argument("--config", default="bench/data/config.ini",
+                        help="config.ini of the dataset to benchmark")
+    parser.add_argument("--generate", action="store_true",
+                        help="generate a synthetic dataset first")
+    parser.add_argument("--cpgs", type=int, default=1_000_000)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--out", default="bench/results",
+                        help="folder to write the result json to")
+    parser.add_argument("--compare", help="older result json to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="allowed slowdown before it counts as a regression")
+    args = parser.parse_args()
+
+    config_path = args.config
+    if args.generate:
+        config_path = generate_data.generate(os.path.dirname(args.config) or ".",
+                                             args.cpgs, args.samples)
+
+    results = run_benchmarks(config_path, args.only, args.repeats)
+
+    os.makedirs(args.out, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    out_path = os.path.join(args.out, f"bench-{stamp}.json")
+    with open(out_path, mode="w", encoding="utf-8") as out_file:
+        json.dump({"created": stamp,
+                   "config": os.path.abspath(config_path),
+                   "machine": {"python": platform.python_version(),
+                               "platform": platform.platform(),
+                               "cpus": os.cpu_count(),
+                               "polars": be.pl.__version__},
+                   "results": results}, out_file, indent=2)
+    print(f"Results written to {out_path}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+api.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+HTTP query API over the backend, for pipelines that need the filtered data
+without rendering the website.
+Uses the same block index, filters, scheduler and caches as the website.
+With query_engine = duckdb the rows and counts are queried with SQL (see sql_backend.py).
+
+Endpoints (GET with query arguments, or POST with a json body):
+/api/info       chromosomes, groups and the amount of CpGs
+/api/counts     amount of CpGs per group
+/api/summary    summary statistics per group and chromosome (and gene)
+/api/rows       the filtered CpGs as an Arrow IPC stream,
+                or json with format=json (at most max_json_rows rows)
+
+Filter arguments, lists can be repeated or comma separated:
+chr, group, gene, min_range, max_range, min_coverage, min_frac, max_frac
+
+Settings go in the config.ini:
+[API]
+port = 5101
+max_json_rows = 100000
+
+run (next to the website, every worker serves the api):
+PYTHONPATH=src panel serve src/ui.py --plugins api --port=5100
+run (on its own):
+python3 src/api.py
+run (as a shard with some of the chromosomes, see router.py):
+python3 src/api.py --port 5102 --shard chr1,chr2
+"""
+
+import io
+import json
+import argparse
+import asyncio
+import configparser
+import pyarrow as pa
+import polars as pl
+import tornado.web
+import tornado.ioloop
+import core
+import dataset as ds
+import instrumentation as instr
+import plot_cache
+import scheduler
+import summary
+import sql_backend as sql
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+LIST_ARGUMENTS = {"chr": "chr_select", "group": "group_select", "gene": "gene_list"}
+NUMBER_ARGUMENTS = {"min_range": int, "max_range": int, "min_coverage": int,
+                    "min_frac": float, "max_frac": float}
+
+
+def parse_spec(arguments: dict[str, list[str]]) -> core.FilterSpec:
+    """Turns request arguments into a filter spec
+
+    Parameters
+    ----------
+    arguments : dict
+            argument name as key, list of values as value
+
+    Returns
+    -------
+    core.FilterSpec
+        The filters of the request
+
+    Raises
+    ------
+    ValueError
+        When a number argument is not a number
+
+    """
+    filters = {}
+    for argument, name in LIST_ARGUMENTS.items():
+        filters[name] = [value.strip() for values in arguments.get(argument, [])
+                         for value in str(values).split(",") if value.strip()]
+    numbers = {}
+    for argument, cast in NUMBER_ARGUMENTS.items():
+        values = arguments.get(argument)
+        if values:
+            try:
+                numbers[argument] = cast(values[-1])
+            except ValueError as error:
+                raise ValueError(f"{argument} should be a number, not {values[-1]!r}") from error
+
+    frac_range = None
+    if "min_frac" in numbers or "max_frac" in numbers:
+        frac_range = (numbers.get("min_frac", 0.0), numbers.get("max_frac", 1.0))
+    return core.make_filter_spec(min_range=numbers.get("min_range", 0),
+                                 max_range=numbers.get("max_range", 0),
+                                 min_coverage=numbers.get("min_coverage", 0),
+                                 frac_range=frac_range, **filters)
+
+
+def query_info(dataset: dict, _spec: core.FilterSpec) -> dict:
+    """Describes the data that can be queried"""
+    bounds = core.data_bounds(dataset["block_index"])
+    return {"generation": dataset["generation"], "rows": bounds["rows"],
+            "chromosomes": bounds["chromosomes"], "groups": bounds["groups"]}
+
+
+def query_rows(dataset: dict, spec: core.FilterSpec) -> pl.DataFrame:
+    """Filters the CpGs on a spec"""
+    if dataset.get("sql_engine") is not None:
+        return dataset["sql_engine"].apply_filter_spec(spec)
+    return core.apply_filter_spec(dataset["main_data"], dataset["block_index"],
+                                  dataset["annotated_bed"], spec)
+
+
+def query_counts(dataset: dict, spec: core.FilterSpec) -> pl.DataFrame:
+    """Counts the filtered CpGs per group"""
+    if dataset.get("sql_engine") is not None:
+        return (dataset["sql_engine"].run(sql.count_methylation_data(sql.filter_plan(spec)))
+                .sort("group_name"))
+    return core.count_methylation_data(query_rows(dataset, spec)).sort("group_name")
+
+
+def query_summary(dataset: dict, spec: core.FilterSpec) -> pl.DataFrame:
+    """Summarises the filtered CpGs"""
+    return summary.summarise_methylation(query_rows(dataset, spec))
+
+
+QUERIES = {"info": query_info, "counts": query_counts,
+           "summary": query_summary, "rows": query_rows}
+
+
+def arrow_chunks(df: pl.DataFrame, rows_per_batch: int = 65536):
+    """Writes a dataframe as an Arrow IPC stream, one record batch at a time
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Data to write
+    rows_per_batch : int
+            Rows per record batch
+
+    Yields
+    ------
+    bytes
+        The next part of the stream
+    """
+    table = df.to_arrow()
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=rows_per_batch):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+class QueryHandler(tornado.web.RequestHandler):
+    """Answers the queries of one endpoint"""
+
+    def initialize(self, config: configparser.ConfigParser):
+        """Stores the config, called by tornado for every request"""
+        self.config = config
+
+    def arguments(self) -> dict[str, list[str]]:
+        """Gets the arguments of the query string and the json body"""
+        arguments = {name: [value.decode() for value in values]
+                     for name, values in self.request.query_arguments.items()}
+        if self.request.body:
+            try:
+                body = json.loads(self.request.body)
+            except json.JSONDecodeError as error:
+                raise tornado.web.HTTPError(400, reason=f"Invalid json: {error}") from error
+            for name, value in body.items():
+                arguments[name] = [str(item) for item in value] if isinstance(value, list) \
+                    else [str(value)]
+        return arguments
+
+    async def get(self, endpoint: str):
+        """Runs a query"""
+        arguments = self.arguments()
+        try:
+            spec = parse_spec(arguments)
+        except ValueError as error:
+            raise tornado.web.HTTPError(400, reason=str(error)) from error
+        output = arguments.get("format", ["arrow" if endpoint == "rows" else "json"])[-1]
+
+        with instr.span(f"api.{endpoint}") as record:
+            result = await self.answer(endpoint, spec)
+            record["rows_out"] = instr.row_count(result)
+            instr.increment("methylation_api_requests_total", endpoint=endpoint)
+
+            if isinstance(result, dict):
+                self.write(result)
+            elif output == "arrow":
+                self.set_header("Content-Type", ARROW_STREAM)
+                for chunk in arrow_chunks(result):
+                    self.write(chunk)
+                    await self.flush()
+            else:
+                max_rows = self.config.getint("API", "max_json_rows", fallback=100_000)
+                if result.height > max_rows:
+                    raise tornado.web.HTTPError(
+                        413, reason=f"{result.height} rows, more than {max_rows}, use format=arrow")
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps({"spec": spec._asdict(), "rows": result.height,
+                                       "data": result.to_dicts()}))
+
+    async def post(self, endpoint: str):
+        """Runs a query, with the arguments in a json body"""
+        await self.get(endpoint)
+
+    async def answer(self, endpoint: str, spec: core.FilterSpec) -> dict | pl.DataFrame:
+        """Gets the result of a query on the data of this process"""
+        dataset = await asyncio.to_thread(ds.get_dataset, self.config)
+        try:
+            return await asyncio.to_thread(self.run_query, endpoint, dataset, spec)
+        except scheduler.SchedulerBusy as error:
+            self.set_header("Retry-After", "5")
+            raise tornado.web.HTTPError(503, reason=f"Server busy: {error}") from error
+
+    def run_query(self, endpoint: str, dataset: dict, spec: core.FilterSpec):
+        """Runs a query in a thread, aggregated results are cached"""
+        if endpoint == "info":
+            return query_info(dataset, spec)
+
+        if sql.query_engine(self.config) == "duckdb":
+            dataset = dataset | {"sql_engine": sql.get_engine(dataset, self.config)}
+        settings = scheduler.scheduler_settings(self.config)
+        cost = core.estimate_rows(dataset["block_index"], spec)
+        with scheduler.get_scheduler(settings).admit(cost, self.request.remote_ip):
+            if endpoint == "rows":
+                return query_rows(dataset, spec)
+            cache = plot_cache.get_plot_cache(self.config, "api_cache")
+            key = (dataset["generation"], endpoint, spec)
+            result = cache.get(key)
+            if result is None:
+                result = QUERIES[endpoint](dataset, spec)
+                cache.put(key, result)
+            return result
+
+
+def api_routes(config: configparser.ConfigParser) -> list[tuple]:
+    """Creates the tornado routes of the api
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files and the api settings
+
+    Returns
+    -------
+    list
+        (pattern, handler, arguments) tuples
+    """
+    return [(r"/api/(info|counts|summary|rows)", QueryHandler, {"config": config})]
+
+
+# Read by panel serve --plugins api
+ROUTES = api_routes(core.parse_config())
+
+
+def main():
+    """Main"""
+    config = core.parse_config()
+    parser = argparse.ArgumentParser(description="Serve the query api")
+    parser.add_argument("--port", type=int, default=config.getint("API", "port", fallback=5101))
+    parser.add_argument("--shard", default=None,
+                        help="comma separated chromosomes, only serve these (see router.py)")
+    args = parser.parse_args()
+    if args.shard is not None:
+        config.read_dict({"DATASET": {"chromosomes": args.shard}})
+    tornado.web.Application(api_routes(config)).listen(args.port)
+    print(f"Serving the api on http://localhost:{args.port}/api")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
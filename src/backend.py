@@ -7,6 +7,8 @@ Year: BFV2
 Usage:
 Serves as the main backend of the website.
 Will contain functions used in ui.py
+The data processing itself is in core.py, this module adds the caching,
+the plots and the panel objects on top of it.
 Not meant to be used without ui.py
 
 run:
@@ -15,327 +17,238 @@ panel serve src/ui.py --port=5100 --allow-websocket-origin='*'
 """
 
 import os
-import re
+import logging
 import asyncio
-import configparser
 import hvplot.polars
+import holoviews as hv
+import numpy as np
+import scipy.cluster.hierarchy
 import polars as pl
 import panel as pn
-import pandas as pd
+import instrumentation as instr
+import core
+from core import (process_groups, count_methylation_data, get_gene_info, filter_df_gene,
+                  filter_genes, load_bed_file, filter_chr, filter_group, filter_ranges,
+                  FilterSpec, make_filter_spec, filter_coverage, filter_frac,
+                  build_block_index, select_blocks, estimate_rows, scan_blocks,
+                  apply_filter_spec, downsample, data_bounds, block_plan, gene_plan,
+                  filter_plan, promoter_regions, region_genes, annotate_promoters)
 
+logger = logging.getLogger(__name__)
 
-@pn.cache
-def parse_config() -> configparser:
-    """Reads config file
+# The website caches the config and the data, the batch scripts use core directly
+parse_config = pn.cache(core.parse_config)
+read_data = pn.cache(max_items=10, per_session=True)(core.read_data)
 
-    This function will read a config file
-    This file contains all of the paths to the data
-    ./data/config.ini
 
-    Parameters
-    ----------
-    None
-
-    Returns
-    -------
-    configparser.ConfigParser
-                        ConfigParser object that contains config.ini information
-
-    """
-    config = configparser.ConfigParser()
-    config.read("data/config.ini")
-    return config
-
-
-def process_groups(config: configparser) -> pl.DataFrame:
-    """Processes group.csv information
+def loading_indicator(label: str) -> pn.indicators.LoadingSpinner:
+    """Create loading indicator
 
-    Will get the group name with barcode information
-    Will also seperate duplicate group names with an index
+    Used when website should display a loading filter
 
     Parameters
     ----------
-    config : ConfigParser
-            Contains the paths to needed files
+    label : str
+            contains the label the loading indicator should show
 
     Returns
     -------
-    pl.DataFrame
-            pl.DataFrame object that contains the group_name and the barcode
+    pn.indicators.LoadingSpinner
+            LoadingSpinner
 
     """
-    # Get file for group data
-    path = config.get("PATHS", "group_data")
-
-    try:
-        barcodes_names: pl.dataframe = pl.read_csv(path)
-
-        # Give duplicate names an index to differentiate them
-        barcodes_names = barcodes_names.with_columns(
-            controle_n=pl.int_range(pl.len()).over(" description") + 1)
-        barcodes_names = barcodes_names.with_columns(
-            group_and_n=pl.concat_str([pl.col(' description'), pl.col("controle_n")]))
-
-        # Strip the strings of ecess of characters
-        barcodes_names = barcodes_names.with_columns(pl.col(pl.Utf8).str.strip_chars()
-                                                     ).drop("controle_n")
-
-    # Raising errors
-    except pl.exceptions.ColumnNotFoundError as error:
-        print(
-            f"Header in {path} file not correct, should be: {' description'}\n {error}")
-        raise
-
-    except FileNotFoundError:
-        print(f"file: {path} not found or incorrect permissions")
-        raise
-
-    return barcodes_names
+    return pn.indicators.LoadingSpinner(
+        value=True, name=label, size=25, align="center"
+    )
 
 
-@pn.cache(max_items=10, per_session=True)
-def read_data(config: configparser) -> pl.DataFrame:
-    """Reads the main analysis data
+async def plot_barchart(df: pl.DataFrame) -> hvplot.plot:
+    """Plots a barchart
 
-    This function will read all of the analysis data and process it.
+    This function will plot a hvplot barchart
 
     Parameters
     ----------
-    config : ConfigParser
-            Contains the paths to needed files
+    df : pl.DataFrame
+        main analysis dataframe
 
     Returns
     -------
-    pl.Dataframe
-            pl.dataframe that contains all of the methylation data
-            Extra column is added that will link the data to the group it belongs to
+    hvplot.barchart
 
     """
-    # Read paths and get the group information
-    path = config.get("PATHS", "data_folder")
-    barcodes_names = process_groups(config)
-    resulting_df: pd.DataFrame = pl.DataFrame(
-        {"chr": [],
-         "start": [],
-         "end": [],
-         "frac": [],
-         "valid": [],
-         "group_name": []})
-
-    # Get the analysis files
-    files: list[str] = os.listdir(path)
-
-    for file in files:
-        # Check if file exists
-        if os.path.isfile(
-                f"{path}/{file}") and file.endswith(".csv"):
-
-            # Read it and make it a polars df
-            temp_df: pd.DataFrame = pd.read_csv(f"{path}/{file}", sep="\t", names=["chr", "start",
-                                                                                   "end", "frac",
-                                                                                   "valid", "group_name"])
-            temp_df: pl.DataFrame = pl.from_pandas(temp_df)
-
-            # Remove excess characters from chr
-            temp_df = temp_df.with_columns(
-                pl.col("chr").str.split("_").list.get(0))
-
-            # Figure out with barcode the file has
-            barcode_num: list[int] = re.findall(r"\d+", file)
-            name_group: str = barcodes_names.filter(pl.col("barcode").cast(
-                pl.String) == barcode_num[0]).select("group_and_n")
-
-            # Name the group accoring to the barcode number
-            temp_df: pl.DataFrame = temp_df.with_columns(
-                pl.lit(name_group).alias("group_name"))
-            resulting_df = pl.concat([temp_df, resulting_df])
-
-    return resulting_df
-
-
-def count_methylation_data(df: pl.DataFrame) -> pl.DataFrame:
-    """Counts amount of methylation points in df
-
-    This function will count all of the methylation points in a df
-    it will be split on the groups in the df
+    # Get count data and plot
+    with instr.span("plot_barchart", rows_in=df.height):
+        return plot_counts(count_methylation_data(df))
+
+
+def plot_counts(counts: pl.DataFrame) -> hvplot.plot:
+    """Plots counted methylations as a barchart
 
     Parameters
     ----------
-    df : pl.DataFrame
-        Dataframe that contains the methylation data
+    counts : pl.DataFrame
+        group_name and n methylations, from count_methylation_data
 
     Returns
     -------
-    pl.Dataframe
-            pl.DataFrame that will contain the amount of methylated spots for every group
+    hvplot.barchart
 
     """
-    # Get All groups in the df
-    all_groups = pl.DataFrame({"group_name": df["group_name"].unique()})
-
-    # Count it
-    return (df
-            .select(["group_name", "frac"])
-            .group_by("group_name")
-            .agg([pl.len().alias("n methylations")])
-            .join(all_groups, on="group_name", how="full")
-            .with_columns(pl.col("group_name").fill_null(pl.col("group_name_right")))
-            .drop("group_name_right")
-            .fill_null(0))
+    return counts.hvplot.bar(x="group_name", y="n methylations",
+                             color="group_name", cmap="Category10",
+                             width=1125, rot=20, height=600,
+                             title="Number of methylations for every group",
+                             xlabel="Group name")
 
 
-def get_gene_info(annotated_bed: pl.DataFrame, genes: list[str]) -> pl.DataFrame:
-    """Will get gene information
+async def plot_tile_plots(tiles: pl.DataFrame, window: int) -> list[tuple]:
+    """Plots the plots from tiles instead of CpGs
 
-    This function will read all of the analysis data and process it.
+    Used when the selection is too wide to plot every CpG.
+    Both plots count the CpGs of whole windows, so the windows at the edges
+    of a range also count the CpGs just outside of it.
+    The density is the amount of CpGs per window.
 
     Parameters
     ----------
-    annotated_bed : pl.DataFrame
-            Contains promoter sites of (mostly) all human genes
-    genes : list
-            A list containing genes the user wants to see, comes from frontend
+    tiles : pl.DataFrame
+        window tiles of the selection, from tiles.query_tiles
+    window : int
+        size of the windows in bases
 
     Returns
     -------
-    pl.Dataframe
-            pl.DataFrame that contains promoter sites for the genes the user specified
+    list
+        This list contains for everyplot a tuple with title of the page and the plot
 
     """
-    print("Getting gene info")
-    df_wanted = (annotated_bed
-                 .filter(pl.col("gene_name").is_in(genes)))
+    if tiles.is_empty():
+        return loading_indicator("Data missing!")
 
-    return df_wanted
+    with instr.span("plot_tile_plots", rows_in=tiles.height):
+        counts = (tiles
+                  .group_by("group_name")
+                  .agg(pl.col("n CpGs").sum().alias("n methylations")))
+        density = (tiles
+                   .group_by(["group_name", "tile_start"])
+                   .agg(pl.col("n CpGs").sum())
+                   .with_columns((pl.col("n CpGs") /
+                                  (pl.col("n CpGs").sum().over("group_name") * window))
+                                 .alias("density"))
+                   .sort(["group_name", "tile_start"]))
+        density_plot = density.hvplot.line(x="tile_start", y="density", by="group_name",
+                                           width=1125, height=600,
+                                           title=f"Density of methylation positions "
+                                                 f"({window:,} bp windows)",
+                                           xlabel="genomic positions")
+    return [("Barplot", plot_counts(counts)),
+            ("Density plot", density_plot),
+            ("Scatter plot", pn.pane.Markdown(f"""
+                                              # Selection too wide for a scatter plot
+                                              The plots are made from {window:,} bp windows.
+                                              Select genes or a smaller range to see the CpGs themselves.
+                                              """))]
 
 
-def filter_df_gene(chromosome: str, start: int, end: int, df: pl.DataFrame) -> pl.DataFrame:
-    """Filters the main data on wanted genes
+async def plot_scatter(df: pl.DataFrame) -> hvplot.plot:
+    """Plots a scatter
 
-    This function will filter the main data on the genes.
-    These genes are specified in the frontend, by the user.
+    This function will plot a hvplot scatter
 
     Parameters
     ----------
-    chromosome : str
-        A chromosome name to filter on
-    start : int
-        a starting range to filter on
-    end : int
-        end of the range to filter on
     df : pl.DataFrame
-        main analysis data
+        main analysis dataframe
 
     Returns
     -------
-    pl.Dataframe
-            main analysis data, filtered on the filters specified above
+    hvplot.scatter
 
     """
-    return df.filter(
-        (pl.col("chr") == chromosome) &
-        (pl.col("start") >= start) &
-        (pl.col("end") <= end))
+    with instr.span("plot_scatter", rows_in=df.height):
+        return df.hvplot.scatter(x="start", y="chr", by="group_name", width=1125,
+                                 dynamic=False,
+                                 alpha=0.2,
+                                 height=600,
+                                 title="Methylated DNA points",
+                                 xlabel="Start positon of methylation",
+                                 ylabel="Chromosome")
 
 
-def filter_genes(gene_list: list[str], df: pl.DataFrame, annotated_bed: pl.DataFrame) -> pl.DataFrame:
-    """Gets list with genes and filters main df on it
+async def plot_density(df: pl.DataFrame) -> hvplot.plot:
+    """Plots a density
 
-    This function will filter the main analysis data based on a list of given genes.
+    This function will plot a hvplot density
 
     Parameters
     ----------
-    gene_list : list
-            A list containing genes the user wants to see, comes from frontend
     df : pl.DataFrame
-            Main analysis data
-    annotated_bed : pl.DataFrame
-            Contains promoter sites of (mostly) all human genes
+        main analysis dataframe
 
     Returns
     -------
-    pl.Dataframe
-            pl.dataframe that contains all of the methylation data
-            Extra column is added that will link the data to the group it belongs to
+    hvplot.density
 
     """
-    # Get a df that contains gene promoter regions
-    df_wanted = get_gene_info(annotated_bed, gene_list)
-    final_subsetted_df: pd.DataFrame = pl.DataFrame(
-        {"chr": [],
-         "start": [],
-         "end": [],
-         "frac": [],
-         "valid": [],
-         "group_name": [],
-         "gene_name": {}})
-
-    # Loop through genes
-    for row in df_wanted.iter_rows():
-        # Extract promoter regions
-        (chromosome, promoter_start, promoter_end, gene) = row
-        # Filter main data based on thos reagions
-        subsetted_df = filter_df_gene(chromosome, promoter_start, promoter_end, df)
-
-        # Add gene name to the resulting df
-        subsetted_df = subsetted_df.with_columns([
-            pl.lit(gene).alias("gene_name")
-        ])
-        final_subsetted_df = pl.concat([subsetted_df, final_subsetted_df])
-
-    return final_subsetted_df
+    with instr.span("plot_density", rows_in=df.height):
+        df = df.select(["group_name", "start"])
 
+        return df.hvplot.kde(by="group_name", width=1125, height=600,
+                             title="Density of methylation positions",
+                             xlabel="genomic positions")
 
-def loading_indicator(label: str) -> pn.indicators.LoadingSpinner:
-    """Create loading indicator
 
-    Used when website should display a loading filter
+def encode_categories(series: pl.Series) -> tuple[np.ndarray, list[str]]:
+    """Encodes strings as small integer codes plus a dictionary
 
     Parameters
     ----------
-    label : str
-            contains the label the loading indicator should show
+    series : pl.Series
+        strings, like chromosome or group names
 
     Returns
     -------
-    pn.indicators.LoadingSpinner
-            LoadingSpinner
+    tuple
+        uint8 codes (uint16 if there are more than 255 values)
+        and the sorted labels, labels[code] gives the string back
 
     """
-    return pn.indicators.LoadingSpinner(
-        value=True, name=label, size=25, align="center"
-    )
+    labels = series.unique().sort().to_list()
+    dtype = np.uint8 if len(labels) < 256 else np.uint16
+    codes = (series
+             .replace_strict(labels, list(range(len(labels))), return_dtype=pl.UInt16)
+             .to_numpy()
+             .astype(dtype))
+    return codes, labels
 
 
-async def plot_barchart(df: pl.DataFrame) -> hvplot.plot:
-    """Plots a barchart
-
-    This function will plot a hvplot barchart
+def position_array(series: pl.Series) -> np.ndarray:
+    """Converts positions to the smallest exact numeric array
 
     Parameters
     ----------
-    df : pl.DataFrame
-        main analysis dataframe
+    series : pl.Series
+        genomic positions
 
     Returns
     -------
-    hvplot.barchart
+    np.ndarray
+        uint32 when the positions fit, float64 otherwise
 
     """
-    # Get count data and plot
-    df = count_methylation_data(df)
-    barplot = df.hvplot.bar(x="group_name", y="n methylations",
-                            color="group_name", cmap="Category10",
-                            width=1125, rot=20, height=600,
-                            title="Number of methylations for every group",
-                            xlabel="Group name")
-    return barplot
+    if series.len() and (series.min() < 0 or series.max() >= 2 ** 32):
+        return series.cast(pl.Float64).to_numpy()
+    return series.cast(pl.UInt32).to_numpy()
 
 
-async def plot_scatter(df: pl.DataFrame) -> hvplot.plot:
-    """Plots a scatter
+async def plot_scatter_binary(df: pl.DataFrame) -> hv.Overlay:
+    """Plots a scatter with typed columns
 
-    This function will plot a hvplot scatter
+    Same plot as plot_scatter, but the browser gets uint32 positions and
+    uint8 chromosome codes as binary buffers, instead of a string
+    for the group and chromosome of every point.
+    The groups are labelled overlays, so the group name is only sent once.
 
     Parameters
     ----------
@@ -344,218 +257,276 @@ async def plot_scatter(df: pl.DataFrame) -> hvplot.plot:
 
     Returns
     -------
-    hvplot.scatter
+    hv.Overlay
 
     """
-    return df.hvplot.scatter(x="start", y="chr", by="group_name", width=1125,
-                             dynamic=False,
-                             alpha=0.2,
-                             height=600,
-                             title="Methylated DNA points",
-                             xlabel="Start positon of methylation",
-                             ylabel="Chromosome")
-
-
-async def plot_density(df: pl.DataFrame) -> hvplot.plot:
-    """Plots a density
-
-    This function will plot a hvplot density
+    with instr.span("plot_scatter", rows_in=df.height):
+        chr_codes, chromosomes = encode_categories(df["chr"])
+        df = df.select(["group_name", "start"]).with_columns(pl.Series("chr code", chr_codes))
+        scatters = []
+        for (group,), part in sorted(df.partition_by("group_name", as_dict=True).items()):
+            scatters.append(hv.Scatter({"start": position_array(part["start"]),
+                                        "chr": part["chr code"].to_numpy()},
+                                       kdims="start", vdims="chr", label=group,
+                                       datatype=["dictionary"]))
+        return (hv.Overlay(scatters)
+                .opts(hv.opts.Scatter(alpha=0.2, size=5),
+                      hv.opts.Overlay(width=1125, height=600,
+                                      title="Methylated DNA points",
+                                      xlabel="Start positon of methylation",
+                                      ylabel="Chromosome",
+                                      yticks=list(enumerate(chromosomes)),
+                                      legend_position="right")))
+
+
+def binned_kde(positions: np.ndarray, n_points: int = 200) -> tuple[np.ndarray, np.ndarray]:
+    """Estimates a gaussian density from a histogram
+
+    The positions are put in a fine histogram first, which is smoothed with a
+    gaussian kernel (bandwidth from Scott's rule). Takes linear time,
+    instead of the points x grid of an exact kernel density.
 
     Parameters
     ----------
-    df : pl.DataFrame
-        main analysis dataframe
+    positions : np.ndarray
+        genomic positions
+    n_points : int
+        amount of points in the returned curve
 
     Returns
     -------
-    hvplot.density
+    tuple
+        float32 grid and float32 density
 
     """
-    df = df.select(["group_name", "start"])
+    positions = positions.astype(np.float64)
+    low, high = positions.min(), positions.max()
+    bandwidth = positions.std() * positions.size ** (-1 / 5) if positions.size > 1 else 0.0
+    if bandwidth == 0 or high == low:
+        bandwidth = max(high - low, 1.0) / n_points
+    low, high = low - 3 * bandwidth, high + 3 * bandwidth
 
-    return df.hvplot.kde(by="group_name", width=1125, height=600,
-                         title="Density of methylation positions",
-                         xlabel="genomic positions")
+    counts, edges = np.histogram(positions, bins=n_points * 4, range=(low, high))
+    step = edges[1] - edges[0]
+    half_width = min(int(4 * bandwidth / step), (counts.size - 1) // 2)
+    kernel_x = np.arange(-half_width, half_width + 1) * step
+    kernel = np.exp(-0.5 * (kernel_x / bandwidth) ** 2)
+    smooth = np.convolve(counts, kernel / kernel.sum(), mode="same")
+    density = smooth / (positions.size * step)
 
+    centers = (edges[:-1] + edges[1:]) / 2
+    return centers[::4].astype(np.float32), density[::4].astype(np.float32)
 
-@pn.cache(max_items=10, per_session=True)
-async def plot_plots(df: pl.DataFrame, want_scatter: list[str]) -> list[tuple]:
-    """Plots all wanted plots
 
-    This function will plot all wanted plots
+async def plot_density_binary(df: pl.DataFrame) -> hv.Overlay:
+    """Plots a density with precomputed curves
+
+    Same plot as plot_density, but the density is computed here with
+    binned_kde and only float32 curves are kept and sent to the browser.
 
     Parameters
     ----------
     df : pl.DataFrame
         main analysis dataframe
-    want_scatter : list
-        Used a check if the scatterplot should be made
 
     Returns
     -------
-    tuple
-        This tuple contains for everyplot a list with title of the page and the plot
+    hv.Overlay
 
     """
-    if df.is_empty():
-        return loading_indicator("Data missing!")
-
-    # Start plotting
-    barplot_task = asyncio.create_task(plot_barchart(df))
-    density_task = asyncio.create_task(plot_density(df))
-
-    scatter_task = asyncio.create_task(
-        plot_scatter(df)) if want_scatter else None
-
-    # Await tasks
-    barplot = await barplot_task
-    density = await density_task
-
-    scatter = await scatter_task if scatter_task else pn.pane.Markdown("""
-                                                                       # To get a scatter plot please select 1 or more genes
-                                                                       Since the scatter plot works extremely slow, you have to select a section of genes to view the start points.
-                                                                       """)
-    print("Plotted!")
-    return [("Barplot", barplot),
-            ("Density plot",density),
-            ("Scatter plot", scatter),]
-
-
-def load_bed_file(config: configparser) -> pl.DataFrame:
-    """Loads a bed file
-
-    Loads the annotated bed file
+    with instr.span("plot_density", rows_in=df.height):
+        curves = []
+        for (group,), part in sorted(df.select(["group_name", "start"]).partition_by(
+                "group_name", as_dict=True).items()):
+            grid, density = binned_kde(part["start"].to_numpy())
+            curves.append(hv.Area({"genomic positions": grid, "density": density},
+                                  kdims="genomic positions", vdims="density", label=group,
+                                  datatype=["dictionary"]))
+        return (hv.Overlay(curves)
+                .opts(hv.opts.Area(alpha=0.5),
+                      hv.opts.Overlay(width=1125, height=600,
+                                      title="Density of methylation positions",
+                                      legend_position="right")))
+
+
+def plot_volcano(df: pl.DataFrame, title: str) -> hvplot.plot:
+    """Plots a volcano plot
+
+    This function will plot the delta fraction against the -log10 p value
+    of a differential methylation result
 
     Parameters
     ----------
-    config : ConfigParser
-            Contains the paths to needed files
+    df : pl.DataFrame
+        differential methylation result
+    title : str
+        title of the plot
 
     Returns
     -------
-    pl.DataFrame
-        Contains the gene promoter information
+    hvplot.scatter
 
     """
-    path = config["PATHS"]["annotated_bed"]
-    try:
-        return pl.read_csv(path, separator=",")
-    except FileNotFoundError:
-        print(f"file: {path} not found or incorrect permissions")
-    return None
+    with instr.span("plot_volcano", rows_in=df.height):
+        df = df.with_columns(
+            (-pl.col("p value").clip(lower_bound=1e-300).log10()).alias("-log10 p"),
+            (pl.col("q value") < 0.05).alias("significant"))
+        return df.hvplot.scatter(x="delta frac", y="-log10 p", by="significant",
+                                 hover_cols=[column for column in ("chr", "start", "gene_name")
+                                             if column in df.columns],
+                                 alpha=0.5, width=1125, height=500, title=title,
+                                 xlabel="delta methylation fraction (B - A)")
 
 
-def filter_chr(chr_list: list[str], df: pl.DataFrame) -> pl.DataFrame:
-    """Filters main df on chr
-
-    Filters the main analysis data based on given chr values
+def sample_table(overview) -> pl.DataFrame:
+    """Puts the coordinates and clusters of the samples in a table
 
     Parameters
     ----------
-    chr_list : list
-            List containing wanted chromosomes
-    df : pl.DataFrame
-            Main analysis data
+    overview : sample_overview.SampleOverview
+        PCA and clusters of the samples
 
     Returns
     -------
     pl.DataFrame
-        main analysis data filtered on wanted chromosomes
+        group_name, cluster and a column for every component
 
     """
-    return (df.filter(pl.col("chr").is_in(chr_list)))
+    return pl.DataFrame({"group_name": list(overview.samples),
+                         "cluster": [str(cluster) for cluster in overview.clusters]}
+                        ).with_columns(pl.Series(f"PC{number + 1}", overview.coordinates[:, number])
+                                       for number in range(overview.coordinates.shape[1]))
 
 
-def filter_group(group_list: list[str], df: pl.DataFrame) -> pl.DataFrame:
-    """Filters main df on group
-
-    Filters the main analysis data based on given group values
+def plot_sample_pca(overview) -> hvplot.plot:
+    """Plots the first two components of the samples, coloured by cluster
 
     Parameters
     ----------
-    chr_list : list
-            List containing wanted groups
-    df : pl.DataFrame
-            Main analysis data
+    overview : sample_overview.SampleOverview
+        PCA and clusters of the samples
 
     Returns
     -------
-    pl.DataFrame
-        main analysis data filtered on wanted groups
+    hvplot.scatter
 
     """
-    return (df.filter(pl.col("group_name").is_in(group_list)))
-
+    with instr.span("plot_sample_pca", rows_in=len(overview.samples)):
+        table = sample_table(overview)
+        second = "PC2" if "PC2" in table.columns else "PC1"
+        labels = [f"{name} ({share:.1%})" for name, share
+                  in zip(("PC1", "PC2"), overview.explained)]
+        return table.hvplot.scatter(x="PC1", y=second, by="cluster", hover_cols=["group_name"],
+                                    size=80, width=1125, height=500,
+                                    title=f"PCA of the samples over {overview.regions} promoter regions",
+                                    xlabel=labels[0], ylabel=labels[-1])
 
-def filter_ranges(min_range: int, max_range: int, df: pl.DataFrame) -> pl.DataFrame:
-    """Filters main df on ranges
 
-    Filters the main analysis data based on given a given start-end range
+def plot_dendrogram(overview) -> hv.Path:
+    """Plots the hierarchical clustering of the samples as a dendrogram
 
     Parameters
     ----------
-    min_range: int
-            min range to filter on
-    max_range: int
-            max range to filter on
-    df : pl.DataFrame
-            Main analysis data
+    overview : sample_overview.SampleOverview
+        PCA and clusters of the samples
 
     Returns
     -------
-    pl.DataFrame
-        main analysis data filtered on range
+    hv.Path
 
     """
-    return (df.filter((pl.col("start") >= min_range) &
-                      (pl.col("end") <= max_range)))
+    tree = scipy.cluster.hierarchy.dendrogram(overview.linkage, no_plot=True,
+                                              labels=list(overview.samples))
+    # Every link is drawn as a path of 4 points, leaves are at 5, 15, 25 ...
+    links = [np.column_stack([x, y]) for x, y in zip(tree["icoord"], tree["dcoord"])]
+    ticks = [(5 + 10 * number, label) for number, label in enumerate(tree["ivl"])]
+    return hv.Path(links).opts(width=1125, height=400, color="black", xticks=ticks,
+                               xrotation=45, xlabel="", ylabel="ward distance",
+                               title="Clustering of the samples")
 
 
-def head_variation(df, n_amount):
-    """returns n gene variation df rows
+def add_notice(plot: hv.core.Dimensioned, notice: str) -> hv.core.Dimensioned:
+    """Adds a notice to the title of a plot
 
     Parameters
     ----------
-    n_amount : int
-            amount of rows to return
-    df : pl.DataFrame
-            gene variation dataframe
+    plot : HoloViews object
+        A plot with a title
+    notice : str
+        Text to add
 
     Returns
     -------
-    pl.DataFrame
-        gene variation with n_amount rows returned
+    HoloViews object
+        The plot with the notice after its title
 
     """
-    if isinstance(df, pl.DataFrame):
-        df = df.head(n=n_amount)
-        return pn.pane.DataFrame(df.to_pandas())
-    return df
+    title = plot.opts.get("plot").kwargs.get("title", "")
+    return plot.opts(title=f"{title} ({notice})")
 
 
-def read_variation_genes(config: configparser):
-    """Reads gene variation file
+async def plot_plots(df: pl.DataFrame, want_scatter: list[str],
+                     binary: bool = False, max_points: int | None = None) -> list[tuple]:
+    """Plots all wanted plots
+
+    This function will plot all wanted plots.
+    When the data has more rows than max_points, the scatter (and the density
+    without binary) is plotted from a sample, and the title says so.
+    The barplot always counts all rows.
 
     Parameters
     ----------
-    config : ConfigParser
-            Contains the paths to needed files
+    df : pl.DataFrame
+        main analysis dataframe
+    want_scatter : list
+        Used a check if the scatterplot should be made
+    binary : bool
+        Use the typed column plots (plot_scatter_binary and plot_density_binary)
+    max_points : int
+        Max amount of points sent to the browser per plot, None for no limit
 
     Returns
     -------
-    pl.DataFrame
-        gene variation dataframe (/data/gene_variation.csv)
+    tuple
+        This tuple contains for everyplot a list with title of the page and the plot
 
     """
-    # Check if file exists, if not return markdown
-    path = config.get("PATHS", "top_genes")
-    if os.path.isfile(path):
-        return pl.read_csv(path).drop_nulls()
-    return pn.pane.Markdown("""
-                            # No gene variation file found
-                            ## Please run the count_best_genes.py script!
-                            ## Or ask web-manager (Ramon) to do so!
-                            """)
+    if df.is_empty():
+        return loading_indicator("Data missing!")
+
+    # Start plotting
+    with instr.span("plot_plots", rows_in=df.height):
+        sample = df
+        notice = None
+        if max_points and df.height > max_points:
+            with instr.span("downsample", rows_in=df.height) as record:
+                sample = downsample(df, max_points)
+                record["rows_out"] = sample.height
+            notice = f"{sample.height:,} of {df.height:,} points, sampled per group"
+
+        barplot_task = asyncio.create_task(plot_barchart(df))
+        # The binary density is binned on the server, so it can use all rows
+        density_task = asyncio.create_task(plot_density_binary(df) if binary
+                                           else plot_density(sample))
+        plot_scatter_task = plot_scatter_binary if binary else plot_scatter
+        scatter_task = asyncio.create_task(
+            plot_scatter_task(sample)) if want_scatter else None
+
+        # Await tasks
+        barplot = await barplot_task
+        density = await density_task
+        if notice and not binary:
+            density = add_notice(density, notice)
+
+        scatter = await scatter_task if scatter_task else pn.pane.Markdown("""
+                                                                           # To get a scatter plot please select 1 or more genes
+                                                                           Since the scatter plot works extremely slow, you have to select a section of genes to view the start points.
+                                                                           """)
+        if notice and scatter_task:
+            scatter = add_notice(scatter, notice)
+    return [("Barplot", barplot),
+            ("Density plot",density),
+            ("Scatter plot", scatter),]
 
 
 def read_info_page(config):
@@ -0,0 +1,1194 @@
+"""
+core.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+The data processing of the website: reading the config and data, the filters,
+the filter spec and the block index.
+Only needs polars, so batch scripts (count_best_genes.py, tiles.py, api.py)
+can use it without loading panel and the plotting libraries.
+backend.py imports everything from here, and adds the caching and the plots.
+
+The data folder can contain the 6 column files of the old pipeline (barcode1_cpg.csv)
+and bedMethyl files of modkit (barcode01.bed, barcode01.bed.gz), gzip or bgzip compressed or not.
+The format is detected from the first line of every file. For bedMethyl only the rows
+of one modification are used, set in the config.ini:
+[DATASET]
+mod_code = m
+
+Not meant to be used on its own
+"""
+
+import os
+import re
+import gzip
+import logging
+import configparser
+from typing import NamedTuple
+import polars as pl
+import instrumentation as instr
+
+logger = logging.getLogger(__name__)
+
+READ_SCHEMA: dict[str, pl.DataType] = {"chr": pl.String, "start": pl.Int64, "end": pl.Int64,
+                                       "frac": pl.Float64, "valid": pl.Int64,
+                                       "group_name": pl.String}
+# Columns of a bedMethyl file that are used, the rest are not parsed
+BEDMETHYL_COLUMNS: dict[str, tuple[int, pl.DataType]] = {
+    "chr": (0, pl.String), "start": (1, pl.Int64), "end": (2, pl.Int64),
+    "mod_code": (3, pl.String), "valid": (9, pl.Int64), "percent": (10, pl.Float64)}
+DATA_SUFFIXES: tuple[str, ...] = (".csv", ".bed", ".bedmethyl")
+COMPRESSED_SUFFIXES: tuple[str, ...] = ("", ".gz", ".bgz")
+
+
+def parse_config() -> configparser:
+    """Reads config file
+
+    This function will read a config file
+    This file contains all of the paths to the data
+    ./data/config.ini
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    configparser.ConfigParser
+                        ConfigParser object that contains config.ini information
+
+    """
+    config = configparser.ConfigParser()
+    config.read("data/config.ini")
+    return config
+
+
+def process_groups(config: configparser) -> pl.DataFrame:
+    """Processes group.csv information
+
+    Will get the group name with barcode information
+    Will also seperate duplicate group names with an index
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+
+    Returns
+    -------
+    pl.DataFrame
+            pl.DataFrame object that contains the group_name and the barcode
+
+    """
+    # Get file for group data
+    path = config.get("PATHS", "group_data")
+
+    try:
+        barcodes_names: pl.dataframe = pl.read_csv(path)
+
+        # Give duplicate names an index to differentiate them
+        barcodes_names = barcodes_names.with_columns(
+            controle_n=pl.int_range(pl.len()).over(" description") + 1)
+        barcodes_names = barcodes_names.with_columns(
+            group_and_n=pl.concat_str([pl.col(' description'), pl.col("controle_n")]))
+
+        # Strip the strings of ecess of characters
+        barcodes_names = barcodes_names.with_columns(pl.col(pl.Utf8).str.strip_chars()
+                                                     ).drop("controle_n")
+
+    # Raising errors
+    except pl.exceptions.ColumnNotFoundError as error:
+        print(
+            f"Header in {path} file not correct, should be: {' description'}\n {error}")
+        raise
+
+    except FileNotFoundError:
+        print(f"file: {path} not found or incorrect permissions")
+        raise
+
+    return barcodes_names
+
+
+def data_file_format(path: str) -> str | None:
+    """Detects the format of a data file from its first line
+
+    Parameters
+    ----------
+    path : str
+            Path to the file, can be gzip or bgzip compressed
+
+    Returns
+    -------
+    str or None
+        "custom" for the 6 column files, "bedmethyl" for bedMethyl files,
+        None when the file is empty or has another format
+
+    """
+    with open(path, "rb") as file:
+        compressed = file.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 11:
+                return "bedmethyl"
+            if len(fields) == 6:
+                return "custom"
+            return None
+    return None
+
+
+def scan_data_file(path: str, file_format: str, mod_code: str = "m") -> pl.LazyFrame:
+    """Scans a data file, only the needed columns are parsed
+
+    Parameters
+    ----------
+    path : str
+            Path to the file
+    file_format : str
+            "custom" or "bedmethyl", from data_file_format
+    mod_code : str
+            Modification to use from a bedMethyl file, m is 5mC
+
+    Returns
+    -------
+    pl.LazyFrame
+        chr, start, end, frac and valid columns
+
+    """
+    if file_format == "custom":
+        return pl.scan_csv(path, separator="\t", has_header=False, schema=READ_SCHEMA).select(
+            # Remove excess characters from chr
+            pl.col("chr").str.split("_").list.get(0), "start", "end", "frac", "valid")
+
+    scan = pl.scan_csv(path, separator="\t", has_header=False, comment_prefix="#",
+                       schema_overrides={f"column_{index + 1}": dtype
+                                         for index, dtype in BEDMETHYL_COLUMNS.values()})
+    return (scan.select(pl.col(f"column_{index + 1}").alias(name)
+                        for name, (index, _dtype) in BEDMETHYL_COLUMNS.items())
+            .filter(pl.col("mod_code") == mod_code)
+            .select("chr", "start", "end", (pl.col("percent") / 100).alias("frac"), "valid"))
+
+
+def shard_chromosomes(config: configparser) -> tuple[str, ...]:
+    """Gets the chromosomes a shard serves, empty when it serves all of them
+
+    Parameters
+    ----------
+    config : ConfigParser
+            chromosomes in the [DATASET] section, comma separated
+
+    Returns
+    -------
+    tuple
+        Sorted chromosome names
+
+    """
+    chromosomes = config.get("DATASET", "chromosomes", fallback="")
+    return tuple(sorted({name.strip() for name in chromosomes.split(",") if name.strip()}))
+
+
+def scan_data(config: configparser) -> list[pl.LazyFrame]:
+    """Scans every data file of the data folder
+
+    A shard (see shard_chromosomes) only reads the rows of its chromosomes.
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+
+    Returns
+    -------
+    list
+        A pl.LazyFrame per file, with the group it belongs to in group_name
+
+    """
+    # Read paths and get the group information
+    path = config.get("PATHS", "data_folder")
+    mod_code = config.get("DATASET", "mod_code", fallback="m")
+    chromosomes = shard_chromosomes(config)
+    barcodes_names = process_groups(config)
+    group_of_barcode: dict[int, str] = dict(zip(barcodes_names["barcode"].cast(pl.Int64),
+                                                barcodes_names["group_and_n"]))
+    suffixes = tuple(suffix + compressed for suffix in DATA_SUFFIXES
+                     for compressed in COMPRESSED_SUFFIXES)
+
+    scans: list[pl.LazyFrame] = []
+    for file in sorted(os.listdir(path)):
+        file_path = os.path.join(path, file)
+        if not os.path.isfile(file_path) or not file.endswith(suffixes):
+            continue
+
+        file_format = data_file_format(file_path)
+        # Figure out with barcode the file has
+        barcode_num: list[str] = re.findall(r"\d+", file)
+        group_name = group_of_barcode.get(int(barcode_num[0])) if barcode_num else None
+        if file_format is None or group_name is None:
+            logger.warning("Skipping %s, unknown format or barcode", file)
+            continue
+
+        # Name the group accoring to the barcode number
+        scan = scan_data_file(file_path, file_format, mod_code).with_columns(
+            pl.lit(group_name).alias("group_name"))
+        scans.append(filter_chr(list(chromosomes), scan) if chromosomes else scan)
+    return scans
+
+
+def read_data(config: configparser) -> pl.DataFrame:
+    """Reads the main analysis data
+
+    This function will read all of the analysis data and process it.
+    The files are scanned lazily and collected together,
+    so polars reads them in parallel.
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+
+    Returns
+    -------
+    pl.Dataframe
+            pl.dataframe that contains all of the methylation data
+            Extra column is added that will link the data to the group it belongs to
+
+    """
+    instr.cache_miss()
+    with instr.span("read_data") as record:
+        scans = scan_data(config)
+        resulting_df = (pl.concat(scans).collect() if scans
+                        else pl.DataFrame(schema=READ_SCHEMA))
+        record["rows_out"] = resulting_df.height
+
+    return resulting_df
+
+
+def count_methylation_data(df: pl.DataFrame) -> pl.DataFrame:
+    """Counts amount of methylation points in df
+
+    This function will count all of the methylation points in a df
+    it will be split on the groups in the df
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+        Dataframe that contains the methylation data
+
+    Returns
+    -------
+    pl.Dataframe
+            pl.DataFrame that will contain the amount of methylated spots for every group
+
+    """
+    # Count it, every group in the df gets a row from the group_by itself
+    return (df
+            .group_by("group_name")
+            .agg([pl.len().alias("n methylations")]))
+
+
+def get_gene_info(annotated_bed: pl.DataFrame, genes: list[str]) -> pl.DataFrame:
+    """Will get gene information
+
+    This function will read all of the analysis data and process it.
+
+    Parameters
+    ----------
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+    genes : list
+            A list containing genes the user wants to see, comes from frontend
+
+    Returns
+    -------
+    pl.Dataframe
+            pl.DataFrame that contains promoter sites for the genes the user specified
+
+    """
+    df_wanted = (annotated_bed
+                 .filter(pl.col("gene_name").is_in(genes)))
+
+    return df_wanted
+
+
+def filter_df_gene(chromosome: str, start: int, end: int, df: pl.DataFrame) -> pl.DataFrame:
+    """Filters the main data on wanted genes
+
+    This function will filter the main data on the genes.
+    These genes are specified in the frontend, by the user.
+
+    Parameters
+    ----------
+    chromosome : str
+        A chromosome name to filter on
+    start : int
+        a starting range to filter on
+    end : int
+        end of the range to filter on
+    df : pl.DataFrame
+        main analysis data
+
+    Returns
+    -------
+    pl.Dataframe
+            main analysis data, filtered on the filters specified above
+
+    """
+    return df.filter(
+        (pl.col("chr") == chromosome) &
+        (pl.col("start") >= start) &
+        (pl.col("end") <= end))
+
+
+def filter_genes(gene_list: list[str], df: pl.DataFrame, annotated_bed: pl.DataFrame) -> pl.DataFrame:
+    """Gets list with genes and filters main df on it
+
+    This function will filter the main analysis data based on a list of given genes.
+
+    Parameters
+    ----------
+    gene_list : list
+            A list containing genes the user wants to see, comes from frontend
+    df : pl.DataFrame
+            Main analysis data
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+
+    Returns
+    -------
+    pl.Dataframe
+            pl.dataframe that contains all of the methylation data
+            Extra column is added that will link the data to the group it belongs to
+
+    """
+    # Get a df that contains gene promoter regions
+    df_wanted = get_gene_info(annotated_bed, gene_list)
+    logger.debug("Filtering on %s promoter regions", df_wanted.height)
+    final_subsetted_df: pl.DataFrame = pl.DataFrame(
+        {"chr": [],
+         "start": [],
+         "end": [],
+         "frac": [],
+         "valid": [],
+         "group_name": [],
+         "gene_name": {}})
+
+    # Loop through genes
+    for row in df_wanted.iter_rows():
+        # Extract promoter regions
+        (chromosome, promoter_start, promoter_end, gene) = row
+        # Filter main data based on thos reagions
+        subsetted_df = filter_df_gene(chromosome, promoter_start, promoter_end, df)
+
+        # Add gene name to the resulting df
+        subsetted_df = subsetted_df.with_columns([
+            pl.lit(gene).alias("gene_name")
+        ])
+        final_subsetted_df = pl.concat([subsetted_df, final_subsetted_df])
+
+    return final_subsetted_df
+
+
+def promoter_regions(annotated_bed: pl.DataFrame) -> pl.DataFrame:
+    """Gets the distinct promoter regions of the annotated bed
+
+    Parameters
+    ----------
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+
+    Returns
+    -------
+    pl.DataFrame
+        chr, start, end, promoter, the name of the region (chr:start-end)
+        as an Enum so it is stored as a small number, and overlaps,
+        if another region overlaps this one. Sorted on chr and start
+
+    """
+    regions = annotated_bed.select(["chr", "start", "end"]).unique().sort(["chr", "start", "end"])
+    names = regions.select(pl.format("{}:{}-{}", "chr", "start", "end")).to_series()
+    return regions.with_columns(
+        names.cast(pl.Enum(names.to_list())).alias("promoter"),
+        ((pl.col("start") < pl.col("end").cum_max().shift().over("chr")).fill_null(False) |
+         (pl.col("start").shift(-1).over("chr") < pl.col("end")).fill_null(False))
+        .alias("overlaps"))
+
+
+def region_genes(annotated_bed: pl.DataFrame, genes: list[str] | None = None) -> pl.DataFrame:
+    """Links the promoter regions to their genes
+
+    Parameters
+    ----------
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+    genes : list
+            Only these genes, all genes when None
+
+    Returns
+    -------
+    pl.DataFrame
+        chr, start, end, gene_name, promoter and overlaps,
+        one row for every row of the annotated bed
+
+    """
+    wanted = annotated_bed if genes is None else get_gene_info(annotated_bed, genes)
+    return wanted.join(promoter_regions(annotated_bed), on=["chr", "start", "end"],
+                       maintain_order="left")
+
+
+def labelled_genes(schema: pl.Schema, annotated_bed: pl.DataFrame,
+                   genes: list[str] | None = None) -> pl.DataFrame | None:
+    """Gets the regions of genes, when data is labelled with the same promoters
+
+    Parameters
+    ----------
+    schema : pl.Schema
+            Schema of the data
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+    genes : list
+            Only these genes, all genes when None
+
+    Returns
+    -------
+    pl.DataFrame or None
+        From region_genes, None when the data has no promoter labels
+        or was labelled with other promoters
+
+    """
+    if "promoter" not in schema:
+        return None
+    regions = region_genes(annotated_bed, genes)
+    return regions if regions["promoter"].dtype == schema["promoter"] else None
+
+
+def annotate_promoters(df: pl.DataFrame, annotated_bed: pl.DataFrame) -> pl.DataFrame:
+    """Labels every CpG with its nearest promoter region
+
+    The regions before and after every CpG are found with two sorted merges
+    (join_asof backward and forward) per chromosome, on the distinct CpGs.
+    Going backward, the region that reaches furthest is used, so a CpG in
+    overlapping regions gets a region that contains it.
+    The distance is 0 when the CpG is inside the region, negative when the CpG is
+    before the region on the chromosome and positive when it is after it.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Main analysis data
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+
+    Returns
+    -------
+    pl.DataFrame
+        df with promoter (Enum, see promoter_regions) and promoter_distance (bp),
+        both null on chromosomes without promoters
+
+    """
+    regions = promoter_regions(annotated_bed)
+    enum = regions["promoter"].dtype
+    sites = df.select(["chr", "start", "end"]).unique().sort(["chr", "start"])
+    if sites.is_empty():
+        return df.with_columns(pl.lit(None, enum).alias("promoter"),
+                               pl.lit(None, pl.Int32).alias("promoter_distance"))
+
+    # The furthest end of the regions that start at or before every region
+    reach = (regions
+             .with_columns(pl.col("end").cum_max().over("chr").alias("reach_end"))
+             .with_columns(pl.when(pl.col("end") == pl.col("reach_end")).then(pl.col("promoter"))
+                           .forward_fill().over("chr").alias("reach_promoter"))
+             .select("chr", "start", "reach_end", "reach_promoter"))
+    before = sites.join_asof(reach, on="start", by="chr", strategy="backward")
+    after = sites.join_asof(regions.select("chr", pl.col("start").alias("after_start"),
+                                           pl.col("promoter").alias("after_promoter")),
+                            left_on="start", right_on="after_start", by="chr",
+                            strategy="forward", allow_exact_matches=False)
+
+    distance_before = pl.max_horizontal(pl.col("end") - pl.col("reach_end"), pl.lit(0))
+    distance_after = pl.col("start") - pl.col("after_start")
+    use_before = (pl.col("reach_promoter").is_not_null() &
+                  (pl.col("after_promoter").is_null() |
+                   (distance_before <= distance_after.abs())))
+    labels = (before
+              .with_columns(after["after_promoter"], after["after_start"])
+              .select("chr", "start", "end",
+                      pl.when(use_before).then(pl.col("reach_promoter"))
+                      .otherwise(pl.col("after_promoter")).alias("promoter"),
+                      pl.when(use_before).then(distance_before)
+                      .otherwise(distance_after).cast(pl.Int32).alias("promoter_distance")))
+    return df.join(labels, on=["chr", "start", "end"], how="left", maintain_order="left")
+
+
+def load_bed_file(config: configparser) -> pl.DataFrame:
+    """Loads a bed file
+
+    Loads the annotated bed file
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+
+    Returns
+    -------
+    pl.DataFrame
+        Contains the gene promoter information
+
+    """
+    path = config["PATHS"]["annotated_bed"]
+    try:
+        return pl.read_csv(path, separator=",")
+    except FileNotFoundError:
+        print(f"file: {path} not found or incorrect permissions")
+    return None
+
+
+def filter_chr(chr_list: list[str], df: pl.DataFrame) -> pl.DataFrame:
+    """Filters main df on chr
+
+    Filters the main analysis data based on given chr values
+
+    Parameters
+    ----------
+    chr_list : list
+            List containing wanted chromosomes
+    df : pl.DataFrame
+            Main analysis data
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on wanted chromosomes
+
+    """
+    return (df.filter(pl.col("chr").is_in(chr_list)))
+
+
+def filter_group(group_list: list[str], df: pl.DataFrame) -> pl.DataFrame:
+    """Filters main df on group
+
+    Filters the main analysis data based on given group values
+
+    Parameters
+    ----------
+    chr_list : list
+            List containing wanted groups
+    df : pl.DataFrame
+            Main analysis data
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on wanted groups
+
+    """
+    return (df.filter(pl.col("group_name").is_in(group_list)))
+
+
+def range_expr(min_range: int, max_range: int) -> pl.Expr:
+    """Creates the expression of a start-end range, a bound of 0 is not set
+
+    Parameters
+    ----------
+    min_range: int
+            min range to filter on, 0 for no lower bound
+    max_range: int
+            max range to filter on, 0 for no upper bound
+
+    Returns
+    -------
+    pl.Expr
+        True for the CpGs inside the range
+
+    """
+    keep = pl.lit(True)
+    if min_range:
+        keep &= pl.col("start") >= min_range
+    if max_range:
+        keep &= pl.col("end") <= max_range
+    return keep
+
+
+def filter_ranges(min_range: int, max_range: int, df: pl.DataFrame) -> pl.DataFrame:
+    """Filters main df on ranges
+
+    Filters the main analysis data based on given a given start-end range.
+    A bound of 0 is not set, the same as in the block index and the tiles
+
+    Parameters
+    ----------
+    min_range: int
+            min range to filter on, 0 for no lower bound
+    max_range: int
+            max range to filter on, 0 for no upper bound
+    df : pl.DataFrame
+            Main analysis data
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on range
+
+    """
+    return df.filter(range_expr(min_range, max_range))
+
+
+class FilterSpec(NamedTuple):
+    """Canonical description of the filters a user picked
+
+    Two selections that filter the same data get the same spec,
+    so it can be used as a cache key.
+    """
+    chromosomes: tuple[str, ...] = ()
+    groups: tuple[str, ...] = ()
+    min_range: int = 0
+    max_range: int = 0
+    genes: tuple[str, ...] = ()
+    min_coverage: int = 0
+    frac_range: tuple[float, float] | None = None
+
+
+def make_filter_spec(chr_select: list[str], group_select: list[str],
+                     min_range: int, max_range: int, gene_list: list[str],
+                     min_coverage: int = 0,
+                     frac_range: tuple[float, float] | None = None) -> FilterSpec:
+    """Creates a filter spec from the values of the widgets
+
+    Parameters
+    ----------
+    chr_select : list
+            Wanted chromosomes
+    group_select : list
+            Wanted groups
+    min_range : int
+            Lowest start position
+    max_range : int
+            Highest end position
+    gene_list : list
+            Wanted genes
+    min_coverage : int
+            Lowest amount of valid reads
+    frac_range : tuple
+            Lowest and highest methylation fraction, None for no filter
+
+    Returns
+    -------
+    FilterSpec
+        Sorted and deduplicated version of the filters
+
+    """
+    return FilterSpec(chromosomes=tuple(sorted(set(chr_select or ()))),
+                      groups=tuple(sorted(set(group_select or ()))),
+                      min_range=int(min_range or 0),
+                      max_range=int(max_range or 0),
+                      genes=tuple(sorted(set(gene_list or ()))),
+                      min_coverage=int(min_coverage or 0),
+                      frac_range=None if frac_range is None
+                      else (float(frac_range[0]), float(frac_range[1])))
+
+
+def filter_coverage(min_coverage: int, df: pl.DataFrame) -> pl.DataFrame:
+    """Filters main df on coverage
+
+    Drops CpGs that are covered by less reads than min_coverage
+
+    Parameters
+    ----------
+    min_coverage : int
+            lowest amount of valid reads a CpG needs
+    df : pl.DataFrame
+            Main analysis data
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on coverage
+
+    """
+    return df.filter(pl.col("valid") >= min_coverage)
+
+
+def filter_frac(min_frac: float, max_frac: float, df: pl.DataFrame) -> pl.DataFrame:
+    """Filters main df on methylation fraction
+
+    Parameters
+    ----------
+    min_frac : float
+            lowest fraction to keep
+    max_frac : float
+            highest fraction to keep
+    df : pl.DataFrame
+            Main analysis data
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on methylation fraction
+
+    """
+    return df.filter(pl.col("frac").is_between(min_frac, max_frac))
+
+
+def build_block_index(df: pl.DataFrame, block_size: int = 65536) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Splits the main df into blocks and stores statistics for every block
+
+    The data is sorted on chr, group and start, so every block is a contiguous slice.
+    For every block the min and max of the columns is stored,
+    so filters can skip blocks that can not match without looking at the rows.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Main analysis data
+    block_size : int
+            Max amount of rows in a block
+
+    Returns
+    -------
+    tuple
+        The sorted main data and the block index
+        (chr, group_name, offset, length and min/max of start, end, frac and valid)
+
+    """
+    df = df.sort(["chr", "group_name", "start"]).rechunk()
+    block_index = (df
+                   .lazy()
+                   .with_row_index("offset")
+                   .with_columns(
+                       (pl.int_range(pl.len()).over(["chr", "group_name"]) // block_size)
+                       .alias("block"))
+                   .group_by(["chr", "group_name", "block"], maintain_order=True)
+                   .agg(pl.col("offset").first(),
+                        pl.len().alias("length"),
+                        pl.col("start").min().alias("start_min"),
+                        pl.col("start").max().alias("start_max"),
+                        pl.col("end").min().alias("end_min"),
+                        pl.col("end").max().alias("end_max"),
+                        pl.col("frac").min().alias("frac_min"),
+                        pl.col("frac").max().alias("frac_max"),
+                        pl.col("valid").min().alias("valid_min"),
+                        pl.col("valid").max().alias("valid_max"))
+                   .drop("block")
+                   .collect())
+    return df, block_index
+
+
+def write_region_store(config: configparser, folder: str,
+                       block_size: int = 65536) -> pl.DataFrame:
+    """Writes every data file as a sorted Parquet file, and indexes the blocks of the files
+
+    One file is in memory at a time, so the data can be larger than the memory.
+    The CpGs are labelled with their nearest promoter (see annotate_promoters).
+    The block index points into the files (path and offset), so a query
+    only reads the row groups of the blocks that can match.
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+    folder : str
+            Folder to write the Parquet files to
+    block_size : int
+            Max amount of rows in a block, also the row group size
+
+    Returns
+    -------
+    pl.DataFrame
+        Block index of all files, with the path of the file of every block
+
+    """
+    os.makedirs(folder, exist_ok=True)
+    annotated_bed = load_bed_file(config)
+    block_indexes = [build_block_index(pl.DataFrame(schema=READ_SCHEMA))[1]
+                     .with_columns(pl.lit(None, pl.String).alias("path"))]
+    with instr.span("write_region_store") as record:
+        for number, scan in enumerate(scan_data(config)):
+            path = os.path.join(folder, f"part_{number}.parquet")
+            df, block_index = build_block_index(annotate_promoters(scan.collect(), annotated_bed),
+                                                block_size)
+            df.write_parquet(path, compression="zstd", row_group_size=block_size,
+                             statistics=True)
+            block_indexes.append(block_index.with_columns(pl.lit(path).alias("path")))
+        block_index = pl.concat(block_indexes).sort(["chr", "group_name", "offset"],
+                                                    maintain_order=True)
+        record["rows_out"] = int(block_index["length"].sum())
+    return block_index
+
+
+def scan_store_blocks(blocks: pl.DataFrame) -> pl.LazyFrame:
+    """Plans the reading of blocks from the Parquet files of a region store
+
+    Every file is scanned once, from its first to its last wanted block,
+    so only those row groups are decompressed. The rows between the blocks
+    are dropped on their row number.
+    It is a plain scan and not a python function in the plan (map_batches),
+    a polars query inside a plan waits on the threads that the plan holds.
+
+    Parameters
+    ----------
+    blocks : pl.DataFrame
+            Rows of a block index made by write_region_store
+
+    Returns
+    -------
+    pl.LazyFrame
+        Plan of the rows of the blocks, sorted on chr and group_name
+
+    """
+    parts = []
+    for (path,), file_blocks in blocks.group_by("path", maintain_order=True):
+        starts, ends = file_blocks["offset"], file_blocks["offset"] + file_blocks["length"]
+        rows = pl.int_ranges(starts, ends, dtype=pl.UInt32).explode()
+        parts.append(pl.scan_parquet(path, row_index_name="row")
+                     .slice(starts.min(), ends.max() - starts.min())
+                     .filter(pl.col("row").is_in(rows.implode()))
+                     .drop("row"))
+    # Sorted on chr and group like the block index, a file holds one group
+    return pl.concat(parts, rechunk=False).sort(["chr", "group_name"], maintain_order=True)
+
+
+def store_schema(block_index: pl.DataFrame) -> pl.Schema:
+    """Gets the schema of the Parquet files of a region store
+
+    The files have the promoter columns of annotate_promoters,
+    so empty selections need this schema instead of READ_SCHEMA.
+
+    Parameters
+    ----------
+    block_index : pl.DataFrame
+            Block index made by write_region_store
+
+    Returns
+    -------
+    pl.Schema
+        Schema of the first file, READ_SCHEMA when the store has no files
+
+    """
+    paths = block_index["path"].drop_nulls()
+    if paths.is_empty():
+        return pl.Schema(READ_SCHEMA)
+    return pl.scan_parquet(paths[0]).collect_schema()
+
+
+def data_bounds(block_index: pl.DataFrame) -> dict:
+    """Gets the chromosomes, groups and highest values of the data
+
+    Uses only the block index, so it works without the data in memory.
+
+    Parameters
+    ----------
+    block_index : pl.DataFrame
+            Block index made by build_block_index or write_region_store
+
+    Returns
+    -------
+    dict
+        rows, chromosomes, groups and the highest start, end, valid and frac
+
+    """
+    return {"rows": int(block_index["length"].sum()),
+            "chromosomes": block_index["chr"].unique().sort().to_list(),
+            "groups": block_index["group_name"].unique().sort().to_list(),
+            "start_max": block_index["start_max"].max() or 0,
+            "end_max": block_index["end_max"].max() or 0,
+            "valid_max": block_index["valid_max"].max() or 0,
+            "frac_max": block_index["frac_max"].max() or 0}
+
+
+def select_blocks(block_index: pl.DataFrame, spec: FilterSpec) -> pl.DataFrame:
+    """Selects the blocks that can contain rows for a filter spec
+
+    Only uses the block statistics, the data itself is not touched.
+    The range is used as a lower bound on start and upper bound on end,
+    the exact range filter still has to be done on the rows.
+
+    Parameters
+    ----------
+    block_index : pl.DataFrame
+            Block index made by build_block_index
+    spec : FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    pl.DataFrame
+        The rows of the block index that can match
+
+    """
+    keep = pl.lit(True)
+    if spec.chromosomes:
+        keep &= pl.col("chr").is_in(spec.chromosomes)
+    if spec.groups:
+        keep &= pl.col("group_name").is_in(spec.groups)
+    if spec.min_range:
+        keep &= pl.col("start_max") >= spec.min_range
+    if spec.max_range:
+        keep &= pl.col("end_min") <= spec.max_range
+    if spec.min_coverage:
+        keep &= pl.col("valid_max") >= spec.min_coverage
+    if spec.frac_range is not None:
+        keep &= ((pl.col("frac_max") >= spec.frac_range[0]) &
+                 (pl.col("frac_min") <= spec.frac_range[1]))
+    return block_index.filter(keep)
+
+
+def estimate_rows(block_index: pl.DataFrame, spec: FilterSpec) -> int:
+    """Estimates the amount of rows a filter spec touches
+
+    Uses only the block index, so it is cheap enough to run before every query.
+
+    Parameters
+    ----------
+    block_index : pl.DataFrame
+            Block index made by build_block_index
+    spec : FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    int
+        Amount of rows in the blocks that can match
+
+    """
+    return int(select_blocks(block_index, spec)["length"].sum())
+
+
+def block_plan(df: pl.DataFrame | None, block_index: pl.DataFrame,
+               spec: FilterSpec) -> pl.LazyFrame:
+    """Plans the chr, group, coverage and fraction filters using the block index
+
+    Blocks that can not match are skipped, the others are sliced out of the
+    main data (no copy), or read from the region store when the plan is collected.
+    Nothing is filtered until the plan is collected, so keeping a plan
+    only keeps the shared main data alive.
+
+    Parameters
+    ----------
+    df : pl.DataFrame or None
+            Main analysis data, sorted by build_block_index,
+            None when the block index points into a region store
+    block_index : pl.DataFrame
+            Block index made by build_block_index
+    spec : FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    pl.LazyFrame
+        Plan of the main analysis data filtered on chr, group, coverage and fraction
+
+    """
+    blocks = select_blocks(block_index, spec)
+    if blocks.is_empty():
+        return pl.LazyFrame(schema=store_schema(block_index)) if df is None else df.clear().lazy()
+    if df is None:
+        selected = scan_store_blocks(blocks)
+    elif blocks.height == block_index.height:
+        selected = df.lazy()
+    else:
+        selected = pl.concat([df.slice(offset, length) for offset, length
+                              in blocks.select(["offset", "length"]).iter_rows()],
+                             rechunk=False).lazy()
+
+    if spec.chromosomes:
+        selected = filter_chr(list(spec.chromosomes), selected)
+    if spec.groups:
+        selected = filter_group(list(spec.groups), selected)
+    if spec.min_coverage:
+        selected = filter_coverage(spec.min_coverage, selected)
+    if spec.frac_range is not None:
+        selected = filter_frac(spec.frac_range[0], spec.frac_range[1], selected)
+    return selected
+
+
+def scan_blocks(df: pl.DataFrame | None, block_index: pl.DataFrame,
+                spec: FilterSpec) -> pl.DataFrame:
+    """Filters main df on chr, group, coverage and fraction using the block index
+
+    Parameters
+    ----------
+    df : pl.DataFrame or None
+            Main analysis data, sorted by build_block_index,
+            None when the block index points into a region store
+    block_index : pl.DataFrame
+            Block index made by build_block_index
+    spec : FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on chr, group, coverage and fraction
+
+    """
+    return block_plan(df, block_index, spec).collect()
+
+
+def gene_plan(gene_list: list[str], plan: pl.LazyFrame,
+              annotated_bed: pl.DataFrame) -> pl.LazyFrame:
+    """Lazy version of filter_genes
+
+    Parameters
+    ----------
+    gene_list : list
+            A list containing genes the user wants to see
+    plan : pl.LazyFrame
+            Plan of the main analysis data
+    annotated_bed : pl.DataFrame
+            Contains promoter sites of (mostly) all human genes
+
+    Returns
+    -------
+    pl.LazyFrame
+        Plan of the CpGs in the promoters, with the gene_name added
+
+    """
+    genes = labelled_genes(plan.collect_schema(), annotated_bed, gene_list)
+    if genes is not None:
+        return annotated_gene_plan(genes, plan)
+
+    promoters = get_gene_info(annotated_bed, gene_list)
+    logger.debug("Filtering on %s promoter regions", promoters.height)
+    if promoters.is_empty():
+        return plan.clear().with_columns(pl.lit(None, dtype=pl.String).alias("gene_name"))
+    # Last promoter first, the same order as filter_genes
+    return pl.concat([filter_df_gene(chromosome, promoter_start, promoter_end, plan)
+                      .with_columns(pl.lit(gene).alias("gene_name"))
+                      for chromosome, promoter_start, promoter_end, gene
+                      in reversed(promoters.rows())])
+
+
+def annotated_gene_plan(genes: pl.DataFrame, plan: pl.LazyFrame) -> pl.LazyFrame:
+    """Plans the gene filter on data labelled by annotate_promoters
+
+    A CpG inside a region that no other region overlaps is labelled with that region,
+    so those CpGs are found on their label. The few overlapping regions use their range.
+
+    Parameters
+    ----------
+    genes : pl.DataFrame
+            The regions of the wanted genes, from region_genes
+    plan : pl.LazyFrame
+            Plan of the main analysis data, with the promoter columns
+
+    Returns
+    -------
+    pl.LazyFrame
+        Plan of the CpGs in the promoters, with the gene_name added
+
+    """
+    labelled = genes.filter(~pl.col("overlaps")).select(["promoter", "gene_name"])
+    parts = [plan
+             .filter((pl.col("promoter_distance") == 0) &
+                     pl.col("promoter").is_in(labelled["promoter"].unique()))
+             .join(labelled.lazy(), on="promoter")]
+    parts += [filter_df_gene(chromosome, promoter_start, promoter_end, plan)
+              .with_columns(pl.lit(gene).alias("gene_name"))
+              for chromosome, promoter_start, promoter_end, gene
+              in genes.filter(pl.col("overlaps"))
+              .select(["chr", "start", "end", "gene_name"]).rows()]
+    return pl.concat(parts)
+
+
+def filter_plan(df: pl.DataFrame | None, block_index: pl.DataFrame,
+                annotated_bed: pl.DataFrame, spec: FilterSpec) -> pl.LazyFrame:
+    """Plans every filter of a filter spec, without filtering anything yet
+
+    Chromosome, group, coverage and fraction use the block index,
+    then the genes and the range are filtered.
+    The plan only refers to the shared main data, so it is cheap to keep
+    and every session can collect (or aggregate) it when it needs the rows.
+
+    Parameters
+    ----------
+    df : pl.DataFrame or None
+            Main analysis data, sorted by build_block_index,
+            None when the block index points into a region store
+    block_index : pl.DataFrame
+            Block index made by build_block_index or write_region_store
+    annotated_bed : pl.DataFrame
+            Promoter regions, used for the genes
+    spec : FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    pl.LazyFrame
+        Plan of the main analysis data filtered on the spec
+
+    """
+    plan = block_plan(df, block_index, spec)
+    if spec.genes:
+        plan = gene_plan(list(spec.genes), plan, annotated_bed)
+    if spec.min_range or spec.max_range:
+        plan = filter_ranges(spec.min_range, spec.max_range, plan)
+    return plan
+
+
+def apply_filter_spec(df: pl.DataFrame | None, block_index: pl.DataFrame,
+                      annotated_bed: pl.DataFrame, spec: FilterSpec) -> pl.DataFrame:
+    """Applies every filter of a filter spec
+
+    Parameters
+    ----------
+    df : pl.DataFrame or None
+            Main analysis data, sorted by build_block_index,
+            None when the block index points into a region store
+    block_index : pl.DataFrame
+            Block index made by build_block_index or write_region_store
+    annotated_bed : pl.DataFrame
+            Promoter regions, used for the genes
+    spec : FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    pl.DataFrame
+        main analysis data filtered on the spec
+
+    """
+    total_rows = int(block_index["length"].sum())
+    with instr.span("update_df", rows_in=total_rows) as record:
+        df = filter_plan(df, block_index, annotated_bed, spec).collect()
+        record["rows_out"] = df.height
+    return df
+
+
+def downsample(df: pl.DataFrame, max_points: int, seed: int = 0) -> pl.DataFrame:
+    """Takes a random sample of at most max_points rows, stratified per group
+
+    The points are divided evenly over the groups, groups smaller than
+    their share keep all of their points and the rest goes to the larger groups.
+    So small groups stay visible next to large ones.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+        main analysis dataframe
+    max_points : int
+        Max amount of rows to keep
+    seed : int
+        Seed of the sample, the same data gives the same sample
+
+    Returns
+    -------
+    pl.DataFrame
+        The sampled rows, in their original order
+
+    """
+    if df.height <= max_points:
+        return df
+    sizes = df.group_by("group_name").len().sort("len")
+    quotas = {}
+    remaining = max_points
+    for groups_left, (group, size) in zip(range(sizes.height, 0, -1), sizes.iter_rows()):
+        quotas[group] = min(size, remaining // groups_left)
+        remaining -= quotas[group]
+    return df.filter(pl.int_range(pl.len()).shuffle(seed).over("group_name") <
+                     pl.col("group_name").replace_strict(quotas, return_dtype=pl.UInt32))
+
@@ -5,154 +5,74 @@ Version: 1.0
 Year: BFV2
 
 Usage:
-This script will create a csv file that contains the std of the normalized positions of all methylation points
+This script will create a csv file with every metric of the gene ranking (see gene_ranking.py)
+for all genes, sorted on a metric (position spread by default).
+The website ranks the genes itself, this file is for use outside of the website.
+It is written to top_genes in the [PATHS] of the config.ini.
 
 run:
 python3 count_best_genes.py
+python3 count_best_genes.py "mean frac"
 """
 
-import backend as be
+import sys
+import core
+import gene_ranking as gr
 import polars as pl
 
 
-def get_top_x_genes(gene_df: pl.DataFrame, df: pl.DataFrame):
-    """Get all the methylation data for every gene
-
-    This function gets all of the methylated points for every gene
+def rank_genes(df: pl.DataFrame, annotated_bed: pl.DataFrame,
+               metric: str = "position spread") -> pl.DataFrame:
+    """Computes the metrics of every gene
 
     Parameters
     ----------
-    gene_df: pl.DataFrame
-            Contains the promoter region information for all genes
     df: pl.DataFrame
-            Contains the main analysis data
+        Contains the main analysis data
+    annotated_bed: pl.DataFrame
+        Contains the promoter region information for all genes
+    metric: str
+        One of gene_ranking.METRICS, to sort on
 
     Returns
     -------
     pl.DataFrame
-        Containing all of the methylated points, with the fitting gene
+        gene name, chromosome and every metric, sorted descending on the metric
 
     """
-    df_count_groups_list = []
-    dict_start_end = {}
-
-    # Loop through the gene promoter region lines
-    for gene_info in gene_df.iter_rows():
-
-        # Get the info and add it to a dict if it is not in it
-        chr, start, end, _ = gene_info
-        if chr not in dict_start_end:
-            dict_start_end[chr] = []
-
-        # Only continue if these ranges have not been done yet
-        if [start, end] in dict_start_end[chr]:
-            continue
-        
-        # Get all genes in this range
-        gene_df_filtered = be.filter_chr([chr], gene_df)
-        gene_df_filtered = be.filter_ranges(start, end, gene_df_filtered)
-        gene_list = pl.Series(gene_df_filtered.select("gene_name")).to_list()
-
-        # Filter main data for these genes
-        new_df = be.filter_df_gene(chr, start, end, df)
-        # Add all the gene names to this
-        for gene in gene_list:
-            counted_df_annot = new_df.with_columns([
-                pl.lit(gene).alias("gene")
-            ])
-            df_count_groups_list.append(counted_df_annot)
+    ranking = gr.build_gene_ranking([gr.gene_sums(df, annotated_bed)])
+    return gr.top_genes(ranking, metric, k=ranking.genes.height)
 
-        # Add range to dict
-        # Only do this range once
-        dict_start_end[chr].append([start, end])
 
-    df_count_groups = pl.concat(df_count_groups_list)
-    return df_count_groups
-
-
-def calc_std(df: pl.DataFrame):
-    """calculates the std
-
-    Calculate the normalized standard deviation on position
-    To get position variation in genes
+def write_to_csv(df: pl.DataFrame, path: str):
+    """Writes the ranked genes to csv.
 
     Parameters
     ----------
     df: pl.DataFrame
-        df that contains all of the methylation points,
-        labeled with the genes and group it belongs to
-
-    Returns
-    -------
-    pl.DataFrame
-        df that contains the gene name and std based on normalized position
-
-    """
-    # Calc normalized position
-    lowest_pos = df.select("start").min().item()
-    highest_pos = df.select("start").max().item()
-    df = df.with_columns(
-        ((pl.col("start") - lowest_pos) / (highest_pos - lowest_pos)).alias("norm pos"))
-
-    # Calculate std for every gene
-    std_methylations = df.group_by(["gene"]).agg(
-        pl.col("norm pos").std().alias("Methylation variation")
-    )
-
-    return std_methylations
-
-
-def sort_df(df: pl.DataFrame):
-    """Sorts df
-
-    Sorts df, based on std. Descending
-
-    Parameters
-    ----------
-    df: pl.DataFrame
-        df that contains the gene name and std based on normalized position
-
-    Returns
-    -------
-    pl.DataFrame
-        df that contains the gene name and std based on normalized position, sorted
-
-    """
-    return df.sort(by="Methylation variation", descending=True)
-
-
-def write_to_csv(df: pl.DataFrame):
-    """Writes sorted std_df to csv.
-
-    Parameters
-    ----------
-    df: pl.DataFrame
-        df that contains the gene name and std based on normalized position, sorted
+        the ranked genes
+    path: str
+        Path of the csv file
 
     Returns
     -------
     None
 
     """
-    
-    df.write_csv("/homes/rreilman/jaar2/kwartaal2/dashboard/app_methylation/data/gene_variation.csv")
+    df.write_csv(path)
 
 
 def main():
     """Main"""
-    
-    # Reads data
-    config = be.parse_config()
-    main = be.read_data(config)
-    annotated = be.load_bed_file(config)
+    metric = sys.argv[1] if len(sys.argv) > 1 else "position spread"
 
-    # Gets all genes and methylation points
-    counted = get_top_x_genes(annotated, main)
+    # Reads data
+    config = core.parse_config()
+    main_data = core.read_data(config)
+    annotated = core.load_bed_file(config)
 
-    # Calculate, sort and write
-    std_df = calc_std(counted)
-    std_df = sort_df(std_df)
-    write_to_csv(std_df)
+    # Rank and write
+    write_to_csv(rank_genes(main_data, annotated, metric), config.get("PATHS", "top_genes"))
 
 
 if __name__ == "__main__":
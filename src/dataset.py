@@ -0,0 +1,558 @@
+"""
+dataset.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Loads the data of the website once per worker process, and shares it between workers.
+The data is read, labelled with the nearest promoters (see core.annotate_promoters),
+sorted and indexed once (by serve.py, or by the first worker that needs it)
+and written as an uncompressed Arrow snapshot, in /dev/shm by default.
+Workers memory map the snapshot, so all workers use the same copy of the data
+through the page cache instead of reading and sorting it again.
+The snapshot remembers the size and modification time of the files it was made from,
+a snapshot of older files is not used. Every snapshot is written to a folder of its own,
+the manifest points to the newest one, so a worker never maps tables of two snapshots.
+
+The data folder and annotated bed are watched. When they change (and stay the same
+for one more check, so files that are still being copied are not read),
+the new data is built in the background and swapped in for new sessions.
+Every version of the data has a generation, caches put it in their keys
+so results of older data are never shown for the new data.
+
+With backend = indexed the data is not kept in memory at all. Every data file is
+written sorted to a Parquet file in the region store (on disk), and only the block index
+is in the snapshot. Queries read the blocks they need from the files (see core.scan_blocks),
+so the data can be larger than the memory of a worker.
+
+With the memory backend the snapshot also holds the site matrix (see site_matrix.py),
+the CpGs aligned over the groups, for the comparisons between groups.
+With both backends it holds the gene ranking and the same statistics
+of every promoter region (see gene_ranking.py).
+
+A shard (see router.py) only loads the chromosomes in its config, its snapshot
+and region store folders get a suffix, so several shards can run on one host.
+
+Settings go in the config.ini:
+[PATHS]
+snapshot_folder = /dev/shm/methylation
+region_store = path/to/region_store
+
+[DATASET]
+# seconds between checks for new data, 0 to turn it off
+reload_interval = 60
+# memory or indexed
+backend = memory
+# also make the site matrix, with the memory backend
+site_matrix = true
+# only these chromosomes, for a shard, all when left out
+chromosomes = chr1,chr2
+
+run (make the snapshot):
+python3 src/dataset.py
+"""
+
+import os
+import json
+import time
+import shutil
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+import configparser
+import polars as pl
+import core
+import site_matrix as sm
+import gene_ranking as gr
+import instrumentation as instr
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION: int = 8
+SNAPSHOT_TABLES: tuple[str, ...] = ("main_data", "block_index", "annotated_bed")
+
+_managers: dict[str, "DatasetManager"] = {}
+_managers_lock = threading.Lock()
+
+
+def snapshot_folder(config: configparser.ConfigParser) -> str:
+    """Gets the folder of the snapshot
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Can contain the snapshot_folder
+
+    Returns
+    -------
+    str
+        The configured folder, or a folder in /dev/shm (or the temp folder)
+
+    """
+    if config.has_option("PATHS", "snapshot_folder"):
+        folder = config.get("PATHS", "snapshot_folder")
+    else:
+        shared = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        folder = os.path.join(shared, "methylation")
+    return folder + shard_suffix(config)
+
+
+def shard_suffix(config: configparser.ConfigParser) -> str:
+    """Gets the suffix of the folders of a shard, so shards on one host do not share them
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Can contain the chromosomes of the shard (see core.shard_chromosomes)
+
+    Returns
+    -------
+    str
+        Empty when the data is not sharded, -shard- and a short hash of the chromosomes otherwise
+
+    """
+    chromosomes = core.shard_chromosomes(config)
+    if not chromosomes:
+        return ""
+    return "-shard-" + hashlib.sha1(",".join(chromosomes).encode()).hexdigest()[:8]
+
+
+def dataset_backend(config: configparser.ConfigParser) -> str:
+    """Gets where the data is kept, memory or indexed (the region store)"""
+    return config.get("DATASET", "backend", fallback="memory")
+
+
+def region_store_folder(config: configparser.ConfigParser) -> str:
+    """Gets the folder of the region store, it holds a folder per generation"""
+    return config.get("PATHS", "region_store",
+                      fallback=os.path.join(tempfile.gettempdir(),
+                                            "methylation_store")) + shard_suffix(config)
+
+
+def pin_generation(folder: str):
+    """Pins a generation folder, so remove_old_stores leaves it alone
+
+    The pin is a shared lock on a file in the folder, so it holds for every
+    worker process. It is released when the returned file is closed,
+    or garbage collected together with the data that uses the folder.
+
+    Parameters
+    ----------
+    folder : str
+            Folder of a generation of the region store
+
+    Returns
+    -------
+    file
+        The open pin file
+    """
+    os.makedirs(folder, exist_ok=True)
+    pin = open(os.path.join(folder, ".pin"), mode="a",  # pylint: disable=consider-using-with
+               encoding="utf-8")
+    fcntl.flock(pin, fcntl.LOCK_SH)
+    return pin
+
+
+def is_pinned(folder: str) -> bool:
+    """Checks if a worker still uses a generation folder, see pin_generation"""
+    try:
+        with open(os.path.join(folder, ".pin"), encoding="utf-8") as pin:
+            fcntl.flock(pin, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+def remove_old_stores(folder: str, keep: int = 2) -> None:
+    """Removes all but the newest generations of the region store, or of the snapshot
+
+    Older generations that a worker still uses (see pin_generation) are kept,
+    sessions that started before a reload keep reading their generation.
+    They are removed by a later reload, after those sessions are closed.
+
+    Parameters
+    ----------
+    folder : str
+            Folder of the region store or the snapshot
+    keep : int
+            Amount of generations to keep
+    """
+    generations = sorted((entry for entry in os.scandir(folder) if entry.is_dir()),
+                         key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    for entry in generations[keep:]:
+        if not is_pinned(entry.path):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def source_stamp(config: configparser.ConfigParser) -> dict[str, list[int]]:
+    """Gets the size and modification time of every file the data is made from
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+
+    Returns
+    -------
+    dict
+        path as key, [size, modification time in ns] as value
+
+    """
+    folder = config.get("PATHS", "data_folder")
+    paths = [os.path.join(folder, file) for file in sorted(os.listdir(folder))]
+    paths += [config.get("PATHS", "annotated_bed"), config.get("PATHS", "group_data")]
+    stamp = {}
+    for path in paths:
+        if os.path.isfile(path):
+            status = os.stat(path)
+            stamp[path] = [status.st_size, status.st_mtime_ns]
+    return stamp
+
+
+def generation_of(stamp: dict[str, list[int]]) -> str:
+    """Gets the generation of a version of the data
+
+    The same files give the same generation in every worker.
+
+    Parameters
+    ----------
+    stamp : dict
+            From source_stamp
+
+    Returns
+    -------
+    str
+        Short hash of the stamp
+
+    """
+    return hashlib.sha1(json.dumps(stamp, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def build_dataset(config: configparser.ConfigParser,
+                  stamp: dict[str, list[int]] | None = None) -> dict:
+    """Reads, sorts and indexes the data
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+    stamp : dict
+            Stamp of the files, from source_stamp, names the folder in the region store.
+            Taken now when not given
+
+    Returns
+    -------
+    dict
+        main_data (sorted, None with the indexed backend), block_index, annotated_bed,
+        site_matrix (None when it is turned off or with the indexed backend),
+        gene_ranking and region_ranking
+
+    """
+    matrix = None
+    annotated_bed = core.load_bed_file(config)
+    regions = gr.region_bed(annotated_bed)
+    with instr.span("build_dataset") as record:
+        if dataset_backend(config) == "indexed":
+            stamp = source_stamp(config) if stamp is None else stamp
+            store = region_store_folder(config)
+            main_data = None
+            block_index = core.write_region_store(config, os.path.join(store, generation_of(stamp)))
+            remove_old_stores(store)
+            # One file of the store at a time, the sums are added up
+            sums, region_sums = [], []
+            for path in block_index["path"].unique(maintain_order=True):
+                part = pl.read_parquet(path)
+                sums.append(gr.gene_sums(part, annotated_bed))
+                region_sums.append(gr.gene_sums(part, regions))
+        else:
+            main_data, block_index = core.build_block_index(
+                core.annotate_promoters(core.read_data(config), annotated_bed))
+            if config.getboolean("DATASET", "site_matrix", fallback=True):
+                matrix = sm.build_site_matrix(main_data)
+            sums = [gr.gene_sums(main_data, annotated_bed)]
+            region_sums = [gr.gene_sums(main_data, regions)]
+        ranking = gr.build_gene_ranking(sums)
+        region_ranking = gr.build_gene_ranking(region_sums)
+        record["rows_out"] = int(block_index["length"].sum())
+    return {"main_data": main_data, "block_index": block_index,
+            "annotated_bed": annotated_bed, "site_matrix": matrix, "gene_ranking": ranking,
+            "region_ranking": region_ranking}
+
+
+def write_snapshot(dataset: dict, config: configparser.ConfigParser,
+                   stamp: dict[str, list[int]] | None = None) -> str:
+    """Writes the data as an uncompressed Arrow snapshot
+
+    The tables go to a new folder in the snapshot folder, then the manifest
+    is written next to its final name and renamed, so workers never see half a snapshot
+    or tables of two snapshots. Workers that still use an older snapshot keep their
+    memory map of the old files, only the newest two snapshot folders are kept.
+
+    Parameters
+    ----------
+    dataset : dict
+            The data, from build_dataset
+    config : ConfigParser
+            Contains the paths to needed files and the snapshot folder
+    stamp : dict
+            Stamp of the files the data was read from, from source_stamp.
+            Taken now when not given
+
+    Returns
+    -------
+    str
+        The snapshot folder
+
+    """
+    folder = snapshot_folder(config)
+    os.makedirs(folder, exist_ok=True)
+    stamp = source_stamp(config) if stamp is None else stamp
+    tables_folder = tempfile.mkdtemp(prefix=f"{generation_of(stamp)}-", dir=folder)
+    tables = [table for table in SNAPSHOT_TABLES if dataset[table] is not None]
+    for table in tables:
+        dataset[table].write_ipc(os.path.join(tables_folder, f"{table}.arrow"),
+                                 compression="uncompressed")
+    if dataset.get("site_matrix") is not None:
+        sm.write_site_matrix(dataset["site_matrix"], os.path.join(tables_folder, "site_matrix"))
+        tables.append("site_matrix")
+    for ranking in ("gene_ranking", "region_ranking"):
+        gr.write_gene_ranking(dataset[ranking], os.path.join(tables_folder, ranking))
+        tables.append(ranking)
+
+    manifest = os.path.join(folder, "manifest.json")
+    with open(f"{manifest}.{os.getpid()}", mode="w", encoding="utf-8") as manifest_file:
+        json.dump({"version": SNAPSHOT_VERSION, "backend": dataset_backend(config),
+                   "folder": os.path.basename(tables_folder),
+                   "chromosomes": list(core.shard_chromosomes(config)),
+                   "tables": tables,
+                   "sources": stamp}, manifest_file)
+    os.replace(f"{manifest}.{os.getpid()}", manifest)
+    remove_old_stores(folder)
+    return folder
+
+
+def read_snapshot(config: configparser.ConfigParser,
+                  stamp: dict[str, list[int]] | None = None) -> dict | None:
+    """Memory maps the snapshot
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files and the snapshot folder
+    stamp : dict
+            Stamp of the wanted files, from source_stamp. Taken now when not given
+
+    Returns
+    -------
+    dict or None
+        main_data (sorted, None with the indexed backend), block_index, annotated_bed,
+        site_matrix, gene_ranking and region_ranking,
+        None when there is no snapshot or it was made from other files
+
+    """
+    folder = snapshot_folder(config)
+    try:
+        with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    stamp = source_stamp(config) if stamp is None else stamp
+    if (manifest.get("version") != SNAPSHOT_VERSION or manifest.get("sources") != stamp
+            or manifest.get("backend") != dataset_backend(config)
+            or manifest.get("chromosomes", []) != list(core.shard_chromosomes(config))):
+        logger.info("Snapshot in %s is out of date", folder)
+        return None
+    folder = os.path.join(folder, manifest["folder"])
+    try:
+        loaded = {table: pl.read_ipc(os.path.join(folder, f"{table}.arrow"), memory_map=True)
+                  if table in manifest["tables"] else None for table in SNAPSHOT_TABLES}
+        loaded["site_matrix"] = (sm.read_site_matrix(os.path.join(folder, "site_matrix"))
+                                 if "site_matrix" in manifest["tables"] else None)
+        for ranking in ("gene_ranking", "region_ranking"):
+            loaded[ranking] = (gr.read_gene_ranking(os.path.join(folder, ranking))
+                               if ranking in manifest["tables"] else None)
+        return loaded
+    except OSError:
+        return None
+
+
+class DatasetManager:
+    """Keeps the current version of the data of a worker and swaps in new versions"""
+
+    def __init__(self, config: configparser.ConfigParser, reload_interval: float = 0):
+        """Creates a manager, the data is loaded on the first get
+
+        Parameters
+        ----------
+        config : ConfigParser
+                Contains the paths to needed files
+        reload_interval : float
+                Seconds between checks for new data, 0 to not watch the files
+
+        """
+        self.config = config
+        self.reload_interval = reload_interval
+        self._current: dict | None = None
+        self._pending: str | None = None
+        self._lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+
+    def get(self) -> dict:
+        """Gets the current version of the data
+
+        Returns
+        -------
+        dict
+            main_data (sorted), block_index, annotated_bed and generation
+
+        """
+        if self._current is None:
+            with self._lock:
+                if self._current is None:
+                    self._current = self.load(source_stamp(self.config))
+                    self.start_watching()
+        return self._current
+
+    def load(self, stamp: dict[str, list[int]]) -> dict:
+        """Loads a version of the data, from the snapshot if there is one
+
+        Only one worker builds a missing snapshot, the others wait for it
+        and memory map the result.
+
+        Parameters
+        ----------
+        stamp : dict
+                Stamp of the files to load, from source_stamp
+
+        Returns
+        -------
+        dict
+            main_data (sorted), block_index, annotated_bed and generation.
+            With the indexed backend also store_pin, the pin of its region store
+            generation, released when the dict is garbage collected
+
+        """
+        pin = (pin_generation(os.path.join(region_store_folder(self.config), generation_of(stamp)))
+               if dataset_backend(self.config) == "indexed" else None)
+        loaded = read_snapshot(self.config, stamp)
+        source = "snapshot"
+        if loaded is None:
+            folder = snapshot_folder(self.config)
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, ".lock"), mode="w", encoding="utf-8") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another worker can have made it while this one waited
+                loaded = read_snapshot(self.config, stamp)
+                if loaded is None:
+                    logger.info("No snapshot of the current files, reading the data files")
+                    write_snapshot(build_dataset(self.config, stamp), self.config, stamp)
+                    loaded = read_snapshot(self.config, stamp)
+                    source = "files"
+        instr.increment("methylation_dataset_loads_total", source=source)
+        loaded["generation"] = generation_of(stamp)
+        loaded["store_pin"] = pin
+        return loaded
+
+    def reload_if_changed(self) -> bool:
+        """Swaps in a new version of the data when the files changed
+
+        The files have to be the same in two checks in a row,
+        so files that are still being copied are not read.
+
+        Returns
+        -------
+        bool
+            True when a new version was swapped in
+
+        """
+        current = self.get()
+        stamp = source_stamp(self.config)
+        generation = generation_of(stamp)
+        if generation == current["generation"]:
+            self._pending = None
+            return False
+        if generation != self._pending:
+            self._pending = generation
+            return False
+
+        with instr.span("reload_dataset") as record:
+            new = self.load(stamp)
+            record["rows_out"] = int(new["block_index"]["length"].sum())
+        # Sessions that already started keep the version they got
+        self._current = new
+        self._pending = None
+        logger.info("Swapped in data generation %s", generation)
+        return True
+
+    def start_watching(self) -> None:
+        """Starts checking the files in the background, if a reload_interval is set"""
+        if self.reload_interval <= 0 or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="dataset-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self) -> None:
+        """Checks the files every reload_interval seconds"""
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload_if_changed()
+            except Exception:  # pylint: disable=broad-except
+                # Keep serving the current data, try again at the next check
+                instr.increment("methylation_dataset_reload_errors_total")
+                logger.exception("Reloading the data failed")
+
+
+def get_manager(config: configparser.ConfigParser) -> DatasetManager:
+    """Gets the dataset manager of this worker process, creates it the first time
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files and the reload_interval
+
+    Returns
+    -------
+    DatasetManager
+        The manager shared by all sessions
+
+    """
+    key = config.get("PATHS", "data_folder") + shard_suffix(config)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = DatasetManager(
+                config, config.getfloat("DATASET", "reload_interval", fallback=60))
+        return _managers[key]
+
+
+def get_dataset(config: configparser.ConfigParser) -> dict:
+    """Gets the current version of the data of this worker process
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the paths to needed files
+
+    Returns
+    -------
+    dict
+        main_data (sorted), block_index, annotated_bed and generation
+
+    """
+    return get_manager(config).get()
+
+
+def main():
+    """Main"""
+    config = core.parse_config()
+    folder = write_snapshot(build_dataset(config), config)
+    print(f"Wrote the snapshot to {folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+differential.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Computes differential methylation between two sets of groups.
+Groups are the group names made by backend.process_groups (for example A53J1).
+For every CpG and every promoter region of the annotated bed
+the coverage weighted methylation fraction of both sets is compared
+with a two proportion z-test on the read counts.
+Every chromosome is computed in its own thread.
+The read counts per CpG can also come from the site matrix (see site_matrix.py).
+
+Not meant to be used on its own, used by ui.py
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+from scipy import special
+
+SITE_KEYS: list[str] = ["chr", "start", "end"]
+REGION_KEYS: list[str] = ["chr", "promoter_start", "promoter_end", "gene_name"]
+
+
+def check_sets(groups_a: list[str], groups_b: list[str]) -> None:
+    """Checks that no group is in both sets, a group compared with itself means nothing
+
+    Parameters
+    ----------
+    groups_a : list
+            Group names of set A
+    groups_b : list
+            Group names of set B
+
+    Raises
+    ------
+    ValueError
+        When a group is in both sets
+
+    """
+    overlap = sorted(set(groups_a) & set(groups_b))
+    if overlap:
+        raise ValueError(f"{', '.join(overlap)} can not be in both sets")
+
+
+def set_counts(df: pl.LazyFrame, groups: list[str], suffix: str) -> pl.LazyFrame:
+    """Counts the methylated and valid reads of every CpG for a set of groups
+
+    Parameters
+    ----------
+    df : pl.LazyFrame
+            Methylation data
+    groups : list
+            Group names in the set
+    suffix : str
+            Added to the column names, A or B
+
+    Returns
+    -------
+    pl.LazyFrame
+        Per CpG: methylated reads, valid reads and amount of samples
+
+    """
+    return (df
+            .filter(pl.col("group_name").is_in(groups))
+            .group_by(SITE_KEYS)
+            .agg((pl.col("frac").cast(pl.Float64) * pl.col("valid")).sum().alias(f"methylated {suffix}"),
+                 pl.col("valid").cast(pl.Float64).sum().alias(f"coverage {suffix}"),
+                 pl.len().alias(f"samples {suffix}")))
+
+
+def z_test(df: pl.DataFrame) -> pl.DataFrame:
+    """Adds the fractions, delta and a two proportion z-test
+
+    Uses the methylated and coverage columns of both sets.
+    The delta is B - A.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Contains methylated A/B and coverage A/B
+
+    Returns
+    -------
+    pl.DataFrame
+        df with frac A, frac B, delta frac, z, p value and q value
+
+    """
+    df = df.with_columns(
+        (pl.col("methylated A") / pl.col("coverage A")).alias("frac A"),
+        (pl.col("methylated B") / pl.col("coverage B")).alias("frac B"),
+        ((pl.col("methylated A") + pl.col("methylated B")) /
+         (pl.col("coverage A") + pl.col("coverage B"))).alias("pooled"))
+    df = df.with_columns(
+        (pl.col("frac B") - pl.col("frac A")).alias("delta frac"),
+        (pl.col("pooled") * (1 - pl.col("pooled")) *
+         (1 / pl.col("coverage A") + 1 / pl.col("coverage B"))).sqrt().alias("se"))
+    df = df.with_columns(
+        pl.when(pl.col("se") > 0)
+        .then(pl.col("delta frac") / pl.col("se"))
+        .otherwise(0.0)
+        .alias("z")).drop(["pooled", "se"])
+
+    z_values = df["z"].to_numpy()
+    p_values = 2 * special.ndtr(-np.abs(z_values))
+    return df.with_columns(pl.Series("p value", p_values),
+                           pl.Series("q value", benjamini_hochberg(p_values)))
+
+
+def benjamini_hochberg(p_values: np.ndarray) -> np.ndarray:
+    """Corrects p values for multiple testing
+
+    Parameters
+    ----------
+    p_values : np.ndarray
+            Uncorrected p values
+
+    Returns
+    -------
+    np.ndarray
+        Benjamini-Hochberg q values
+
+    """
+    n_tests = p_values.size
+    if n_tests == 0:
+        return p_values
+    order = np.argsort(p_values)
+    ranked = p_values[order] * n_tests / np.arange(1, n_tests + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    q_values = np.empty(n_tests)
+    q_values[order] = np.minimum(ranked, 1.0)
+    return q_values
+
+
+def chromosome_counts(df: pl.DataFrame, groups_a: list[str],
+                      groups_b: list[str]) -> pl.DataFrame:
+    """Counts both sets for every CpG of one chromosome
+
+    Only CpGs that have reads in both sets are kept.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Methylation data of one chromosome
+    groups_a : list
+            Group names of set A
+    groups_b : list
+            Group names of set B
+
+    Returns
+    -------
+    pl.DataFrame
+        Per CpG read counts of both sets
+
+    """
+    lazy = df.lazy()
+    return (set_counts(lazy, groups_a, "A")
+            .join(set_counts(lazy, groups_b, "B"), on=SITE_KEYS, how="inner")
+            .filter((pl.col("coverage A") > 0) & (pl.col("coverage B") > 0))
+            .collect())
+
+
+def region_counts(counts: pl.DataFrame, promoters: pl.DataFrame) -> pl.DataFrame:
+    """Sums the CpG read counts for every promoter region of one chromosome
+
+    The CpGs are sorted on position, so the CpGs of a promoter are a contiguous
+    range that is found with a binary search. The sums come from prefix sums,
+    so overlapping promoters do not need a join.
+
+    Parameters
+    ----------
+    counts : pl.DataFrame
+            Per CpG read counts, from chromosome_counts
+    promoters : pl.DataFrame
+            Promoter regions of the same chromosome
+
+    Returns
+    -------
+    pl.DataFrame
+        Per promoter read counts of both sets and the amount of CpGs
+
+    """
+    if counts.is_empty() or promoters.is_empty():
+        return pl.DataFrame()
+    counts = counts.sort("start")
+    starts = counts["start"].to_numpy()
+    ends = counts["end"].to_numpy()
+
+    if np.any(ends[1:] < ends[:-1]):
+        # Ends are not in the same order as starts, fall back to a range join
+        return (counts
+                .join_where(promoters.select(pl.col("start").alias("promoter_start"),
+                                             pl.col("end").alias("promoter_end"),
+                                             "gene_name"),
+                            pl.col("start") >= pl.col("promoter_start"),
+                            pl.col("end") <= pl.col("promoter_end"))
+                .group_by(REGION_KEYS)
+                .agg(pl.col("methylated A").sum(), pl.col("coverage A").sum(),
+                     pl.col("methylated B").sum(), pl.col("coverage B").sum(),
+                     pl.len().alias("n CpGs")))
+
+    first = np.searchsorted(starts, promoters["start"].to_numpy(), side="left")
+    last = np.maximum(np.searchsorted(ends, promoters["end"].to_numpy(), side="right"), first)
+
+    regions = {"chr": promoters["chr"],
+               "promoter_start": promoters["start"],
+               "promoter_end": promoters["end"],
+               "gene_name": promoters["gene_name"],
+               "n CpGs": last - first}
+    for column in ("methylated A", "coverage A", "methylated B", "coverage B"):
+        prefix = np.concatenate(([0.0], np.cumsum(counts[column].to_numpy())))
+        regions[column] = prefix[last] - prefix[first]
+    return (pl.DataFrame(regions)
+            .filter(pl.col("n CpGs") > 0)
+            .unique(REGION_KEYS, maintain_order=True))
+
+
+def differential_from_counts(counts: pl.DataFrame, annotated_bed: pl.DataFrame,
+                             workers: int | None = None) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Tests every CpG and promoter, from the per CpG read counts of both sets
+
+    Parameters
+    ----------
+    counts : pl.DataFrame
+            Per CpG read counts, from chromosome_counts or site_matrix.site_counts
+    annotated_bed : pl.DataFrame
+            Promoter regions (chr, start, end, gene_name)
+    workers : int
+            Amount of threads, one chromosome per thread
+
+    Returns
+    -------
+    tuple
+        Per CpG results and per promoter results,
+        both sorted on q value
+
+    """
+    chromosomes = counts.partition_by("chr", as_dict=True) if not counts.is_empty() else {}
+    promoters = annotated_bed.partition_by("chr", as_dict=True)
+
+    def one_chromosome(key):
+        return region_counts(chromosomes[key], promoters.get(key, annotated_bed.clear()))
+
+    workers = workers or min(len(chromosomes), os.cpu_count() or 1) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(one_chromosome, chromosomes))
+
+    region_frames = [regions.select(REGION_KEYS + ["n CpGs", "methylated A", "coverage A",
+                                                   "methylated B", "coverage B"])
+                     for regions in results if not regions.is_empty()]
+
+    sites = z_test(counts) if not counts.is_empty() else pl.DataFrame()
+    regions = z_test(pl.concat(region_frames)) if region_frames else pl.DataFrame()
+    if not sites.is_empty():
+        sites = sites.sort("q value")
+    if not regions.is_empty():
+        regions = regions.sort("q value")
+    return sites, regions
+
+
+def differential_methylation(df: pl.DataFrame, annotated_bed: pl.DataFrame,
+                             groups_a: list[str], groups_b: list[str],
+                             workers: int | None = None) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Computes differential methylation between two sets of groups
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Methylation data
+    annotated_bed : pl.DataFrame
+            Promoter regions (chr, start, end, gene_name)
+    groups_a : list
+            Group names of set A, the reference
+    groups_b : list
+            Group names of set B
+    workers : int
+            Amount of threads, one chromosome per thread
+
+    Returns
+    -------
+    tuple
+        Per CpG results and per promoter results,
+        both sorted on q value
+
+    Raises
+    ------
+    ValueError
+        When a group is in both sets
+
+    """
+    check_sets(groups_a, groups_b)
+    data = df.filter(pl.col("group_name").is_in(list(groups_a) + list(groups_b)))
+    chromosomes = data.partition_by("chr", as_dict=True)
+
+    def one_chromosome(key):
+        return chromosome_counts(chromosomes[key], groups_a, groups_b)
+
+    workers = workers or min(len(chromosomes), os.cpu_count() or 1) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        site_frames = [counts for counts in executor.map(one_chromosome, chromosomes)
+                       if not counts.is_empty()]
+
+    counts = pl.concat(site_frames) if site_frames else pl.DataFrame()
+    return differential_from_counts(counts, annotated_bed, workers)
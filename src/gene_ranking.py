@@ -0,0 +1,356 @@
+"""
+gene_ranking.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Ranks the genes on the methylation of their promoters.
+A gene is ranked once per chromosome it has promoters on (genes like IL3RA are on chrX and chrY),
+promoters without a gene name ("Unknown gene" in the annotated bed) are left out.
+The statistics of every gene and group (sample) are computed once, in one pass over the data:
+the amount of CpGs, the mean of their positions, the sum of the squared deviations from that mean
+and the sum of their fractions. The groups that are selected are added up at query time
+(the squared deviations with the distance of every group mean to the overall mean, Chan et al.),
+and the data can be counted in parts (one file at a time with the indexed backend).
+Unlike a sum of squared positions, this stays exact for genes with promoters
+far apart on a chromosome.
+
+Metrics that can be ranked on:
+position spread     standard deviation of the CpG positions in the promoters (bp)
+mean frac           mean methylation fraction of the CpGs
+frac variance       variance of the mean fraction of the groups, how much the groups differ
+n CpGs              amount of CpGs
+
+The same sums are made for every distinct promoter region (region_bed), for the
+sample overview (see sample_overview.py), where shared promoters should count once.
+
+Top k queries select the columns of the wanted groups, filter on chromosome and
+amount of CpGs, and use a partial sort (np.argpartition), so they take milliseconds.
+The ranking is part of the shared snapshot (see dataset.py).
+
+Not meant to be used on its own, used by ui.py and count_best_genes.py
+"""
+
+import os
+import json
+from typing import NamedTuple
+import numpy as np
+import polars as pl
+import core
+
+METRICS: tuple[str, ...] = ("position spread", "mean frac", "frac variance", "n CpGs")
+PLANES: tuple[str, ...] = ("counts", "position_mean", "position_deviations", "frac_sum")
+READ_COLUMNS: list[str] = list(core.READ_SCHEMA)
+# Placeholder name of the promoters without a known gene in the annotated bed
+UNKNOWN_GENE: str = "Unknown gene"
+
+
+class GeneRanking(NamedTuple):
+    """Genes (gene_name and chr) by samples, with the sums needed for every metric"""
+    genes: pl.DataFrame
+    samples: tuple[str, ...]
+    counts: np.ndarray
+    position_mean: np.ndarray
+    position_deviations: np.ndarray
+    frac_sum: np.ndarray
+
+
+def promoter_cpgs(df: pl.DataFrame, annotated_bed: pl.DataFrame) -> list[pl.DataFrame]:
+    """Finds the CpGs in the promoters of every gene with a range join
+
+    Used for data that is not labelled with core.annotate_promoters.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Methylation data, or a part of it
+    annotated_bed : pl.DataFrame
+            Promoter regions (chr, start, end, gene_name)
+
+    Returns
+    -------
+    list
+        Per chromosome, the CpGs with the gene_name of every promoter around them
+
+    """
+    promoters = (annotated_bed
+                 .unique(["chr", "start", "end", "gene_name"])
+                 .rename({"start": "promoter_start", "end": "promoter_end"}))
+    data = df.partition_by("chr", as_dict=True) if not df.is_empty() else {}
+    regions = promoters.partition_by("chr", as_dict=True)
+    return [cpgs
+            .select(READ_COLUMNS)
+            .join_where(regions[key].drop("chr"),
+                        pl.col("start") >= pl.col("promoter_start"),
+                        pl.col("end") <= pl.col("promoter_end"))
+            .drop(["promoter_start", "promoter_end"])
+            .unique(["gene_name", "chr", "start", "end", "group_name"])
+            for key, cpgs in data.items() if key in regions]
+
+
+def region_bed(annotated_bed: pl.DataFrame) -> pl.DataFrame:
+    """Turns the promoters into one row per distinct region, named after the region
+
+    gene_sums and build_gene_ranking of this bed give the sums of every
+    promoter region instead of every gene. The regions are the same as
+    the regions of the annotated bed, so labelled data is still grouped on its labels.
+
+    Parameters
+    ----------
+    annotated_bed : pl.DataFrame
+            Promoter regions (chr, start, end, gene_name)
+
+    Returns
+    -------
+    pl.DataFrame
+        chr, start, end and gene_name, the name of the region (chr:start-end),
+        see core.promoter_regions
+
+    """
+    return (core.promoter_regions(annotated_bed)
+            .select(["chr", "start", "end", pl.col("promoter").cast(pl.String).alias("gene_name")]))
+
+
+def gene_sums(df: pl.DataFrame, annotated_bed: pl.DataFrame) -> pl.DataFrame:
+    """Sums the CpGs in the promoters of every gene, per group
+
+    A CpG is counted once for every gene with a promoter around it,
+    promoters of UNKNOWN_GENE are left out.
+    Data labelled by core.annotate_promoters is grouped on its labels,
+    other data is matched to the promoters with a range join.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Methylation data, or a part of it
+    annotated_bed : pl.DataFrame
+            Promoter regions (chr, start, end, gene_name)
+
+    Returns
+    -------
+    pl.DataFrame
+        gene_name, chr, group_name and every plane
+
+    """
+    genes = core.labelled_genes(df.schema, annotated_bed)
+    known = pl.col("gene_name") != UNKNOWN_GENE
+    if genes is not None:
+        # Labelled by core.annotate_promoters, the CpGs are found on their label
+        frames = [core.annotated_gene_plan(genes.filter(known), df.lazy())
+                  .select(READ_COLUMNS + ["gene_name"])
+                  .unique(["gene_name", "chr", "start", "end", "group_name"])
+                  .collect()]
+    else:
+        frames = promoter_cpgs(df, annotated_bed.filter(known))
+    if not frames:
+        return pl.DataFrame(schema={"gene_name": pl.String, "chr": pl.String,
+                                    "group_name": pl.String, "counts": pl.UInt32,
+                                    "position_mean": pl.Float64,
+                                    "position_deviations": pl.Float64, "frac_sum": pl.Float64})
+
+    position = pl.col("start").cast(pl.Float64)
+    return (pl.concat(frames)
+            .group_by(["gene_name", "chr", "group_name"])
+            .agg(pl.len().cast(pl.UInt32).alias("counts"),
+                 position.mean().alias("position_mean"),
+                 ((position - position.mean()) ** 2).sum().alias("position_deviations"),
+                 pl.col("frac").cast(pl.Float64).sum().alias("frac_sum"))
+            .select(["gene_name", "chr", "group_name", *PLANES]))
+
+
+def build_gene_ranking(sums: list[pl.DataFrame]) -> GeneRanking:
+    """Puts the sums of every gene and group in a matrix
+
+    Parameters
+    ----------
+    sums : list
+            Results of gene_sums, for example one per data file, they are combined
+
+    Returns
+    -------
+    GeneRanking
+        The genes sorted on name and chromosome, the groups sorted on name,
+        and the planes in column major order
+
+    """
+    keys = ["gene_name", "chr", "group_name"]
+    counts = pl.col("counts").cast(pl.Float64)
+    cell_mean = (counts * pl.col("position_mean")).sum().over(keys) / counts.sum().over(keys)
+    cells = (pl.concat(sums)
+             .with_columns(cell_mean.alias("cell_mean"))
+             .group_by(keys)
+             .agg(pl.col("counts").sum(),
+                  pl.col("cell_mean").first().alias("position_mean"),
+                  (pl.col("position_deviations") +
+                   counts * (pl.col("position_mean") - pl.col("cell_mean")) ** 2)
+                  .sum().alias("position_deviations"),
+                  pl.col("frac_sum").sum()))
+    genes = cells.select(["gene_name", "chr"]).unique().sort(["gene_name", "chr"])
+    samples = tuple(sorted(cells["group_name"].unique().to_list()))
+    cells = (cells
+             .join(genes.with_row_index("row"), on=["gene_name", "chr"])
+             .with_columns(pl.col("group_name")
+                           .replace_strict(list(samples), list(range(len(samples))),
+                                           return_dtype=pl.UInt32).cast(pl.UInt32).alias("column")))
+
+    shape = (genes.height, len(samples))
+    rows, columns = cells["row"].to_numpy(), cells["column"].to_numpy()
+    planes = {}
+    for plane in PLANES:
+        planes[plane] = np.zeros(shape, dtype=np.uint32 if plane == "counts" else np.float64,
+                                 order="F")
+        planes[plane][rows, columns] = cells[plane].to_numpy()
+    return GeneRanking(genes, samples, **planes)
+
+
+def write_gene_ranking(ranking: GeneRanking, folder: str) -> None:
+    """Writes the ranking, the planes as .npy files so they can be memory mapped
+
+    Every file is written next to its final name first and then renamed.
+
+    Parameters
+    ----------
+    ranking : GeneRanking
+            From build_gene_ranking
+    folder : str
+            Folder to write to
+    """
+    os.makedirs(folder, exist_ok=True)
+    temporary = f".{os.getpid()}"
+    ranking.genes.write_ipc(os.path.join(folder, "genes.arrow" + temporary),
+                            compression="uncompressed")
+    for plane in PLANES:
+        with open(os.path.join(folder, f"{plane}.npy" + temporary), "wb") as file:
+            np.save(file, getattr(ranking, plane))
+    with open(os.path.join(folder, "samples.json" + temporary), mode="w",
+              encoding="utf-8") as file:
+        json.dump(list(ranking.samples), file)
+    for name in ("genes.arrow", *(f"{plane}.npy" for plane in PLANES), "samples.json"):
+        os.replace(os.path.join(folder, name + temporary), os.path.join(folder, name))
+
+
+def read_gene_ranking(folder: str) -> GeneRanking:
+    """Memory maps a ranking written by write_gene_ranking
+
+    Parameters
+    ----------
+    folder : str
+            Folder the ranking was written to
+
+    Returns
+    -------
+    GeneRanking
+        The ranking, with read only planes
+    """
+    with open(os.path.join(folder, "samples.json"), encoding="utf-8") as file:
+        samples = tuple(json.load(file))
+    return GeneRanking(pl.read_ipc(os.path.join(folder, "genes.arrow"), memory_map=True),
+                       samples,
+                       **{plane: np.load(os.path.join(folder, f"{plane}.npy"), mmap_mode="r")
+                          for plane in PLANES})
+
+
+def gene_metrics(ranking: GeneRanking, chromosomes: list[str] | tuple = (),
+                 groups: list[str] | tuple = (), min_cpgs: int = 1) -> pl.DataFrame:
+    """Computes every metric for the selected groups
+
+    Parameters
+    ----------
+    ranking : GeneRanking
+            From build_gene_ranking or read_gene_ranking
+    chromosomes : list
+            Only genes on these chromosomes, all when empty
+    groups : list
+            Only the CpGs of these groups, all when empty
+    min_cpgs : int
+            Only genes with at least this amount of CpGs in the groups
+
+    Returns
+    -------
+    pl.DataFrame
+        gene_name, chr and every metric, in the order of the ranking.
+        Metrics that need two values (CpGs or groups) are NaN for genes with one
+    """
+    columns = ([ranking.samples.index(group) for group in groups if group in ranking.samples]
+               if groups else list(range(len(ranking.samples))))
+    counts = np.asarray(ranking.counts[:, columns], dtype=np.float64)
+    total = counts.sum(axis=1)
+    keep = total >= max(min_cpgs, 1)
+    if chromosomes:
+        keep &= ranking.genes["chr"].is_in(list(chromosomes)).to_numpy()
+    rows = np.flatnonzero(keep)
+
+    counts, total = counts[rows], total[rows]
+    position_mean = np.asarray(ranking.position_mean[:, columns])[rows]
+    position_deviations = np.asarray(ranking.position_deviations[:, columns])[rows].sum(axis=1)
+    frac_sum = np.asarray(ranking.frac_sum[:, columns])[rows]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Groups without CpGs have a mean of 0 and a count of 0, so they add nothing
+        overall_mean = (counts * position_mean).sum(axis=1) / total
+        squared_deviations = position_deviations + (
+            counts * (position_mean - overall_mean[:, None]) ** 2).sum(axis=1)
+        spread = np.where(total > 1, np.sqrt(squared_deviations / (total - 1)), np.nan)
+        group_fracs = np.where(counts > 0, frac_sum / counts, np.nan)
+    measured_groups = (counts > 0).sum(axis=1)
+    variance = np.full(rows.size, np.nan)
+    several = measured_groups > 1
+    if several.any():
+        variance[several] = np.nanvar(group_fracs[several], axis=1, ddof=1)
+
+    return ranking.genes[rows].with_columns(
+        pl.Series("position spread", spread),
+        pl.Series("mean frac", frac_sum.sum(axis=1) / total),
+        pl.Series("frac variance", variance),
+        pl.Series("n CpGs", total.astype(np.int64)))
+
+
+def top_genes(ranking: GeneRanking, metric: str = "position spread", k: int = 20,
+              chromosomes: list[str] | tuple = (), groups: list[str] | tuple = (),
+              min_cpgs: int = 1, descending: bool = True) -> pl.DataFrame:
+    """Gets the k genes with the highest (or lowest) value of a metric
+
+    Only the k best genes are sorted, the rest is split off with np.argpartition.
+    Genes without a value for the metric come last.
+
+    Parameters
+    ----------
+    ranking : GeneRanking
+            From build_gene_ranking or read_gene_ranking
+    metric : str
+            One of METRICS
+    k : int
+            Amount of genes
+    chromosomes : list
+            Only genes on these chromosomes, all when empty
+    groups : list
+            Only the CpGs of these groups, all when empty
+    min_cpgs : int
+            Only genes with at least this amount of CpGs in the groups
+    descending : bool
+            Highest values first, False for the lowest values
+
+    Returns
+    -------
+    pl.DataFrame
+        The k genes, sorted on the metric, with every metric
+
+    Raises
+    ------
+    ValueError
+        When the metric is unknown
+    """
+    if metric not in METRICS:
+        raise ValueError(f"unknown metric {metric!r}, use one of {', '.join(METRICS)}")
+    metrics = gene_metrics(ranking, chromosomes, groups, min_cpgs)
+    k = min(max(k, 0), metrics.height)
+    if k == 0:
+        return metrics.clear()
+
+    values = metrics[metric].to_numpy().astype(np.float64)
+    order = -values if descending else values.copy()
+    order[np.isnan(order)] = np.inf
+    best = np.argpartition(order, k - 1)[:k] if k < order.size else np.arange(order.size)
+    best = best[np.argsort(order[best], kind="stable")]
+    return metrics[best]
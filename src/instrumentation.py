@@ -0,0 +1,322 @@
+"""
+instrumentation.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Timing and counting of the hot paths of the website.
+Steps are wrapped in a span, which records how long they took
+and how many rows went in and out.
+Everything is exposed as Prometheus metrics on a local port,
+and requests can optionally be profiled with cProfile or pyinstrument.
+
+Settings go in the config.ini:
+[INSTRUMENTATION]
+metrics_port = 9100
+profiler = none | cprofile | pyinstrument
+profile_dir = path/to/profiles
+
+Not meant to be used on its own, used by backend.py and ui.py
+"""
+
+import os
+import time
+import logging
+import threading
+import configparser
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                              1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+_lock = threading.Lock()
+_local = threading.local()
+# step name -> [bucket counts, count, sum of seconds]
+_durations: dict[str, list] = {}
+# (metric name, labels) -> value
+_counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_server: ThreadingHTTPServer | None = None
+
+
+def row_count(data) -> int | None:
+    """Gets the amount of rows of a dataframe
+
+    Parameters
+    ----------
+    data : pl.DataFrame or anything else
+            Object to count the rows of
+
+    Returns
+    -------
+    int or None
+        Amount of rows, None if data has no height (is not a dataframe)
+
+    """
+    return getattr(data, "height", None)
+
+
+def increment(name: str, value: float = 1, **labels: str) -> None:
+    """Increments a counter
+
+    Parameters
+    ----------
+    name : str
+            Name of the counter
+    value : float
+            Value to add
+    labels : str
+            Prometheus labels of the counter
+
+    Returns
+    -------
+    None
+
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(step: str, seconds: float) -> None:
+    """Adds a duration to the histogram of a step
+
+    Parameters
+    ----------
+    step : str
+            Name of the step
+    seconds : float
+            Duration of the step
+
+    Returns
+    -------
+    None
+
+    """
+    with _lock:
+        buckets, _, _ = histogram = _durations.setdefault(step, [[0] * len(BUCKETS), 0, 0.0])
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                buckets[index] += 1
+        histogram[1] += 1
+        histogram[2] += seconds
+
+
+@contextmanager
+def span(step: str, rows_in: int | None = None):
+    """Times a step
+
+    Yields a dict, set "rows_out" in it to record the rows a step returned.
+
+    Parameters
+    ----------
+    step : str
+            Name of the step
+    rows_in : int
+            Amount of rows that went into the step
+
+    Yields
+    ------
+    dict
+        Record of the span
+
+    """
+    record = {"rows_in": rows_in, "rows_out": None}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        observe(step, seconds)
+        if record["rows_in"] is not None:
+            increment("methylation_step_rows_in_total", record["rows_in"], step=step)
+        if record["rows_out"] is not None:
+            increment("methylation_step_rows_out_total", record["rows_out"], step=step)
+        logger.debug("%s took %.4fs (rows in: %s, rows out: %s)",
+                     step, seconds, record["rows_in"], record["rows_out"])
+
+
+def cache_miss() -> None:
+    """Marks that a cached function had to run
+
+    Call this in the body of a pn.cache function,
+    the body only runs when the cache missed.
+
+    """
+    _local.missed = True
+
+
+@contextmanager
+def track_cache(cache: str):
+    """Counts if a call to a cached function was a hit or a miss
+
+    Parameters
+    ----------
+    cache : str
+            Name of the cache
+
+    """
+    outer = getattr(_local, "missed", False)
+    _local.missed = False
+    try:
+        yield
+    finally:
+        result = "miss" if _local.missed else "hit"
+        increment("methylation_cache_requests_total", cache=cache, result=result)
+        _local.missed = outer
+
+
+def _format_labels(labels) -> str:
+    """Formats labels the way Prometheus wants them"""
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics() -> str:
+    """Renders all metrics in the Prometheus text format
+
+    Returns
+    -------
+    str
+        Metrics text
+
+    """
+    lines = ["# HELP methylation_step_duration_seconds Duration of a step",
+             "# TYPE methylation_step_duration_seconds histogram"]
+    with _lock:
+        for step, (buckets, count, total) in sorted(_durations.items()):
+            for bound, amount in zip(BUCKETS, buckets):
+                upper = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'methylation_step_duration_seconds_bucket'
+                             f'{_format_labels((("step", step), ("le", upper)))} {amount}')
+            lines.append(f"methylation_step_duration_seconds_count"
+                         f"{_format_labels((('step', step),))} {count}")
+            lines.append(f"methylation_step_duration_seconds_sum"
+                         f"{_format_labels((('step', step),))} {total}")
+
+        names = sorted({name for name, _ in _counters})
+        for name in names:
+            lines.append(f"# TYPE {name} counter")
+            for (counter, labels), value in sorted(_counters.items()):
+                if counter == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics on /metrics"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handles a GET request"""
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keeps scrapes out of the logs"""
+
+
+def start_metrics_server(config: configparser.ConfigParser) -> int | None:
+    """Starts the metrics endpoint, if a port is configured
+
+    Every worker process gets its own port, starting at metrics_port.
+    Calling it again in the same process does nothing.
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the instrumentation settings
+
+    Returns
+    -------
+    int or None
+        Port the metrics are served on, None if disabled
+
+    """
+    global _server  # pylint: disable=global-statement
+    with _lock:
+        if _server is not None:
+            return _server.server_address[1]
+        port = config.getint("INSTRUMENTATION", "metrics_port", fallback=0)
+        if not port:
+            return None
+
+        for offset in range(config.getint("INSTRUMENTATION", "metrics_ports", fallback=100)):
+            try:
+                _server = ThreadingHTTPServer(("127.0.0.1", port + offset), MetricsHandler)
+                break
+            except OSError:
+                continue
+        else:
+            logger.warning("No free port found for the metrics from %s", port)
+            return None
+
+    threading.Thread(target=_server.serve_forever, daemon=True,
+                     name="metrics-server").start()
+    logger.info("Serving metrics on 127.0.0.1:%s/metrics", _server.server_address[1])
+    return _server.server_address[1]
+
+
+@contextmanager
+def profile_request(config: configparser.ConfigParser, name: str):
+    """Profiles a request, if a profiler is configured
+
+    The profile is written to profile_dir,
+    as .prof for cProfile and .html for pyinstrument.
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the instrumentation settings
+    name : str
+            Name of the request, used in the file name
+
+    """
+    profiler = config.get("INSTRUMENTATION", "profiler", fallback="none").lower()
+    if profiler not in ("cprofile", "pyinstrument"):
+        yield
+        return
+
+    out_dir = config.get("INSTRUMENTATION", "profile_dir", fallback="profiles")
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{name}-{os.getpid()}-{time.time_ns()}")
+
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed, not profiling")
+            yield
+            return
+        session = Profiler(async_mode="disabled")
+        session.start()
+        try:
+            yield
+        finally:
+            session.stop()
+            with open(f"{path}.html", mode="w", encoding="utf-8") as out_file:
+                out_file.write(session.output_html())
+        return
+
+    import cProfile
+    session = cProfile.Profile()
+    session.enable()
+    try:
+        yield
+    finally:
+        session.disable()
+        session.dump_stats(f"{path}.prof")
@@ -0,0 +1,221 @@
+"""
+plot_cache.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Cache for built plots that is shared by all sessions of a worker process.
+ui.py runs again for every session, but this module is only imported once,
+so the cache lives as long as the worker.
+Entries are keyed on the filter spec and evicted least recently used,
+bounded by an estimate of their size in bytes.
+
+Settings go in the config.ini:
+[CACHE]
+plot_cache_mb = 256
+
+pandas, panel and HoloViews are only imported by the functions that need them,
+so api.py can use the cache without loading the plotting libraries.
+
+Not meant to be used on its own, used by ui.py and api.py
+"""
+
+import sys
+import threading
+import configparser
+from collections import OrderedDict
+import polars as pl
+import instrumentation as instr
+
+
+def estimate_size(obj) -> int:
+    """Estimates the memory an object keeps alive
+
+    Knows about dataframes, arrays, HoloViews objects and containers,
+    everything else is measured with sys.getsizeof.
+    An object can only be a pandas, numpy or HoloViews object when that
+    library was imported already, so they are looked up in sys.modules.
+
+    Parameters
+    ----------
+    obj : object
+            Object to measure
+
+    Returns
+    -------
+    int
+        Estimated size in bytes
+
+    """
+    pd = sys.modules.get("pandas")
+    np = sys.modules.get("numpy")
+    hv = sys.modules.get("holoviews")
+    if pd is not None and isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (pl.DataFrame, pl.Series)):
+        return int(obj.estimated_size())
+    if np is not None and isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, (str, bytes)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sum(estimate_size(value) for value in obj.values()) + sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_size(item) for item in obj) + sys.getsizeof(obj)
+    if hv is not None and isinstance(obj, hv.core.Dimensioned):
+        # HoloViews object, measure the data of every element in it
+        return sum(estimate_size(data) for data in obj.traverse(lambda element: element.data,
+                                                                [hv.Element])
+                   if data is not None) + 1024
+    return sys.getsizeof(obj)
+
+
+class PlotCache:
+    """Least recently used cache, bounded by the size of its entries in bytes"""
+
+    def __init__(self, max_bytes: int, name: str = "plot_cache"):
+        """Creates an empty cache
+
+        Parameters
+        ----------
+        max_bytes : int
+                Max total size of the entries
+        name : str
+                Name used in the metrics
+
+        """
+        self.max_bytes = max_bytes
+        self.name = name
+        self.current_bytes = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Gets an entry and marks it as recently used
+
+        Parameters
+        ----------
+        key : hashable
+                Key of the entry
+
+        Returns
+        -------
+        object or None
+            The entry, None if it is not cached
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        instr.increment("methylation_cache_requests_total", cache=self.name,
+                        result="miss" if entry is None else "hit")
+        return None if entry is None else entry[0]
+
+    def put(self, key, value) -> bool:
+        """Stores an entry, evicting the least recently used ones if needed
+
+        Parameters
+        ----------
+        key : hashable
+                Key of the entry
+        value : object
+                The entry
+
+        Returns
+        -------
+        bool
+            False if the entry is larger than the whole cache and was not stored
+
+        """
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                instr.increment("methylation_cache_evictions_total", cache=self.name)
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+        return True
+
+    def clear(self) -> None:
+        """Removes all entries"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_caches: dict[str, PlotCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_plot_cache(config: configparser.ConfigParser, name: str = "plot_cache") -> PlotCache:
+    """Gets the cache of this worker process, creates it the first time
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the cache settings
+    name : str
+            Name of the cache
+
+    Returns
+    -------
+    PlotCache
+        The cache shared by all sessions
+
+    """
+    with _caches_lock:
+        if name not in _caches:
+            megabytes = config.getfloat("CACHE", f"{name}_mb", fallback=256)
+            _caches[name] = PlotCache(int(megabytes * 1024 * 1024), name)
+        return _caches[name]
+
+
+def freeze_plots(plots):
+    """Turns the result of plot_plots into something that can be shared
+
+    Panel panes belong to the sessions that show them, so markdown panes are
+    stored as their text. HoloViews objects can be shown by every session.
+
+    Parameters
+    ----------
+    plots : list
+            (title, plot) tuples
+
+    Returns
+    -------
+    list
+        (title, plot or markdown text) tuples
+
+    """
+    import panel as pn
+    return [(title, plot.object if isinstance(plot, pn.pane.Markdown) else plot)
+            for title, plot in plots]
+
+
+def thaw_plots(plots):
+    """Turns frozen plots back into something a session can show
+
+    Parameters
+    ----------
+    plots : list
+            (title, plot or markdown text) tuples, from freeze_plots
+
+    Returns
+    -------
+    list
+        (title, plot) tuples
+
+    """
+    import panel as pn
+    return [(title, pn.pane.Markdown(plot) if isinstance(plot, str) else plot)
+            for title, plot in plots]
@@ -0,0 +1,259 @@
+"""
+router.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Query router over shards of the data, so the data and the queries can be
+spread over several hosts. Every shard is an api.py process that only loads
+some of the chromosomes (api.py --shard), with its own snapshot and block index.
+The router serves the same endpoints as api.py: it asks every shard which
+chromosomes it has (/api/info), sends a query only to the shards with
+chromosomes of the query, with the chromosome filter narrowed to the shard,
+and merges the answers:
+
+/api/info       chromosomes and groups of all shards, the rows added up
+/api/counts     the counts of the groups added up
+/api/summary    the summaries put together, they are per chromosome so they do not overlap
+/api/rows       the rows of the shards after each other
+
+Settings go in the config.ini:
+[ROUTER]
+port = 5110
+shards = http://127.0.0.1:5102, http://127.0.0.1:5103
+# seconds the chromosomes of the shards are remembered
+refresh = 30
+
+run (two shards and the router on one host):
+python3 src/api.py --port 5102 --shard chr1,chr2,chr3
+python3 src/api.py --port 5103 --shard chr4,chr5,chr6
+python3 src/router.py
+"""
+
+import io
+import json
+import time
+import asyncio
+import argparse
+import configparser
+from typing import NamedTuple
+import polars as pl
+import tornado.web
+import tornado.ioloop
+import tornado.httpclient
+import api
+import core
+import instrumentation as instr
+
+
+class Shard(NamedTuple):
+    """A shard and the data it serves, from its /api/info"""
+    url: str
+    chromosomes: tuple[str, ...]
+    groups: tuple[str, ...]
+    rows: int
+    generation: str
+
+
+def shard_urls(config: configparser.ConfigParser) -> list[str]:
+    """Gets the urls of the shards, comma separated in the [ROUTER] section"""
+    return [url.strip().rstrip("/") for url in config.get("ROUTER", "shards", fallback="")
+            .split(",") if url.strip()]
+
+
+def spec_arguments(spec: core.FilterSpec) -> dict:
+    """Turns a filter spec into the json body of an api request, see api.parse_spec
+
+    Parameters
+    ----------
+    spec : core.FilterSpec
+            The filters of the query
+
+    Returns
+    -------
+    dict
+        The arguments, only the filters that are used
+    """
+    arguments = {"chr": list(spec.chromosomes), "group": list(spec.groups),
+                 "gene": list(spec.genes), "min_range": spec.min_range,
+                 "max_range": spec.max_range, "min_coverage": spec.min_coverage}
+    arguments = {name: value for name, value in arguments.items() if value not in ([], 0)}
+    if spec.frac_range is not None:
+        arguments["min_frac"], arguments["max_frac"] = spec.frac_range
+    return arguments
+
+
+def split_spec(spec: core.FilterSpec,
+               shards: list[Shard]) -> list[tuple[Shard, core.FilterSpec]]:
+    """Splits a filter spec over the shards that have its chromosomes
+
+    Parameters
+    ----------
+    spec : core.FilterSpec
+            The filters of the query
+    shards : list
+            Every shard, from ShardMap.get
+
+    Returns
+    -------
+    list
+        (shard, spec) pairs, the spec only has the chromosomes of the shard.
+        When no shard has the chromosomes, the first shard answers (with no rows)
+    """
+    if not spec.chromosomes:
+        return [(shard, spec) for shard in shards]
+    parts = [(shard, spec._replace(chromosomes=tuple(name for name in spec.chromosomes
+                                                      if name in shard.chromosomes)))
+             for shard in shards]
+    parts = [(shard, part) for shard, part in parts if part.chromosomes]
+    return parts or [(shard, spec) for shard in shards[:1]]
+
+
+def merge_info(shards: list[Shard]) -> dict:
+    """Describes the data of all shards together, like api.query_info"""
+    return {"generation": ",".join(shard.generation for shard in shards),
+            "rows": sum(shard.rows for shard in shards),
+            "chromosomes": sorted({name for shard in shards for name in shard.chromosomes}),
+            "groups": sorted({name for shard in shards for name in shard.groups})}
+
+
+def filled_parts(parts: list[pl.DataFrame]) -> list[pl.DataFrame]:
+    """Leaves out the answers without rows, their types can differ (an empty enum is a categorical)"""
+    return [part for part in parts if not part.is_empty()] or parts[:1]
+
+
+def merge_counts(parts: list[pl.DataFrame]) -> pl.DataFrame:
+    """Adds up the counts of the groups, like api.query_counts"""
+    return (pl.concat(filled_parts(parts))
+            .group_by("group_name")
+            .agg(pl.col("n methylations").sum().cast(pl.UInt32))
+            .sort("group_name"))
+
+
+def merge_summary(parts: list[pl.DataFrame]) -> pl.DataFrame:
+    """Puts the summaries together, every chromosome is on one shard"""
+    summary = pl.concat(filled_parts(parts), how="diagonal_relaxed")
+    keys = [key for key in ("group_name", "chr", "gene_name") if key in summary.columns]
+    return summary.sort(keys)
+
+
+def merge_rows(parts: list[pl.DataFrame]) -> pl.DataFrame:
+    """Puts the rows of the shards after each other"""
+    return pl.concat(filled_parts(parts), how="vertical_relaxed")
+
+
+MERGES = {"counts": merge_counts, "summary": merge_summary, "rows": merge_rows}
+
+
+class ShardMap:
+    """Remembers the chromosomes of every shard for a while"""
+
+    def __init__(self, urls: list[str], refresh: float = 30):
+        self.urls = urls
+        self.refresh = refresh
+        self.shards: list[Shard] = []
+        self.checked = 0.0
+        self.lock = asyncio.Lock()
+
+    async def get(self, client: tornado.httpclient.AsyncHTTPClient) -> list[Shard]:
+        """Gets the shards, asks them for their data when it is time to check again
+
+        Parameters
+        ----------
+        client : AsyncHTTPClient
+                Client to ask the shards with
+
+        Returns
+        -------
+        list
+            Every shard, in the order of the config
+        """
+        async with self.lock:
+            if not self.shards or time.monotonic() - self.checked > self.refresh:
+                answers = await asyncio.gather(*(client.fetch(f"{url}/api/info")
+                                                 for url in self.urls))
+                infos = [json.loads(answer.body) for answer in answers]
+                self.shards = [Shard(url, tuple(info["chromosomes"]), tuple(info["groups"]),
+                                     info["rows"], info["generation"])
+                               for url, info in zip(self.urls, infos)]
+                self.checked = time.monotonic()
+            return self.shards
+
+    def forget(self):
+        """Asks the shards again next time, after a shard failed"""
+        self.shards = []
+
+
+class RouterHandler(api.QueryHandler):
+    """Answers the queries of one endpoint with the answers of the shards"""
+
+    def initialize(self, config: configparser.ConfigParser, shard_map: ShardMap = None):
+        """Stores the config and the shards, called by tornado for every request"""
+        super().initialize(config)
+        self.shard_map = shard_map
+
+    async def answer(self, endpoint: str, spec: core.FilterSpec) -> dict | pl.DataFrame:
+        """Sends the query to the shards and merges their answers"""
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            shards = await self.shard_map.get(client)
+            if endpoint == "info":
+                return merge_info(shards)
+            parts = split_spec(spec, shards)
+            with instr.span(f"router.{endpoint}", rows_in=len(parts)):
+                answers = await asyncio.gather(*(
+                    client.fetch(f"{shard.url}/api/{endpoint}", method="POST",
+                                 body=json.dumps(spec_arguments(part) | {"format": "arrow"}),
+                                 request_timeout=300)
+                    for shard, part in parts))
+        except tornado.httpclient.HTTPClientError as error:
+            if error.code == 503:
+                self.set_header("Retry-After", "5")
+                raise tornado.web.HTTPError(503, reason="A shard is busy") from error
+            self.shard_map.forget()
+            raise tornado.web.HTTPError(502, reason=f"A shard failed: {error}") from error
+        except OSError as error:
+            self.shard_map.forget()
+            raise tornado.web.HTTPError(502, reason=f"A shard is down: {error}") from error
+        return await asyncio.to_thread(
+            MERGES[endpoint], [pl.read_ipc_stream(io.BytesIO(answer.body)) for answer in answers])
+
+
+def router_routes(config: configparser.ConfigParser) -> list[tuple]:
+    """Creates the tornado routes of the router
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the urls of the shards
+
+    Returns
+    -------
+    list
+        (pattern, handler, arguments) tuples
+    """
+    shard_map = ShardMap(shard_urls(config), config.getfloat("ROUTER", "refresh", fallback=30))
+    return [(r"/api/(info|counts|summary|rows)", RouterHandler,
+             {"config": config, "shard_map": shard_map})]
+
+
+def main():
+    """Main"""
+    config = core.parse_config()
+    parser = argparse.ArgumentParser(description="Route queries to the shards")
+    parser.add_argument("--port", type=int,
+                        default=config.getint("ROUTER", "port", fallback=5110))
+    parser.add_argument("--shards", default=None, help="comma separated urls of the shards")
+    args = parser.parse_args()
+    if args.shards is not None:
+        config.read_dict({"ROUTER": {"shards": args.shards}})
+    if not shard_urls(config):
+        parser.error("no shards, set shards in the [ROUTER] section or use --shards")
+    tornado.web.Application(router_routes(config)).listen(args.port)
+    print(f"Routing the api on http://localhost:{args.port}/api to {', '.join(shard_urls(config))}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
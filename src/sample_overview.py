@@ -0,0 +1,165 @@
+"""
+sample_overview.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Shows how the samples (groups) relate to each other, over all promoters at once.
+The region ranking (see gene_ranking.region_bed) already holds the amount of CpGs and the
+sum of their fractions for every distinct promoter region and group, so the mean fraction
+of every promoter in every sample is known without touching the CpGs.
+A promoter shared by several genes is one feature, as is every unnamed promoter.
+
+These means are put in a sparse samples by promoters matrix, centered per promoter.
+A promoter without CpGs in a sample is left empty, which is the same as giving it
+the mean of the other samples. A randomized PCA (a random projection and a few
+power iterations, so only products with the sparse matrix and small dense
+decompositions are needed) gives the coordinates of the samples, and the samples
+are clustered hierarchically (ward) on those coordinates.
+
+The overview only depends on the region ranking, the chromosomes, the groups and the
+minimum amount of CpGs, so ui.py caches it per generation of the data.
+
+Not meant to be used on its own, used by ui.py
+"""
+
+from typing import NamedTuple
+import numpy as np
+import scipy.sparse
+import scipy.cluster.hierarchy
+import gene_ranking as gr
+
+
+class SampleOverview(NamedTuple):
+    """Coordinates and clusters of the samples"""
+    samples: tuple[str, ...]
+    coordinates: np.ndarray
+    explained: np.ndarray
+    linkage: np.ndarray
+    clusters: np.ndarray
+    regions: int
+
+
+def sample_matrix(ranking: gr.GeneRanking, chromosomes: list[str] | tuple = (),
+                  groups: list[str] | tuple = (), min_cpgs: int = 1,
+                  min_samples: int = 2) -> tuple[scipy.sparse.csr_matrix, tuple[str, ...]]:
+    """Puts the centered mean fraction of every promoter and sample in a sparse matrix
+
+    Parameters
+    ----------
+    ranking : gr.GeneRanking
+            Ranking of the promoter regions, build_gene_ranking of the sums
+            of gene_ranking.region_bed, or read_gene_ranking
+    chromosomes : list
+            Only promoters on these chromosomes, all when empty
+    groups : list
+            Only these samples, all when empty
+    min_cpgs : int
+            A promoter is measured in a sample when it has at least this amount of CpGs
+    min_samples : int
+            Only promoters that are measured in at least this amount of samples
+
+    Returns
+    -------
+    tuple
+        Samples by promoters matrix, with only the measured values stored,
+        and the names of the samples
+    """
+    columns = ([ranking.samples.index(group) for group in groups if group in ranking.samples]
+               if groups else list(range(len(ranking.samples))))
+    samples = tuple(ranking.samples[column] for column in columns)
+    counts = np.asarray(ranking.counts[:, columns], dtype=np.float64)
+    measured = counts >= max(min_cpgs, 1)
+    keep = measured.sum(axis=1) >= min_samples
+    if chromosomes:
+        keep &= ranking.genes["chr"].is_in(list(chromosomes)).to_numpy()
+    rows = np.flatnonzero(keep)
+
+    counts, measured = counts[rows], measured[rows]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fracs = np.where(measured, np.asarray(ranking.frac_sum[:, columns])[rows] / counts, 0.0)
+    means = fracs.sum(axis=1) / np.maximum(measured.sum(axis=1), 1)
+    regions, sample_columns = np.nonzero(measured)
+    values = fracs[regions, sample_columns] - means[regions]
+    return scipy.sparse.csr_matrix((values, (sample_columns, regions)),
+                                   shape=(len(samples), rows.size)), samples
+
+
+def randomized_pca(matrix: scipy.sparse.csr_matrix, components: int = 3,
+                   oversamples: int = 10, iterations: int = 4,
+                   seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Randomized PCA of a centered matrix (Halko, Martinsson and Tropp)
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+            Samples by features, every feature centered
+    components : int
+            Amount of components
+    oversamples : int
+            Extra random directions, makes the first components more precise
+    iterations : int
+            Power iterations, needed when the variance is spread over many components
+    seed : int
+            Seed of the random directions, so the same data gives the same plot
+
+    Returns
+    -------
+    tuple
+        Coordinates of the samples (samples by components)
+        and the fraction of the variance of every component
+    """
+    n_samples, n_features = matrix.shape
+    rank = min(components + oversamples, n_samples, n_features)
+    components = min(components, rank)
+    sketch = matrix @ np.random.default_rng(seed).standard_normal((n_features, rank))
+    for _ in range(iterations):
+        sketch, _ = np.linalg.qr(sketch)
+        sketch = matrix @ (matrix.T @ sketch)
+    basis, _ = np.linalg.qr(sketch)
+    left, singular, _ = np.linalg.svd(np.asarray((matrix.T @ basis).T), full_matrices=False)
+
+    coordinates = (basis @ left[:, :components]) * singular[:components]
+    # The sign of a component is arbitrary, the sample furthest out is made positive
+    furthest = np.abs(coordinates).argmax(axis=0)
+    coordinates *= np.where(coordinates[furthest, np.arange(components)] < 0, -1, 1)
+    total = matrix.multiply(matrix).sum()
+    explained = singular[:components] ** 2 / total if total else np.zeros(components)
+    return coordinates, explained
+
+
+def sample_overview(ranking: gr.GeneRanking, chromosomes: list[str] | tuple = (),
+                    groups: list[str] | tuple = (), min_cpgs: int = 1,
+                    components: int = 3, clusters: int = 3) -> SampleOverview | None:
+    """Computes the PCA and the clusters of the samples
+
+    Parameters
+    ----------
+    ranking : gr.GeneRanking
+            Ranking of the promoter regions, build_gene_ranking of the sums
+            of gene_ranking.region_bed, or read_gene_ranking
+    chromosomes : list
+            Only promoters on these chromosomes, all when empty
+    groups : list
+            Only these samples, all when empty
+    min_cpgs : int
+            A promoter is measured in a sample when it has at least this amount of CpGs
+    components : int
+            Amount of components
+    clusters : int
+            Amount of clusters the samples are split in
+
+    Returns
+    -------
+    SampleOverview or None
+        The overview, None with less than 3 samples or 2 promoters to compare
+    """
+    matrix, samples = sample_matrix(ranking, chromosomes, groups, min_cpgs)
+    if matrix.shape[0] < 3 or matrix.shape[1] < 2:
+        return None
+    coordinates, explained = randomized_pca(matrix, components)
+    linkage = scipy.cluster.hierarchy.linkage(coordinates, method="ward")
+    labels = scipy.cluster.hierarchy.fcluster(linkage, t=min(clusters, len(samples)),
+                                              criterion="maxclust")
+    return SampleOverview(samples, coordinates, explained, linkage, labels, matrix.shape[1])
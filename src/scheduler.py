@@ -0,0 +1,227 @@
+"""
+scheduler.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Admission control for the heavy work of the website (filtering and plotting).
+Every query gets a cost, the amount of rows it touches (estimated with the block index).
+Cheap queries run right away, heavy queries need one of the heavy slots of the worker.
+When all slots are taken, heavy queries wait in a queue that takes turns between sessions,
+so one user with many big selections can not push everyone else back.
+The queue is bounded, and queries that wait too long are turned down,
+this keeps the waiting time bounded instead of every query getting slower.
+
+The worker processes do not share the scheduler, so the budget is split over them:
+by default every worker gets cpus / num_procs polars threads and heavy slots.
+
+Settings go in the config.ini:
+[SCHEDULER]
+num_procs = 60
+cpus = 64
+polars_threads = 1
+panel_threads = 30
+heavy_slots = 1
+heavy_rows = 1000000
+max_queue = 8
+queue_timeout = 20
+
+Not meant to be used on its own, used by ui.py
+"""
+
+import os
+import time
+import logging
+import threading
+import configparser
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import instrumentation as instr
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerBusy(RuntimeError):
+    """Raised when a query is turned down because the worker is too busy"""
+
+
+def scheduler_settings(config: configparser.ConfigParser) -> dict:
+    """Reads the scheduler settings from the config
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the scheduler settings
+
+    Returns
+    -------
+    dict
+        polars_threads, panel_threads, heavy_slots, heavy_rows, max_queue and queue_timeout
+
+    """
+    num_procs = max(config.getint("SCHEDULER", "num_procs", fallback=1), 1)
+    cpus = config.getint("SCHEDULER", "cpus", fallback=os.cpu_count() or 1)
+    cpus_per_worker = max(cpus // num_procs, 1)
+    polars_threads = config.getint("SCHEDULER", "polars_threads", fallback=cpus_per_worker)
+    return {"polars_threads": polars_threads,
+            "panel_threads": config.getint("SCHEDULER", "panel_threads", fallback=30),
+            "heavy_slots": config.getint("SCHEDULER", "heavy_slots",
+                                         fallback=max(cpus_per_worker // polars_threads, 1)),
+            "heavy_rows": config.getint("SCHEDULER", "heavy_rows", fallback=1_000_000),
+            "max_queue": config.getint("SCHEDULER", "max_queue", fallback=8),
+            "queue_timeout": config.getfloat("SCHEDULER", "queue_timeout", fallback=20.0)}
+
+
+def configure_threads(settings: dict) -> None:
+    """Limits the polars thread pool of this worker
+
+    Polars starts its thread pool on the first query, so this has to be called
+    before any data is read. The POLARS_MAX_THREADS environment variable wins
+    when it was set already.
+
+    Parameters
+    ----------
+    settings : dict
+            Scheduler settings, from scheduler_settings
+
+    Returns
+    -------
+    None
+
+    """
+    os.environ.setdefault("POLARS_MAX_THREADS", str(settings["polars_threads"]))
+    import polars as pl
+    if pl.thread_pool_size() != int(os.environ["POLARS_MAX_THREADS"]):
+        logger.warning("polars already uses %s threads, POLARS_MAX_THREADS was set too late",
+                       pl.thread_pool_size())
+
+
+class Scheduler:
+    """Gives out the heavy slots of a worker, taking turns between sessions"""
+
+    def __init__(self, heavy_slots: int, heavy_rows: int,
+                 max_queue: int = 8, queue_timeout: float = 20.0):
+        """Creates a scheduler with all slots free
+
+        Parameters
+        ----------
+        heavy_slots : int
+                Amount of heavy queries that can run at the same time
+        heavy_rows : int
+                Queries that touch more rows than this are heavy
+        max_queue : int
+                Max amount of waiting heavy queries, more are turned down
+        queue_timeout : float
+                Max seconds a heavy query waits before it is turned down
+
+        """
+        self.heavy_slots = heavy_slots
+        self.heavy_rows = heavy_rows
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self._condition = threading.Condition()
+        # session -> waiting tickets, the first session is next in line
+        self._queues: OrderedDict = OrderedDict()
+        self._waiting = 0
+
+    def _next_ticket(self):
+        """Gets the ticket that may run next, the oldest one of the first session"""
+        if not self._queues:
+            return None
+        return self._queues[next(iter(self._queues))][0]
+
+    def _remove_ticket(self, session, ticket, rotate: bool = True) -> None:
+        """Takes a ticket out of the queue, with rotate the session goes to the back of the line"""
+        queue = self._queues[session]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[session]
+        elif rotate:
+            self._queues.move_to_end(session)
+        self._waiting -= 1
+
+    @contextmanager
+    def admit(self, cost: int, session="default"):
+        """Waits until a query may run
+
+        Parameters
+        ----------
+        cost : int
+                Amount of rows the query touches
+        session : hashable
+                Session that asks, sessions take turns in the queue
+
+        Raises
+        ------
+        SchedulerBusy
+            When the queue is full or the query waited longer than queue_timeout
+
+        """
+        if cost <= self.heavy_rows:
+            instr.increment("methylation_scheduler_requests_total", result="light")
+            yield
+            return
+
+        ticket = object()
+        start = time.perf_counter()
+        with self._condition:
+            must_wait = self.running >= self.heavy_slots or bool(self._queues)
+            if must_wait and self._waiting >= self.max_queue:
+                instr.increment("methylation_scheduler_requests_total", result="rejected")
+                raise SchedulerBusy(f"{self._waiting} queries are already waiting")
+            self._queues.setdefault(session, deque()).append(ticket)
+            self._waiting += 1
+
+            deadline = start + self.queue_timeout
+            while not (self.running < self.heavy_slots and self._next_ticket() is ticket):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._remove_ticket(session, ticket, rotate=False)
+                    self._condition.notify_all()
+                    instr.increment("methylation_scheduler_requests_total", result="timeout")
+                    raise SchedulerBusy(f"waited {self.queue_timeout}s for a free slot")
+                self._condition.wait(remaining)
+
+            self._remove_ticket(session, ticket)
+            self.running += 1
+            self._condition.notify_all()
+
+        instr.observe("scheduler.wait", time.perf_counter() - start)
+        instr.increment("methylation_scheduler_requests_total", result="admitted")
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.running -= 1
+                self._condition.notify_all()
+
+    def __len__(self) -> int:
+        return self._waiting
+
+
+_scheduler: Scheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(settings: dict) -> Scheduler:
+    """Gets the scheduler of this worker process, creates it the first time
+
+    Parameters
+    ----------
+    settings : dict
+            Scheduler settings, from scheduler_settings
+
+    Returns
+    -------
+    Scheduler
+        The scheduler shared by all sessions
+
+    """
+    global _scheduler  # pylint: disable=global-statement
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(settings["heavy_slots"], settings["heavy_rows"],
+                                   settings["max_queue"], settings["queue_timeout"])
+        return _scheduler
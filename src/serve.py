@@ -0,0 +1,81 @@
+"""
+serve.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Starts the website, loading the data only once for all workers.
+The data is read, sorted and indexed here and written as a snapshot (see dataset.py),
+then this process is replaced by panel serve, which forks the workers.
+Every worker memory maps the snapshot, so the workers share one copy of the data
+and start without reading the data files.
+
+The data is not kept in this process to be shared by forking, polars can not be used
+in a forked child after its thread pool was started, so the snapshot is used instead.
+Every argument after -- is passed on to panel serve.
+
+run:
+python3 src/serve.py --port 5100 --num-procs 60 -- --allow-websocket-origin='*' --reuse-sessions --global-loading-spinner
+python3 src/serve.py --api --port 5100 --num-procs 60
+"""
+
+import os
+import sys
+import argparse
+import core
+import dataset as ds
+
+SRC_FOLDER: str = os.path.dirname(os.path.abspath(__file__))
+
+
+def panel_command(args: argparse.Namespace, extra: list[str]) -> list[str]:
+    """Creates the panel serve command
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+            Arguments of the launcher
+    extra : list
+            Arguments for panel serve
+
+    Returns
+    -------
+    list
+        The command
+    """
+    command = [sys.executable, "-m", "panel", "serve", os.path.join(SRC_FOLDER, "ui.py"),
+               "--port", str(args.port), "--num-procs", str(args.num_procs)]
+    if args.api:
+        command += ["--plugins", "api"]
+    return command + extra
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(description="Load the data once, then start the workers")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--num-procs", type=int, default=60)
+    parser.add_argument("--api", action="store_true", help="serve the query api too")
+    parser.add_argument("--reuse-snapshot", action="store_true",
+                        help="do not rebuild an up to date snapshot")
+    args, extra = parser.parse_known_args()
+    extra = [argument for argument in extra if argument != "--"]
+
+    config = core.parse_config()
+    if args.reuse_snapshot and ds.read_snapshot(config) is not None:
+        print(f"Using the snapshot in {ds.snapshot_folder(config)}")
+    else:
+        folder = ds.write_snapshot(ds.build_dataset(config), config)
+        print(f"Wrote the snapshot to {folder}")
+
+    # Workers import the modules in src, also the api plugin
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [SRC_FOLDER, os.environ.get("PYTHONPATH")]))
+    command = panel_command(args, extra)
+    sys.stdout.flush()
+    os.execv(command[0], command)
+
+
+if __name__ == "__main__":
+    main()
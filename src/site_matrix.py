@@ -0,0 +1,218 @@
+"""
+site_matrix.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Wide version of the main data, for comparisons between groups.
+Every CpG is a row and every group (sample) a column, with a plane for the
+methylation fraction and a plane for the coverage. The positions are stored once,
+instead of once per group like in the main data.
+The planes are stored column by column, so reading the columns of a few groups
+only touches their part of the memory mapped file.
+
+A CpG without reads in a group has coverage 0 and fraction NaN.
+The matrix is part of the shared snapshot (see dataset.py), for the memory backend,
+and is used by the differential methylation tab.
+
+Settings go in the config.ini:
+[DATASET]
+site_matrix = true
+
+Not meant to be used on its own
+"""
+
+import os
+import json
+from typing import NamedTuple
+import numpy as np
+import polars as pl
+import core
+
+SITE_KEYS: list[str] = ["chr", "start", "end"]
+
+
+class SiteMatrix(NamedTuple):
+    """CpGs by samples, with a fraction and a coverage plane"""
+    sites: pl.DataFrame
+    samples: tuple[str, ...]
+    frac: np.ndarray
+    valid: np.ndarray
+
+
+def build_site_matrix(df: pl.DataFrame) -> SiteMatrix:
+    """Aligns the CpGs of all groups
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Main analysis data
+
+    Returns
+    -------
+    SiteMatrix
+        The CpGs sorted on chr and start, the groups sorted on name,
+        and the planes in column major order
+
+    """
+    sites = df.select(SITE_KEYS).unique().sort(SITE_KEYS)
+    samples = tuple(sorted(df["group_name"].unique().to_list()))
+    cells = (df.lazy()
+             .join(sites.lazy().with_row_index("site"), on=SITE_KEYS)
+             .group_by(["site", "group_name"])
+             .agg((pl.col("frac") * pl.col("valid")).sum().alias("methylated"),
+                  pl.col("valid").sum())
+             .with_columns(pl.col("group_name")
+                           .replace_strict(list(samples), list(range(len(samples))),
+                                           return_dtype=pl.UInt32).cast(pl.UInt32).alias("sample"))
+             .collect())
+
+    shape = (sites.height, len(samples))
+    frac = np.full(shape, np.nan, dtype=np.float64, order="F")
+    valid = np.zeros(shape, dtype=np.uint32, order="F")
+    rows, columns = cells["site"].to_numpy(), cells["sample"].to_numpy()
+    coverage = cells["valid"].to_numpy()
+    valid[rows, columns] = coverage
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frac[rows, columns] = cells["methylated"].to_numpy() / coverage
+    return SiteMatrix(sites, samples, frac, valid)
+
+
+def write_site_matrix(matrix: SiteMatrix, folder: str) -> None:
+    """Writes the matrix, the planes as .npy files so they can be memory mapped
+
+    Every file is written next to its final name first and then renamed.
+
+    Parameters
+    ----------
+    matrix : SiteMatrix
+            From build_site_matrix
+    folder : str
+            Folder to write to
+    """
+    os.makedirs(folder, exist_ok=True)
+    temporary = f".{os.getpid()}"
+    matrix.sites.write_ipc(os.path.join(folder, "sites.arrow" + temporary),
+                           compression="uncompressed")
+    with open(os.path.join(folder, "frac.npy" + temporary), "wb") as file:
+        np.save(file, matrix.frac)
+    with open(os.path.join(folder, "valid.npy" + temporary), "wb") as file:
+        np.save(file, matrix.valid)
+    with open(os.path.join(folder, "samples.json" + temporary), mode="w",
+              encoding="utf-8") as file:
+        json.dump(list(matrix.samples), file)
+    for name in ("sites.arrow", "frac.npy", "valid.npy", "samples.json"):
+        os.replace(os.path.join(folder, name + temporary), os.path.join(folder, name))
+
+
+def read_site_matrix(folder: str) -> SiteMatrix:
+    """Memory maps a matrix written by write_site_matrix
+
+    Parameters
+    ----------
+    folder : str
+            Folder the matrix was written to
+
+    Returns
+    -------
+    SiteMatrix
+        The matrix, with read only planes
+    """
+    with open(os.path.join(folder, "samples.json"), encoding="utf-8") as file:
+        samples = tuple(json.load(file))
+    return SiteMatrix(pl.read_ipc(os.path.join(folder, "sites.arrow"), memory_map=True),
+                      samples,
+                      np.load(os.path.join(folder, "frac.npy"), mmap_mode="r"),
+                      np.load(os.path.join(folder, "valid.npy"), mmap_mode="r"))
+
+
+def site_mask(sites: pl.DataFrame, spec: core.FilterSpec) -> np.ndarray:
+    """Selects the CpGs of the chromosome and range filters of a spec
+
+    Parameters
+    ----------
+    sites : pl.DataFrame
+            The CpGs of the matrix
+    spec : core.FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask over the CpGs
+    """
+    keep = pl.lit(True)
+    if spec.chromosomes:
+        keep &= pl.col("chr").is_in(spec.chromosomes)
+    # The same as core.apply_filter_spec
+    keep &= core.range_expr(spec.min_range, spec.max_range)
+    return sites.with_columns(keep.alias("keep"))["keep"].to_numpy()
+
+
+def set_counts(matrix: SiteMatrix, rows: np.ndarray, groups: list[str],
+               spec: core.FilterSpec, suffix: str) -> dict[str, np.ndarray]:
+    """Sums the methylated and valid reads of a set of groups for every CpG
+
+    Reads that fail the coverage or fraction filter of the spec are not counted.
+
+    Parameters
+    ----------
+    matrix : SiteMatrix
+            From build_site_matrix or read_site_matrix
+    rows : np.ndarray
+            Indices of the CpGs to count
+    groups : list
+            Group names in the set
+    spec : core.FilterSpec
+            The filters to apply
+    suffix : str
+            Added to the names, A or B
+
+    Returns
+    -------
+    dict
+        methylated, coverage and samples of every CpG, as numpy arrays
+    """
+    columns = [matrix.samples.index(group) for group in groups if group in matrix.samples]
+    valid = np.asarray(matrix.valid[:, columns])[rows].astype(np.float64)
+    frac = np.asarray(matrix.frac[:, columns])[rows]
+    present = valid > 0
+    if spec.min_coverage:
+        present &= valid >= spec.min_coverage
+    if spec.frac_range is not None:
+        with np.errstate(invalid="ignore"):
+            present &= (frac >= spec.frac_range[0]) & (frac <= spec.frac_range[1])
+    valid = np.where(present, valid, 0.0)
+    return {f"methylated {suffix}": np.where(present, frac * valid, 0.0).sum(axis=1),
+            f"coverage {suffix}": valid.sum(axis=1),
+            f"samples {suffix}": present.sum(axis=1).astype(np.uint32)}
+
+
+def site_counts(matrix: SiteMatrix, spec: core.FilterSpec, groups_a: list[str],
+                groups_b: list[str]) -> pl.DataFrame:
+    """Counts both sets for every CpG, the same as differential.chromosome_counts
+
+    Parameters
+    ----------
+    matrix : SiteMatrix
+            From build_site_matrix or read_site_matrix
+    spec : core.FilterSpec
+            The filters to apply, the group and gene filters are not used
+    groups_a : list
+            Group names of set A
+    groups_b : list
+            Group names of set B
+
+    Returns
+    -------
+    pl.DataFrame
+        Per CpG read counts of both sets, of the CpGs with reads in both sets
+    """
+    rows = np.flatnonzero(site_mask(matrix.sites, spec))
+    counts = (set_counts(matrix, rows, groups_a, spec, "A") |
+              set_counts(matrix, rows, groups_b, spec, "B"))
+    covered = (counts["coverage A"] > 0) & (counts["coverage B"] > 0)
+    return pl.concat([matrix.sites[rows[covered]],
+                      pl.DataFrame({name: values[covered] for name, values in counts.items()})],
+                     how="horizontal")
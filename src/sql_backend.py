@@ -0,0 +1,317 @@
+"""
+sql_backend.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Optional query backend on DuckDB, an embedded SQL engine.
+Every version of the data is registered as three tables:
+methylation     the CpGs, the Parquet files of the region store with the indexed backend,
+                or the main data, converted to arrow once per worker, with the memory backend
+promoters       the annotated bed (chr, start, end, gene_name)
+groups          the groups and barcodes of the group_data csv
+
+The filters of the website are built as SQL (filter_chr, filter_group, filter_ranges,
+filter_genes and count_methylation_data, the same names as in core.py) and give the same rows.
+The gene filter is a range join of the CpGs on the promoters, planned by DuckDB.
+When a query needs more memory than memory_limit, DuckDB spills to temp_directory,
+so queries can be larger than the memory.
+Analysts can run their own SQL over the same tables with SqlEngine.query.
+
+Needs the duckdb package (pip install duckdb), the website works without it.
+
+Settings go in the config.ini:
+[DATASET]
+# polars (default) or duckdb
+query_engine = duckdb
+
+[DUCKDB]
+memory_limit = 4GB
+temp_directory = /tmp/methylation_duckdb
+# threads of one query, defaults to the polars threads of the worker
+threads = 4
+
+Not meant to be used on its own, used by ui.py and api.py
+"""
+
+import os
+import logging
+import tempfile
+import threading
+import configparser
+from typing import NamedTuple
+import polars as pl
+import core
+import instrumentation as instr
+
+logger = logging.getLogger(__name__)
+
+_engines: dict[str, "SqlEngine"] = {}
+_engines_lock = threading.Lock()
+
+
+class Query(NamedTuple):
+    """SQL text with its named parameters, filters wrap it in a new query"""
+    sql: str = "SELECT * FROM methylation"
+    parameters: dict = {}
+
+
+def query_engine(config: configparser.ConfigParser) -> str:
+    """Gets the engine that runs the filters, polars or duckdb"""
+    return config.get("DATASET", "query_engine", fallback="polars").lower()
+
+
+def add_parameter(query: Query, value) -> tuple[str, dict]:
+    """Adds a parameter with a name that is not used in the query yet
+
+    Parameters
+    ----------
+    query : Query
+            Query the parameter is added to
+    value : any
+            Value of the parameter
+
+    Returns
+    -------
+    tuple
+        The placeholder to put in the sql ($p0, $p1, ...) and the new parameters
+
+    """
+    name = f"p{len(query.parameters)}"
+    return f"${name}", query.parameters | {name: value}
+
+
+def filter_chr(chr_list: list[str], query: Query) -> Query:
+    """Filters the query on chromosomes, see core.filter_chr"""
+    placeholder, parameters = add_parameter(query, list(chr_list))
+    return Query(f"SELECT * FROM ({query.sql}) WHERE list_contains({placeholder}, chr)",
+                 parameters)
+
+
+def filter_group(group_list: list[str], query: Query) -> Query:
+    """Filters the query on groups, see core.filter_group"""
+    placeholder, parameters = add_parameter(query, list(group_list))
+    return Query(f"SELECT * FROM ({query.sql}) WHERE list_contains({placeholder}, group_name)",
+                 parameters)
+
+
+def filter_ranges(min_range: int, max_range: int, query: Query) -> Query:
+    """Filters the query on a start-end range, a bound of 0 is not set, see core.filter_ranges"""
+    conditions = []
+    if min_range:
+        low, parameters = add_parameter(query, int(min_range))
+        query = query._replace(parameters=parameters)
+        conditions.append(f"start >= {low}")
+    if max_range:
+        high, parameters = add_parameter(query, int(max_range))
+        query = query._replace(parameters=parameters)
+        conditions.append(f'"end" <= {high}')
+    if not conditions:
+        return query
+    return Query(f"SELECT * FROM ({query.sql}) WHERE {' AND '.join(conditions)}",
+                 query.parameters)
+
+
+def filter_coverage(min_coverage: int, query: Query) -> Query:
+    """Filters the query on coverage, see core.filter_coverage"""
+    placeholder, parameters = add_parameter(query, int(min_coverage))
+    return Query(f"SELECT * FROM ({query.sql}) WHERE valid >= {placeholder}", parameters)
+
+
+def filter_frac(min_frac: float, max_frac: float, query: Query) -> Query:
+    """Filters the query on methylation fraction, see core.filter_frac"""
+    low, parameters = add_parameter(query, float(min_frac))
+    high, parameters = add_parameter(query._replace(parameters=parameters), float(max_frac))
+    return Query(f"SELECT * FROM ({query.sql}) WHERE frac BETWEEN {low} AND {high}",
+                 parameters)
+
+
+def filter_genes(gene_list: list[str], query: Query) -> Query:
+    """Filters the query on the promoters of genes, see core.filter_genes
+
+    A range join on the promoters table, a CpG is returned once
+    for every wanted gene with a promoter around it.
+
+    Parameters
+    ----------
+    gene_list : list
+            A list containing genes the user wants to see
+    query : Query
+            Query of the methylation data
+
+    Returns
+    -------
+    Query
+        The CpGs in the promoters, with the gene_name added
+
+    """
+    placeholder, parameters = add_parameter(query, list(gene_list))
+    return Query(f"""SELECT data.*, promoter.gene_name
+                     FROM ({query.sql}) AS data
+                     JOIN (SELECT chr, start, "end", gene_name FROM promoters
+                           WHERE list_contains({placeholder}, gene_name)) AS promoter
+                     ON data.chr = promoter.chr
+                     AND data.start >= promoter.start AND data."end" <= promoter."end"
+                  """, parameters)
+
+
+def count_methylation_data(query: Query) -> Query:
+    """Counts the CpGs per group, see core.count_methylation_data"""
+    return Query(f'SELECT group_name, count(*)::UINTEGER AS "n methylations" FROM ({query.sql}) '
+                 "GROUP BY group_name", query.parameters)
+
+
+def filter_plan(spec: core.FilterSpec) -> Query:
+    """Builds the query of every filter of a filter spec, see core.filter_plan
+
+    Parameters
+    ----------
+    spec : core.FilterSpec
+            The filters to apply
+
+    Returns
+    -------
+    Query
+        The methylation data filtered on the spec
+
+    """
+    query = Query()
+    if spec.chromosomes:
+        query = filter_chr(list(spec.chromosomes), query)
+    if spec.groups:
+        query = filter_group(list(spec.groups), query)
+    if spec.min_coverage:
+        query = filter_coverage(spec.min_coverage, query)
+    if spec.frac_range is not None:
+        query = filter_frac(spec.frac_range[0], spec.frac_range[1], query)
+    if spec.genes:
+        query = filter_genes(list(spec.genes), query)
+    if spec.min_range or spec.max_range:
+        query = filter_ranges(spec.min_range, spec.max_range, query)
+    return query
+
+
+class SqlEngine:
+    """DuckDB database over one version of the data
+
+    A DuckDB connection can run one query at a time, so every thread
+    gets its own connection to the same database.
+    """
+
+    def __init__(self, dataset: dict, config: configparser.ConfigParser | None = None):
+        """Opens the database and sets the memory limit and spill folder
+
+        Parameters
+        ----------
+        dataset : dict
+                The data, from dataset.get_dataset or dataset.build_dataset
+        config : ConfigParser
+                Contains the [DUCKDB] settings and the path of the group data
+        """
+        try:
+            import duckdb
+        except ImportError as error:
+            raise ImportError("query_engine = duckdb needs the duckdb package, "
+                              "pip install duckdb") from error
+        config = config if config is not None else configparser.ConfigParser()
+        settings = {"memory_limit": config.get("DUCKDB", "memory_limit", fallback=None),
+                    "temp_directory": config.get(
+                        "DUCKDB", "temp_directory",
+                        fallback=os.path.join(tempfile.gettempdir(), "methylation_duckdb")),
+                    "threads": config.getint("DUCKDB", "threads",
+                                             fallback=pl.thread_pool_size())}
+        self.database = duckdb.connect(":memory:", config={name: value for name, value
+                                                            in settings.items()
+                                                            if value is not None})
+
+        if dataset["main_data"] is not None:
+            self.schema = dict(dataset["main_data"].schema)
+            # Converted once per worker, DuckDB scans the arrow table and does not load it.
+            # The number columns keep the memory of the main data, to_arrow would copy
+            # chr and group_name to large_string, they go as categoricals
+            # (a small dictionary and a code per row)
+            self.tables = {"methylation": dataset["main_data"]
+                           .with_columns(pl.col(["chr", "group_name"]).cast(pl.Categorical))
+                           .to_arrow()}
+            self.views = {}
+        else:
+            paths = dataset["block_index"]["path"].drop_nulls().unique().sort().to_list()
+            self.schema = (dict(pl.scan_parquet(paths[0]).collect_schema()) if paths
+                           else dict(core.READ_SCHEMA))
+            self.tables = {} if paths else {
+                "methylation": pl.DataFrame(schema=core.READ_SCHEMA).to_arrow()}
+            files = ", ".join("'{}'".format(path.replace("'", "''")) for path in paths)
+            self.views = {"methylation": f"SELECT * FROM read_parquet([{files}])"} if paths else {}
+        self.tables["promoters"] = dataset["annotated_bed"].to_arrow()
+        if config.has_option("PATHS", "group_data"):
+            try:
+                self.tables["groups"] = core.process_groups(config).to_arrow()
+            except (FileNotFoundError, pl.exceptions.ColumnNotFoundError):
+                logger.warning("No groups table, the group data could not be read")
+        self.local = threading.local()
+
+    def connection(self):
+        """Gets the connection of this thread, with the tables registered"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.database.cursor()
+            for name, table in self.tables.items():
+                connection.register(name, table)
+            for name, sql in self.views.items():
+                connection.execute(f"CREATE TEMP VIEW {name} AS {sql}")
+            self.local.connection = connection
+        return connection
+
+    def query(self, sql: str, parameters: dict | list | None = None) -> pl.DataFrame:
+        """Runs any SQL over the methylation, promoters and groups tables
+
+        Parameters
+        ----------
+        sql : str
+                The query
+        parameters : dict or list
+                Values of the $name or ? placeholders
+
+        Returns
+        -------
+        pl.DataFrame
+            The result, columns of the methylation table get their polars types back
+        """
+        with instr.span("sql_query") as record:
+            result = self.connection().execute(sql, parameters).pl()
+            record["rows_out"] = result.height
+        return result.cast({name: dtype for name, dtype in self.schema.items()
+                            if name in result.columns and result.schema[name] != dtype})
+
+    def run(self, query: Query) -> pl.DataFrame:
+        """Runs a query built by the filters of this module"""
+        return self.query(query.sql, query.parameters)
+
+    def apply_filter_spec(self, spec: core.FilterSpec) -> pl.DataFrame:
+        """Applies every filter of a filter spec, see core.apply_filter_spec"""
+        return self.run(filter_plan(spec))
+
+
+def get_engine(dataset: dict, config: configparser.ConfigParser) -> SqlEngine:
+    """Gets the engine of a version of the data, made once per worker
+
+    Parameters
+    ----------
+    dataset : dict
+            The data, from dataset.get_dataset
+    config : ConfigParser
+            Contains the [DUCKDB] settings
+
+    Returns
+    -------
+    SqlEngine
+        Engine over the tables of the data
+    """
+    key = dataset.get("generation", "")
+    with _engines_lock:
+        if key not in _engines:
+            # Older versions of the data are not queried by new sessions
+            _engines.clear()
+            _engines[key] = SqlEngine(dataset, config)
+        return _engines[key]
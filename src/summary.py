@@ -0,0 +1,126 @@
+"""
+summary.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Computes summary statistics of the methylation data.
+For every group, chromosome and (if the data is filtered on genes) gene
+it calculates the amount of CpGs, the coverage weighted methylation fraction,
+quantiles of the fraction and the coverage distribution.
+Everything is calculated in one group_by, so it also works on whole genome selections.
+Selections answered from tiles get the statistics that follow from the sums of the tiles.
+
+Not meant to be used on its own, used by ui.py
+"""
+
+import polars as pl
+
+QUANTILES: tuple[float, ...] = (0.25, 0.5, 0.75)
+
+
+def summary_keys(df: pl.DataFrame | pl.LazyFrame) -> list[str]:
+    """Gets the columns to summarise on
+
+    Parameters
+    ----------
+    df : pl.DataFrame or pl.LazyFrame
+            Dataframe (or plan) that contains the methylation data
+
+    Returns
+    -------
+    list
+        group_name and chr, with gene_name if the data has genes
+
+    """
+    keys = ["group_name", "chr"]
+    if "gene_name" in df.collect_schema().names():
+        keys.append("gene_name")
+    return keys
+
+
+def summary_expressions() -> list[pl.Expr]:
+    """Creates the expressions of the summary
+
+    Returns
+    -------
+    list
+        polars expressions, to be used in a group_by().agg()
+
+    """
+    frac = pl.col("frac").cast(pl.Float64)
+    valid = pl.col("valid").cast(pl.Float64)
+    expressions = [
+        pl.len().alias("n CpGs"),
+        ((frac * valid).sum() / valid.sum()).alias("weighted mean frac"),
+        frac.mean().alias("mean frac"),
+    ]
+    expressions += [frac.quantile(q, interpolation="linear").alias(f"frac q{int(q * 100)}")
+                    for q in QUANTILES]
+    expressions += [
+        valid.sum().alias("total coverage"),
+        valid.mean().alias("mean coverage"),
+        valid.min().alias("min coverage"),
+    ]
+    expressions += [valid.quantile(q, interpolation="linear").alias(f"coverage q{int(q * 100)}")
+                    for q in QUANTILES]
+    expressions.append(valid.max().alias("max coverage"))
+    return expressions
+
+
+def summarise_tiles(tiles: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame:
+    """Summarises tiles (see tiles.py) instead of CpGs
+
+    Tiles only know the amount of CpGs, the coverage and the methylated reads,
+    so only the statistics that follow from those sums are computed.
+
+    Parameters
+    ----------
+    tiles : pl.DataFrame or pl.LazyFrame
+            Window or promoter tiles, from tiles.query_tiles
+
+    Returns
+    -------
+    pl.DataFrame
+        One row for every group, chromosome (and gene) with n CpGs,
+        weighted mean frac, total coverage and mean coverage
+
+    """
+    keys = summary_keys(tiles)
+    n_cpgs = pl.col("n CpGs").sum()
+    coverage = pl.col("total coverage").sum()
+    return (tiles
+            .lazy()
+            .group_by(keys)
+            .agg(n_cpgs.cast(pl.UInt32).alias("n CpGs"),
+                 (pl.col("methylated reads").sum() / coverage).alias("weighted mean frac"),
+                 coverage.alias("total coverage"),
+                 (coverage / n_cpgs).alias("mean coverage"))
+            .sort(keys)
+            .collect())
+
+
+def summarise_methylation(df: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame:
+    """Summarises the methylation data
+
+    A plan is aggregated without collecting the rows first.
+
+    Parameters
+    ----------
+    df : pl.DataFrame or pl.LazyFrame
+            Dataframe (or plan) that contains the methylation data
+
+    Returns
+    -------
+    pl.DataFrame
+        One row for every group, chromosome (and gene) with its statistics
+
+    """
+    keys = summary_keys(df)
+    return (df
+            .lazy()
+            .group_by(keys)
+            .agg(summary_expressions())
+            .sort(keys)
+            .collect())
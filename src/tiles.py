@@ -0,0 +1,384 @@
+"""
+tiles.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Aggregates the methylation data into tiles, so wide selections
+do not have to drag every CpG through the filters and plots.
+There are fixed window tiles (for example 1 kb, 10 kb ...) and promoter tiles.
+A tile has the amount of CpGs, the total coverage, the methylated reads and
+the coverage weighted methylation fraction, for every group.
+Wide selections are plotted and summarised from the window tiles,
+the summary of a gene selection comes from the promoter tiles.
+The tiles are precomputed once and stored as parquet in the tile_folder,
+with the generation of the data files they were made from (see dataset.generation_of).
+Tiles of another generation are not used, so after a reload of the data
+wide selections use the CpGs until the tiles are made again.
+
+Settings go in the config.ini:
+[PATHS]
+tile_folder = path/to/tiles
+
+[TILES]
+windows = 1000,10000,100000,1000000
+zoom_threshold = 1000000
+max_tiles = 5000
+
+run (precompute the tiles):
+python3 src/tiles.py
+"""
+
+import os
+import json
+import configparser
+import numpy as np
+import polars as pl
+
+
+def tile_settings(config: configparser.ConfigParser) -> dict:
+    """Reads the tile settings from the config
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the tile settings
+
+    Returns
+    -------
+    dict
+        windows, zoom_threshold and max_tiles
+
+    """
+    windows = config.get("TILES", "windows", fallback="1000,10000,100000,1000000")
+    return {"windows": sorted(int(window) for window in windows.split(",")),
+            "zoom_threshold": config.getint("TILES", "zoom_threshold", fallback=1_000_000),
+            "max_tiles": config.getint("TILES", "max_tiles", fallback=5000)}
+
+
+def tile_aggregations() -> list[pl.Expr]:
+    """Creates the expressions every tile is made of
+
+    Returns
+    -------
+    list
+        polars expressions, to be used in a group_by().agg()
+
+    """
+    return [pl.len().alias("n CpGs"),
+            pl.col("valid").cast(pl.Float64).sum().alias("total coverage"),
+            (pl.col("frac").cast(pl.Float64) * pl.col("valid")).sum().alias("methylated reads")]
+
+
+def with_mean_frac(tiles: pl.LazyFrame | pl.DataFrame):
+    """Adds the coverage weighted fraction to tiles
+
+    Parameters
+    ----------
+    tiles : pl.DataFrame or pl.LazyFrame
+            Tiles with total coverage and methylated reads
+
+    Returns
+    -------
+    pl.DataFrame or pl.LazyFrame
+        tiles with a mean frac column
+
+    """
+    return tiles.with_columns(
+        (pl.col("methylated reads") / pl.col("total coverage")).alias("mean frac"))
+
+
+def build_window_tiles(df: pl.DataFrame, window: int) -> pl.DataFrame:
+    """Aggregates the data into fixed size windows
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Main analysis data
+    window : int
+            Size of a window in bases
+
+    Returns
+    -------
+    pl.DataFrame
+        One row for every group, chromosome and window that has CpGs
+
+    """
+    return with_mean_frac(
+        df.lazy()
+        .with_columns(((pl.col("start") // window) * window).alias("tile_start"))
+        .group_by(["chr", "group_name", "tile_start"])
+        .agg(tile_aggregations())
+        .with_columns((pl.col("tile_start") + window).alias("tile_end"))
+        .sort(["chr", "group_name", "tile_start"])
+    ).collect()
+
+
+def build_promoter_tiles(df: pl.DataFrame, annotated_bed: pl.DataFrame) -> pl.DataFrame:
+    """Aggregates the data for every promoter
+
+    A CpG counts for a promoter when it is completely inside of it,
+    the same rule as backend.filter_genes uses.
+    The CpGs are sorted, so the CpGs of a promoter are found with a binary search
+    and the sums come from prefix sums.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Main analysis data
+    annotated_bed : pl.DataFrame
+            Promoter regions (chr, start, end, gene_name)
+
+    Returns
+    -------
+    pl.DataFrame
+        One row for every group and promoter that has CpGs
+
+    """
+    promoters = annotated_bed.partition_by("chr", as_dict=True)
+    frames = []
+    for (chromosome, group), part in (df
+                                      .select(["chr", "group_name", "start", "end", "frac", "valid"])
+                                      .sort(["chr", "group_name", "start"])
+                                      .partition_by(["chr", "group_name"], as_dict=True)
+                                      .items()):
+        chromosome_promoters = promoters.get((chromosome,))
+        if chromosome_promoters is None:
+            continue
+        starts = part["start"].to_numpy()
+        ends = part["end"].to_numpy()
+        first = np.searchsorted(starts, chromosome_promoters["start"].to_numpy(), side="left")
+        if np.any(ends[1:] < ends[:-1]):
+            # Only happens for records longer than a CpG, a record that ends
+            # after a later one cuts the promoter off there
+            ends = np.maximum.accumulate(ends)
+        last = np.maximum(np.searchsorted(ends, chromosome_promoters["end"].to_numpy(),
+                                          side="right"), first)
+
+        coverage = part["valid"].cast(pl.Float64).to_numpy()
+        methylated = part["frac"].cast(pl.Float64).to_numpy() * coverage
+        tile = {"chr": chromosome_promoters["chr"],
+                "group_name": group,
+                "tile_start": chromosome_promoters["start"],
+                "tile_end": chromosome_promoters["end"],
+                "gene_name": chromosome_promoters["gene_name"],
+                "n CpGs": last - first}
+        for column, values in (("total coverage", coverage), ("methylated reads", methylated)):
+            prefix = np.concatenate(([0.0], np.cumsum(values)))
+            tile[column] = prefix[last] - prefix[first]
+        frames.append(pl.DataFrame(tile).filter(pl.col("n CpGs") > 0))
+
+    if not frames:
+        return pl.DataFrame()
+    return with_mean_frac(pl.concat(frames)).sort(["chr", "group_name", "tile_start"])
+
+
+def tile_path(config: configparser.ConfigParser, name: str) -> str:
+    """Gets the path of a tile file
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the tile_folder
+    name : str
+            Name of the tiles, window size or promoters
+
+    Returns
+    -------
+    str
+        Path to the parquet file
+
+    """
+    return os.path.join(config.get("PATHS", "tile_folder"), f"tiles_{name}.parquet")
+
+
+def stamp_path(config: configparser.ConfigParser) -> str:
+    """Gets the path of the file with the generation of the tiles"""
+    return os.path.join(config.get("PATHS", "tile_folder"), "tiles.json")
+
+
+def tile_generation(config: configparser.ConfigParser) -> str | None:
+    """Gets the generation of the data the tiles were made from
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the tile_folder
+
+    Returns
+    -------
+    str or None
+        The generation, None when the tiles were not made (or are being made)
+
+    """
+    try:
+        with open(stamp_path(config), encoding="utf-8") as stamp_file:
+            return json.load(stamp_file).get("generation")
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def precompute_tiles(df: pl.DataFrame, annotated_bed: pl.DataFrame,
+                     config: configparser.ConfigParser, generation: str) -> list[str]:
+    """Builds all tiles and writes them to the tile_folder
+
+    The stamp is removed first and written last,
+    so tiles that are half written are not used.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+            Main analysis data
+    annotated_bed : pl.DataFrame
+            Promoter regions
+    config : ConfigParser
+            Contains the tile_folder and tile settings
+    generation : str
+            Generation of the data files df was read from, see dataset.generation_of
+
+    Returns
+    -------
+    list
+        Paths of the written files
+
+    """
+    os.makedirs(config.get("PATHS", "tile_folder"), exist_ok=True)
+    stamp = stamp_path(config)
+    if os.path.isfile(stamp):
+        os.remove(stamp)
+    written = []
+    for window in tile_settings(config)["windows"]:
+        path = tile_path(config, str(window))
+        build_window_tiles(df, window).write_parquet(path, statistics=True, row_group_size=65536)
+        written.append(path)
+
+    path = tile_path(config, "promoters")
+    build_promoter_tiles(df, annotated_bed).write_parquet(path, statistics=True)
+    written.append(path)
+
+    with open(f"{stamp}.{os.getpid()}", mode="w", encoding="utf-8") as stamp_file:
+        json.dump({"generation": generation}, stamp_file)
+    os.replace(f"{stamp}.{os.getpid()}", stamp)
+    return written
+
+
+def load_tiles(config: configparser.ConfigParser, generation: str) -> dict[str, pl.LazyFrame]:
+    """Opens the precomputed tiles
+
+    The files are scanned lazily, queries only read the row groups they need.
+
+    Parameters
+    ----------
+    config : ConfigParser
+            Contains the tile_folder and tile settings
+    generation : str
+            Generation of the data that is shown, see dataset.generation_of
+
+    Returns
+    -------
+    dict
+        window size (or "promoters") as key, LazyFrame as value.
+        Empty when no tile_folder is configured, the tiles were not made yet
+        or were made from another generation of the data
+
+    """
+    if not config.has_option("PATHS", "tile_folder"):
+        return {}
+    if tile_generation(config) != generation:
+        return {}
+    tiles = {}
+    for name in [str(window) for window in tile_settings(config)["windows"]] + ["promoters"]:
+        path = tile_path(config, name)
+        if os.path.isfile(path):
+            tiles[name] = pl.scan_parquet(path)
+    return tiles
+
+
+def pick_window(span: int, settings: dict, available: dict) -> int | None:
+    """Picks the tile size for a span
+
+    Parameters
+    ----------
+    span : int
+            Width of the requested region in bases
+    settings : dict
+            Tile settings, from tile_settings
+    available : dict
+            Loaded tiles, from load_tiles
+
+    Returns
+    -------
+    int or None
+        The smallest window that keeps the amount of tiles under max_tiles,
+        None if the span is narrow enough to use the raw CpGs
+
+    """
+    if span <= settings["zoom_threshold"]:
+        return None
+    for window in settings["windows"]:
+        if str(window) in available and span / window <= settings["max_tiles"]:
+            return window
+    windows = [window for window in settings["windows"] if str(window) in available]
+    return windows[-1] if windows else None
+
+
+def query_tiles(tiles: pl.LazyFrame, chromosomes: tuple[str, ...], groups: tuple[str, ...],
+                min_range: int = 0, max_range: int = 0,
+                genes: tuple[str, ...] = ()) -> pl.DataFrame:
+    """Gets the tiles of a region
+
+    Tiles that overlap the range are returned, so the edges can stick out a bit.
+    A bound of 0 is not set, the same as in core.filter_ranges.
+
+    Parameters
+    ----------
+    tiles : pl.LazyFrame
+            Tiles of one size
+    chromosomes : tuple
+            Wanted chromosomes, empty for all
+    groups : tuple
+            Wanted groups, empty for all
+    min_range : int
+            Start of the region, 0 for no limit
+    max_range : int
+            End of the region, 0 for no limit
+    genes : tuple
+            Wanted genes, empty for all, only for the promoter tiles
+
+    Returns
+    -------
+    pl.DataFrame
+        The tiles in the region
+
+    """
+    keep = pl.lit(True)
+    if chromosomes:
+        keep &= pl.col("chr").is_in(chromosomes)
+    if groups:
+        keep &= pl.col("group_name").is_in(groups)
+    if min_range:
+        keep &= pl.col("tile_end") > min_range
+    if max_range:
+        keep &= pl.col("tile_start") < max_range
+    if genes:
+        keep &= pl.col("gene_name").is_in(genes)
+    return tiles.filter(keep).collect()
+
+
+def main():
+    """Main"""
+    import core
+    import dataset
+
+    config = core.parse_config()
+    # Taken before reading, files that change while reading give tiles that are not used
+    generation = dataset.generation_of(dataset.source_stamp(config))
+    main_data = core.read_data(config)
+    annotated = core.load_bed_file(config)
+    for path in precompute_tiles(main_data, annotated, config, generation):
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
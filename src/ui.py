@@ -10,24 +10,61 @@ This script creates the ui, and calls functions from backend.py
 
 run:
 panel serve src/ui.py --port=5100 --allow-websocket-origin='*' --num-procs 60 --reuse-sessions --global-loading-spinner
+or, loading the data once for all workers:
+python3 src/serve.py --port 5100 --num-procs 60 -- --allow-websocket-origin='*' --reuse-sessions --global-loading-spinner
 """
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import panel as pn
 import nest_asyncio
 import backend as be
+import instrumentation as instr
+import summary
+import differential
+import site_matrix
+import gene_ranking
+import sample_overview
+import tiles
+import plot_cache
+import scheduler
+import dataset as ds
+import sql_backend
+
+config = be.parse_config()
+scheduler_config = scheduler.scheduler_settings(config)
+# Has to happen before the first polars query starts its thread pool
+scheduler.configure_threads(scheduler_config)
+work_scheduler = scheduler.get_scheduler(scheduler_config)
 
 nest_asyncio.apply()
 pn.extension("plotly", 'mathjax', design="material",
-             sizing_mode="stretch_width", nthreads=30, loading_spinner="dots",
-             loading_color="#2196F3",)
+             sizing_mode="stretch_width", nthreads=scheduler_config["panel_threads"],
+             loading_spinner="dots", loading_color="#2196F3",)
 pn.param.ParamMethod.loading_indicator = True
 
 
-config = be.parse_config()
-main_data = be.read_data(config=config)
-annotated_bed = be.load_bed_file(config=config)
-gene_variation = be.read_variation_genes(config)
+# Loaded once per worker process, from the shared snapshot when serve.py made one.
+# A session keeps the generation it started with, new data is used by new sessions
+shared_data = ds.get_dataset(config)
+generation = shared_data["generation"]
+main_data = shared_data["main_data"]
+block_index = shared_data["block_index"]
+annotated_bed = shared_data["annotated_bed"]
+matrix = shared_data["site_matrix"]
+ranking = shared_data["gene_ranking"]
+region_ranking = shared_data["region_ranking"]
+# Optional, the filters run as SQL in DuckDB instead of polars
+sql_engine = (sql_backend.get_engine(shared_data, config)
+              if sql_backend.query_engine(config) == "duckdb" else None)
+# From the block index, main_data is None with the indexed backend
+data_bounds = be.data_bounds(block_index)
+# Tiles of older data files are not used
+tile_data = tiles.load_tiles(config, generation)
+tile_config = tiles.tile_settings(config)
+max_points = config.getint("PLOTS", "max_points", fallback=200_000)
+aggregate_rows = config.getint("PLOTS", "aggregate_rows", fallback=10 * max_points)
+max_table_rows = config.getint("PLOTS", "max_table_rows", fallback=10_000)
+instr.start_metrics_server(config)
 
 
 def create_settings():
@@ -47,11 +84,9 @@ def create_settings():
                         This box contains all the settings made in this function.
 
     """
-    chr_select = pn.widgets.MultiChoice(options=main_data["chr"]
-                                        .unique().to_list(), name="chromosome:")
-    group_select = pn.widgets.MultiChoice(options=main_data["group_name"]
-                                          .unique().to_list(), name="group:")
-    highest_start = main_data.select("start").max().item()
+    chr_select = pn.widgets.MultiChoice(options=data_bounds["chromosomes"], name="chromosome:")
+    group_select = pn.widgets.MultiChoice(options=data_bounds["groups"], name="group:")
+    highest_start = data_bounds["start_max"]
     min_range = pn.widgets.IntInput(name="range start",
                                     start=0,
                                     end=highest_start)
@@ -64,21 +99,57 @@ def create_settings():
                                        max_items=5,
                                        option_limit=10)
 
-    amount_rows_variation_file = gene_variation.with_row_index().select("index").max().item()
-    name_top_genes_count = f"top x genes to display\n ({amount_rows_variation_file})"
+    amount_genes = ranking.genes.height
+    name_top_genes_count = f"top x genes to display\n ({amount_genes})"
     top_genes_count = pn.widgets.IntInput(name=name_top_genes_count,
                                           value=20,
-                                          end=amount_rows_variation_file, start=1)
+                                          end=max(amount_genes, 1), start=1)
+
+    min_coverage = pn.widgets.IntInput(name="min coverage (valid reads)",
+                                       value=0, start=0,
+                                       end=data_bounds["valid_max"])
+    highest_frac = max(data_bounds["frac_max"], 1)
+    frac_range = pn.widgets.RangeSlider(name="methylation fraction",
+                                        start=0, end=highest_frac,
+                                        value=(0, highest_frac), step=0.01)
+
+    groups_a = pn.widgets.MultiChoice(options=data_bounds["groups"], name="differential set A:")
+    groups_b = pn.widgets.MultiChoice(options=data_bounds["groups"], name="differential set B:")
+
+    rank_metric = pn.widgets.Select(name="rank genes on", options=list(gene_ranking.METRICS))
+    min_gene_cpgs = pn.widgets.IntInput(name="min CpGs per gene", value=1, start=1)
 
     submit = pn.widgets.Button(name='Filter data!', button_type='primary')
     return pn.layout.WidgetBox("# Settings", "### Configure settings for plotting",
                                chr_select, group_select,
                                min_range, max_range, all_genes, top_genes_count,
+                               min_coverage, frac_range, groups_a, groups_b,
+                               rank_metric, min_gene_cpgs,
                                submit)
 
 
+def frac_filter(frac_slider):
+    """Gets the fraction range to filter on
+
+    Parameters
+    ----------
+    frac_slider : pn.widgets.RangeSlider
+                The fraction slider of the widgetbox
+
+    Returns
+    -------
+    tuple or None
+                The selected range, None if the full range is selected
+
+    """
+    if tuple(frac_slider.value) == (frac_slider.start, frac_slider.end):
+        return None
+    return tuple(frac_slider.value)
+
+
 @pn.cache(max_items=10, per_session=True)
-def update_df(chr_select, group_select, min_range, max_range, gene_list):
+def update_df(chr_select, group_select, min_range, max_range, gene_list,
+              min_coverage=0, frac_range=None):
     """Filters df based on user input
 
     This function will take values set by the user in the frontend
@@ -101,45 +172,358 @@ def update_df(chr_select, group_select, min_range, max_range, gene_list):
     gene_list : list
                 The value of what genes the user wants to see
                 comes from widgetbox
+    min_coverage : int
+                The lowest amount of valid reads a CpG needs
+                comes from widgetbox
+    frac_range : tuple
+                The methylation fraction range to keep, None to keep all
+                comes from widgetbox
+
+    Returns
+    -------
+    pl.LazyFrame
+                Plan of the main data filtered on what the user wants to see.
+                Only refers to the shared main data, so the cache entries stay small
+
+    """
+    instr.cache_miss()
+    spec = be.make_filter_spec(chr_select, group_select, min_range, max_range,
+                               gene_list, min_coverage, frac_range)
+    return be.filter_plan(main_data, block_index, annotated_bed, spec)
+
+
+def spec_plan(spec):
+    """Gets the (cached) plan of a filter spec
+
+    With query_engine = duckdb the query runs now and is not cached,
+    so the rows are only kept while they are used.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
+
+    Returns
+    -------
+    pl.LazyFrame
+            Plan of the main data filtered on the spec
+
+    """
+    if sql_engine is not None:
+        return sql_engine.apply_filter_spec(spec).lazy()
+    with instr.track_cache("update_df"):
+        return update_df(chr_select=list(spec.chromosomes),
+                         group_select=list(spec.groups),
+                         min_range=spec.min_range,
+                         max_range=spec.max_range,
+                         gene_list=list(spec.genes),
+                         min_coverage=spec.min_coverage,
+                         frac_range=spec.frac_range)
+
+
+def admit(spec):
+    """Waits for the scheduler before heavy work on a filter spec
+
+    The cost is the amount of rows the spec touches, estimated with the block index.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the work is done on
 
     Returns
     -------
-    filtered_data : pl.Dataframe
-                A polars dataframe filter on what the user wants to see.
+    contextmanager
+            Runs the work when the scheduler allows it,
+            raises scheduler.SchedulerBusy when the worker is too busy
 
     """
-    filtered_data = main_data.clone()
+    session = id(pn.state.curdoc) if pn.state.curdoc is not None else "default"
+    return work_scheduler.admit(be.estimate_rows(block_index, spec), session)
+
+
+def tile_window(spec):
+    """Decides if a selection is plotted from tiles
+
+    Tiles are used for wide ranges, and for narrow ranges that still
+    touch more than aggregate_rows CpGs (estimated with the block index,
+    before anything is filtered).
+    Tiles only know counts, coverage and the mean fraction,
+    so selections with genes, coverage or fraction filters always use the CpGs.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
 
-    if gene_list:
-        print("Filtering genes")
-        filtered_data = be.filter_genes(
-            gene_list, filtered_data, annotated_bed)
+    Returns
+    -------
+    int or None
+            Window size of the tiles to use, None to use the CpGs
 
-    if chr_select:
-        print("Filtering chromosome")
-        filtered_data = be.filter_chr(chr_select, filtered_data)
+    """
+    if not tile_data or spec.genes or spec.min_coverage or spec.frac_range is not None:
+        return None
+    span = (spec.max_range or data_bounds["end_max"]) - spec.min_range
+    window = tiles.pick_window(span, tile_config, tile_data)
+    if window is None and be.estimate_rows(block_index, spec) > aggregate_rows:
+        # Narrow, but too many CpGs to plot, use the smallest tiles
+        window = next((window for window in tile_config["windows"]
+                       if str(window) in tile_data), None)
+    return window
 
-    if group_select:
-        print("Filter groups")
-        filtered_data = be.filter_group(group_select, filtered_data)
 
-    if min_range or max_range:
-        # Checks to see if user filters between the lowest and highest value
-        min_range = max(min_range, filtered_data["start"].min())
-        max_range = min(max_range, filtered_data["end"].max())
-        print(min_range, max_range)
-        filtered_data = be.filter_ranges(min_range, max_range, filtered_data)
+def summary_tiles(spec):
+    """Decides if the summary of a selection comes from tiles
 
-    print("Filtered data!")
-    return filtered_data
+    Wide selections use the window tiles they are plotted from.
+    Gene selections use the promoter tiles, when no range, coverage
+    or fraction filter leaves CpGs of the promoters out.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
+
+    Returns
+    -------
+    str or None
+            Name of the tiles to use, None to use the CpGs
+
+    """
+    window = tile_window(spec)
+    if window:
+        return str(window)
+    if ("promoters" in tile_data and spec.genes and not spec.min_range and not spec.max_range
+            and not spec.min_coverage and spec.frac_range is None):
+        return "promoters"
+    return None
+
+
+@pn.cache(max_items=50)
+def summarise_filter(spec, data_generation):  # pylint: disable=unused-argument
+    """Summarises the data for a filter spec
+
+    Cached on the spec, so all sessions that use the same filters
+    share the result, without hashing the data itself.
+    The plan is aggregated directly, the filtered rows are never kept.
+    Selections that are answered from tiles (see summary_tiles) are summarised
+    from the tiles, so their latency does not depend on the amount of CpGs.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
+    data_generation : str
+            Generation of the data of the session, part of the cache key
+
+    Returns
+    -------
+    pl.DataFrame
+            Summary statistics for every group, chromosome (and gene)
+
+    """
+    instr.cache_miss()
+    name = summary_tiles(spec)
+    if name is not None:
+        tile_rows = tiles.query_tiles(tile_data[name], spec.chromosomes, spec.groups,
+                                      spec.min_range, spec.max_range, spec.genes)
+        with instr.span("summarise_tiles", rows_in=tile_rows.height) as record:
+            summarised = summary.summarise_tiles(tile_rows)
+            record["rows_out"] = summarised.height
+        return summarised
+    with admit(spec):
+        with instr.span("summarise_filter",
+                        rows_in=be.estimate_rows(block_index, spec)) as record:
+            summarised = summary.summarise_methylation(spec_plan(spec))
+            record["rows_out"] = summarised.height
+    return summarised
+
+
+@pn.cache(max_items=20)
+def differential_filter(spec, groups_a, groups_b,
+                        data_generation):  # pylint: disable=unused-argument
+    """Computes differential methylation for a filter spec
+
+    The group filter of the spec is not used, the two sets decide the groups.
+    If genes are selected, only their promoters are tested.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
+    groups_a : tuple
+            Groups in set A
+    groups_b : tuple
+            Groups in set B
+    data_generation : str
+            Generation of the data of the session, part of the cache key
+
+    Returns
+    -------
+    pn.Column
+            Volcano plots and tables of the per promoter and per CpG results
+
+    """
+    instr.cache_miss()
+    with admit(spec._replace(groups=groups_a + groups_b, genes=())):
+        promoters = (be.get_gene_info(annotated_bed, list(spec.genes))
+                     if spec.genes else annotated_bed)
+        if matrix is not None:
+            # Only the columns of the two sets are read from the site matrix
+            with instr.span("differential", rows_in=matrix.sites.height) as record:
+                counts = site_matrix.site_counts(matrix, spec, list(groups_a), list(groups_b))
+                sites, regions = differential.differential_from_counts(counts, promoters)
+                record["rows_out"] = sites.height
+        else:
+            filtered_data = spec_plan(spec._replace(groups=groups_a + groups_b,
+                                                    genes=())).collect()
+            with instr.span("differential", rows_in=filtered_data.height) as record:
+                sites, regions = differential.differential_methylation(
+                    filtered_data, promoters, list(groups_a), list(groups_b))
+                record["rows_out"] = sites.height
+
+    if sites.is_empty():
+        return pn.pane.Markdown("# No CpGs with reads in both sets for these filters!")
+
+    content = [pn.pane.Markdown(f"### {sites.height} CpGs and {regions.height} promoters tested, "
+                                "delta is set B - set A")]
+    if not regions.is_empty():
+        content += [be.plot_volcano(regions, "Promoters"),
+                    pn.pane.DataFrame(regions.head(500).to_pandas())]
+    content += [be.plot_volcano(sites.head(20000), "CpGs (20000 lowest q values)"),
+                pn.pane.DataFrame(sites.head(500).to_pandas())]
+    return pn.Column(*content)
+
+
+def differential_tab(spec, groups_a, groups_b):
+    """Creates the content of the differential methylation tab
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
+    groups_a : list
+            Groups in set A
+    groups_b : list
+            Groups in set B
+
+    Returns
+    -------
+    pn.viewable
+            The results, or an explanation of how to get them
+
+    """
+    if not groups_a or not groups_b:
+        return pn.pane.Markdown("""
+                                # Select two sets of groups
+                                Pick groups for set A and set B in the settings to compare their methylation.
+                                """)
+    try:
+        differential.check_sets(groups_a, groups_b)
+    except ValueError as error:
+        return pn.pane.Markdown(f"# Pick every group in only one set!\n{error}")
+    with instr.track_cache("differential_filter"):
+        return differential_filter(spec, tuple(sorted(groups_a)), tuple(sorted(groups_b)),
+                                   generation)
+
+
+def gene_variation_tab(spec, metric, amount, min_cpgs):
+    """Creates the content of the gene variation tab
+
+    The genes are ranked on the chromosomes and groups of the spec.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked
+    metric : str
+            Metric to rank on, one of gene_ranking.METRICS
+    amount : int
+            Amount of genes to show
+    min_cpgs : int
+            Lowest amount of CpGs a gene needs
+
+    Returns
+    -------
+    pn.viewable
+            The top genes, or a message when no gene has enough CpGs
+
+    """
+    with instr.span("gene_ranking", rows_in=ranking.genes.height) as record:
+        top = gene_ranking.top_genes(ranking, metric, amount or 20, spec.chromosomes,
+                                     spec.groups, min_cpgs or 1)
+        record["rows_out"] = top.height
+    if top.is_empty():
+        return pn.pane.Markdown("# No genes with enough CpGs for these filters!")
+    return pn.pane.DataFrame(top.to_pandas())
+
+
+@pn.cache(max_items=20)
+def sample_overview_filter(chromosomes, groups, min_cpgs,
+                           data_generation):  # pylint: disable=unused-argument
+    """Computes the PCA and clusters of the samples
+
+    Only needs the region ranking, so it is cached on the chromosomes, groups
+    and generation, and all sessions share the result.
+
+    Parameters
+    ----------
+    chromosomes : tuple
+            Chromosomes the user picked, all when empty
+    groups : tuple
+            Groups (samples) the user picked, all when empty
+    min_cpgs : int
+            Lowest amount of CpGs a promoter needs in a sample
+    data_generation : str
+            Generation of the data of the session, part of the cache key
+
+    Returns
+    -------
+    sample_overview.SampleOverview or None
+            The overview, None when there are too few samples or promoters
+
+    """
+    instr.cache_miss()
+    with instr.span("sample_overview", rows_in=region_ranking.genes.height) as record:
+        overview = sample_overview.sample_overview(region_ranking, chromosomes, groups,
+                                                   min_cpgs)
+        record["rows_out"] = 0 if overview is None else overview.regions
+    return overview
+
+
+def sample_overview_tab(spec, min_cpgs):
+    """Creates the content of the sample overview tab
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked, the chromosomes and groups are used
+    min_cpgs : int
+            Lowest amount of CpGs a promoter needs in a sample
+
+    Returns
+    -------
+    pn.viewable
+            The PCA, the dendrogram and the table of the samples
+
+    """
+    with instr.track_cache("sample_overview"):
+        overview = sample_overview_filter(spec.chromosomes, spec.groups, min_cpgs or 1,
+                                          generation)
+    if overview is None:
+        return pn.pane.Markdown("# Too few samples or promoters with CpGs for these filters!")
+    return pn.Column(be.plot_sample_pca(overview), be.plot_dendrogram(overview),
+                     pn.pane.DataFrame(be.sample_table(overview).to_pandas()))
 
 
-@pn.cache
 def create_tabs(plots, *args):
     """Creates all of the tabs
 
     The webpage works by splitting plots and tables in tabs
     This funtions will create all tabs
+    Not cached, the plots are cached in the plot cache and
+    every session gets its own copy of them
 
     Parameters
     ----------
@@ -155,25 +539,93 @@ def create_tabs(plots, *args):
             together with the page's content
 
     """
-    print("Updating tabs")
-    tabs = pn.Tabs()
-
-    # Puts plots in the tabs
-    if isinstance(plots, list):
-        for title, plot in plots:
-            tabs.append((title, plot))
-    else:
-        tabs.append(("Empty Dataframe", be.pn.pane.Markdown(
-            "# No methylation found for these filters!")))
-    # Puts args content in tabs, if args is used
-    if args:
-        for content in args:
-            title, item = content
-            tabs.append((title, item))
+    with instr.span("create_tabs"):
+        tabs = pn.Tabs()
+
+        # Puts plots in the tabs
+        if isinstance(plots, list):
+            for title, plot in plots:
+                tabs.append((title, plot))
+        else:
+            tabs.append(("Empty Dataframe", be.pn.pane.Markdown(
+                "# No methylation found for these filters!")))
+        # Puts args content in tabs, if args is used
+        if args:
+            for content in args:
+                title, item = content
+                tabs.append((title, item))
 
     return tabs
 
 
+def filter_and_plot(spec):
+    """Filters the data and plots it
+
+    Wide selections are plotted from the tiles, the others from the CpGs.
+    The filtered rows only live while plotting, what is kept (and cached)
+    are the plots, which hold aggregated or sampled data, and the first rows of the table.
+
+    Parameters
+    ----------
+    spec : be.FilterSpec
+            The filters the user picked, the empty spec shows all data
+
+    Returns
+    -------
+    tuple
+            The plots (or a loading indicator if there is no data)
+            and if genes were selected, the first max_table_rows filtered CpGs
+            as a pandas dataframe with the total amount of filtered CpGs
+
+    """
+    window = tile_window(spec)
+    if window:
+        # Wide selection, plot the tiles instead of every CpG
+        with instr.span("query_tiles") as record:
+            tile_rows = tiles.query_tiles(tile_data[str(window)], spec.chromosomes,
+                                          spec.groups, spec.min_range, spec.max_range)
+            record["rows_out"] = tile_rows.height
+        return asyncio.run(be.plot_tile_plots(tile_rows, window)), None
+
+    with admit(spec):
+        # Without filters the plan is the shared main data itself, nothing is copied
+        with instr.span("update_df", rows_in=be.estimate_rows(block_index, spec)) as record:
+            temp_data = spec_plan(spec).collect()
+            record["rows_out"] = temp_data.height
+
+        plots = asyncio.run(be.plot_plots(temp_data, list(spec.genes),
+                                          binary=config.getboolean("PLOTS", "binary_transport",
+                                                                   fallback=True),
+                                          max_points=max_points))
+    filtered_table = None
+    if "gene_name" in temp_data.columns:
+        filtered_table = (temp_data.select(["chr", "start", "end", "group_name", "gene_name"])
+                          .head(max_table_rows).to_pandas(), temp_data.height)
+    return plots, filtered_table
+
+
+def table_tab(filtered_table):
+    """Creates the content of the filtered data tab
+
+    Parameters
+    ----------
+    filtered_table : tuple
+            The first rows as a pandas dataframe and the total amount of rows
+
+    Returns
+    -------
+    pn.viewable
+            The table, with a notice when not all rows are shown
+
+    """
+    table, total_rows = filtered_table
+    if total_rows <= len(table):
+        return pn.pane.DataFrame(table)
+    return pn.Column(pn.pane.Markdown(f"### Showing the first {len(table):,} "
+                                      f"of {total_rows:,} filtered CpGs"),
+                     pn.pane.DataFrame(table))
+
+
 async def submit_button(button, settings_box):
     """Filters and plots when filter button is pressed
 
@@ -195,28 +647,59 @@ async def submit_button(button, settings_box):
             together with the page's content
 
     """
-    # Clones data
-    temp_data = main_data.clone()
-    if button:
-
-        # Filter data
-        temp_data = update_df(chr_select=settings_box[2].value,
-                              group_select=settings_box[3].value,
-                              min_range=settings_box[4].value,
-                              max_range=settings_box[5].value,
-                              gene_list=settings_box[6].value)
-    headed_gene_variation = be.head_variation(
-        gene_variation, settings_box[7].value)
-    # Plot data
-    plots = asyncio.run(be.plot_plots(temp_data, settings_box[6].value))
-    if "gene_name" in temp_data.columns:
+    with instr.profile_request(config, "submit"), instr.span("submit"):
+        spec = be.FilterSpec()
+        if button:
+            spec = be.make_filter_spec(chr_select=settings_box[2].value,
+                                       group_select=settings_box[3].value,
+                                       min_range=settings_box[4].value,
+                                       max_range=settings_box[5].value,
+                                       gene_list=settings_box[6].value,
+                                       min_coverage=settings_box[8].value,
+                                       frac_range=frac_filter(settings_box[9]))
+
+        plot_store = plot_cache.get_plot_cache(config)
+        try:
+            cached = plot_store.get((generation, spec))
+            if cached is not None:
+                # Another session already plotted these filters
+                frozen_plots, filtered_table = cached
+                plots = plot_cache.thaw_plots(frozen_plots)
+            else:
+                plots, filtered_table = filter_and_plot(spec)
+                if isinstance(plots, list):
+                    plot_store.put((generation, spec),
+                                   (plot_cache.freeze_plots(plots), filtered_table))
+
+            with instr.track_cache("summarise_filter"):
+                summary_table = pn.pane.DataFrame(summarise_filter(spec, generation).to_pandas())
+            differential_content = differential_tab(spec, settings_box[10].value,
+                                                    settings_box[11].value)
+        except scheduler.SchedulerBusy as error:
+            return pn.pane.Markdown(f"""
+                                    # The server is busy
+                                    Too many large selections are being filtered right now ({error}).
+                                    Try again in a moment, or make the selection smaller.
+                                    """)
+
+        headed_gene_variation = gene_variation_tab(spec, settings_box[12].value,
+                                                   settings_box[7].value,
+                                                   settings_box[13].value)
+        samples_content = sample_overview_tab(spec, settings_box[13].value)
+        if filtered_table is not None:
+            return create_tabs(plots,
+                               ("Summary", summary_table),
+                               ("Differential methylation", differential_content),
+                               ("Gene Variation", headed_gene_variation),
+                               ("Sample overview", samples_content),
+                               ("Filtered data", table_tab(filtered_table)),
+                               ("Info Page", be.read_info_page(config)))
         return create_tabs(plots,
-                            ("Gene Variation", headed_gene_variation),
-                            ("Filtered data", pn.pane.DataFrame(temp_data.select(["chr", "start", "end", "group_name", "gene_name"]).to_pandas())),
-                            ("Info Page", be.read_info_page(config)))
-    return create_tabs(plots,
-                            ("Gene Variation", headed_gene_variation),
-                            ("Info Page", be.read_info_page(config)))
+                           ("Summary", summary_table),
+                           ("Differential methylation", differential_content),
+                           ("Gene Variation", headed_gene_variation),
+                           ("Sample overview", samples_content),
+                           ("Info Page", be.read_info_page(config)))
 
 
 
@@ -242,7 +725,7 @@ async def load_page():
     # Binds button to submit button function
     tabs = pn.bind(lambda button, settings_box: asyncio.run(submit_button(button,
                                                                           settings_box)
-                                                            ), settings_box[8], settings_box)
+                                                            ), settings_box[-1], settings_box)
 
     return pn.template.MaterialTemplate(
         site="",
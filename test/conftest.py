@@ -0,0 +1,15 @@
+"""
+conftest.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+Makes the modules in src importable the same way ui.py imports them,
+so modules that do `import backend` also work in the tests.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,72 @@
+"""
+test_api.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the http query api
+
+run:
+python3 -m pytest
+"""
+
+import json
+import pyarrow as pa
+import pytest
+import tornado.web
+import tornado.httpserver
+import tornado.testing
+import tornado.httpclient
+from src import api
+
+
+def test_parse_spec():
+    """Tests that repeated and comma separated arguments end up in the spec"""
+    spec = api.parse_spec({"chr": ["chr2,chr1", "chr1"], "gene": ["TP53"],
+                           "min_range": ["100"], "min_frac": ["0.5"]})
+    assert spec.chromosomes == ("chr1", "chr2")
+    assert spec.genes == ("TP53",)
+    assert spec.min_range == 100
+    assert spec.frac_range == (0.5, 1.0)
+
+    with pytest.raises(ValueError):
+        api.parse_spec({"max_range": ["a lot"]})
+
+
+def test_arrow_chunks():
+    """Tests that the chunks together are one valid Arrow stream"""
+    df = api.pl.DataFrame({"start": range(1000), "chr": ["chr1"] * 1000})
+    stream = b"".join(api.arrow_chunks(df, rows_per_batch=300))
+    table = pa.ipc.open_stream(stream).read_all()
+    assert table.num_rows == 1000
+    assert api.pl.from_arrow(table).equals(df)
+
+
+@pytest.mark.asyncio
+async def test_endpoints():
+    """Tests the counts and rows endpoints against the backend filters"""
+    config = api.core.parse_config()
+    dataset = api.ds.get_dataset(config)
+    chromosome = dataset["main_data"]["chr"][0]
+    expected = api.query_rows(dataset, api.parse_spec({"chr": [chromosome]}))
+
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application(api.api_routes(config)))
+    server.add_sockets([sock])
+    client = tornado.httpclient.AsyncHTTPClient()
+    try:
+        response = await client.fetch(f"http://127.0.0.1:{port}/api/counts?chr={chromosome}")
+        counts = json.loads(response.body)["data"]
+        assert sum(row["n methylations"] for row in counts) == expected.height
+
+        response = await client.fetch(f"http://127.0.0.1:{port}/api/rows", method="POST",
+                                      body=json.dumps({"chr": [chromosome]}))
+        assert response.headers["Content-Type"] == api.ARROW_STREAM
+        assert pa.ipc.open_stream(response.body).read_all().num_rows == expected.height
+
+        with pytest.raises(tornado.httpclient.HTTPClientError) as error:
+            await client.fetch(f"http://127.0.0.1:{port}/api/counts?min_range=abc")
+        assert error.value.code == 400
+    finally:
+        server.stop()
@@ -11,6 +11,7 @@ run:
 python3 -m pytest
 """
 
+import gzip
 import pytest
 import configparser
 import asyncio
@@ -202,3 +203,243 @@ def test_filter_chr(chr_ls, df):
         Data to filter on
     """
     assert isinstance(be.filter_chr(chr_ls, df), be.pl.DataFrame)
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        be.FilterSpec(),
+        be.FilterSpec(chromosomes=("chr1",), min_coverage=10),
+        be.FilterSpec(frac_range=(0.2, 0.6)),
+        be.FilterSpec(groups=("A53J1",), min_range=30000, max_range=900000),
+        be.FilterSpec(chromosomes=("djdsjd",)),
+    ]
+)
+def test_scan_blocks(spec):
+    """Test the block index
+    Filtering with the block index should give the same rows as filtering every row
+
+    Parameters
+    ----------
+    spec: be.FilterSpec
+        filters to apply
+    """
+    sorted_data, block_index = be.build_block_index(main_data, block_size=16)
+    result = be.scan_blocks(sorted_data, block_index, spec)
+
+    expected = sorted_data
+    if spec.chromosomes:
+        expected = be.filter_chr(list(spec.chromosomes), expected)
+    if spec.groups:
+        expected = be.filter_group(list(spec.groups), expected)
+    expected = be.filter_coverage(spec.min_coverage, expected)
+    if spec.frac_range:
+        expected = be.filter_frac(*spec.frac_range, expected)
+    if spec.min_range or spec.max_range:
+        result = be.filter_ranges(spec.min_range, spec.max_range, result)
+        expected = be.filter_ranges(spec.min_range, spec.max_range, expected)
+
+    assert result.sort(["chr", "group_name", "start"]).equals(expected)
+
+
+def test_filter_ranges_open_bound():
+    """Test that a bound of 0 is not set
+    Only a start keeps everything from the start on, only an end everything up to the end
+    """
+    start = int(main_data["start"].median())
+    from_start = be.filter_ranges(start, 0, main_data)
+    assert from_start.height == main_data.filter(be.pl.col("start") >= start).height > 0
+    up_to = be.filter_ranges(0, start, main_data)
+    assert up_to.height == main_data.filter(be.pl.col("end") <= start).height > 0
+    assert be.filter_ranges(0, 0, main_data).height == main_data.height
+
+
+def test_select_blocks_skips():
+    """Test that blocks that can not match are skipped
+    A coverage above the highest coverage should not select any blocks
+    """
+    _, block_index = be.build_block_index(main_data, block_size=16)
+    highest = main_data["valid"].max()
+    assert be.select_blocks(block_index, be.FilterSpec(min_coverage=highest + 1)).is_empty()
+    assert be.select_blocks(block_index, be.FilterSpec()).height == block_index.height
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        be.FilterSpec(),
+        be.FilterSpec(chromosomes=("chr1",), min_range=30000, max_range=900000),
+        be.FilterSpec(chromosomes=("chr1",), min_range=30000),
+        be.FilterSpec(genes=("TP53", "BRCA1"), min_coverage=5),
+        be.FilterSpec(genes=("not_a_gene",)),
+    ]
+)
+def test_filter_plan(spec):
+    """Test the lazy filter plan
+    Collecting the plan should give the same rows as the eager filters,
+    and nothing should be filtered before it is collected
+
+    Parameters
+    ----------
+    spec: be.FilterSpec
+        filters to apply
+    """
+    sorted_data, block_index = be.build_block_index(main_data, block_size=16)
+    annotated_bed = be.load_bed_file(config)
+    plan = be.filter_plan(sorted_data, block_index, annotated_bed, spec)
+    assert isinstance(plan, be.pl.LazyFrame)
+
+    expected = be.filter_coverage(spec.min_coverage, sorted_data)
+    if spec.chromosomes:
+        expected = be.filter_chr(list(spec.chromosomes), expected)
+    if spec.genes:
+        expected = be.filter_genes(list(spec.genes), expected, annotated_bed)
+    if spec.min_range or spec.max_range:
+        expected = be.filter_ranges(spec.min_range, spec.max_range, expected)
+    result = plan.collect()
+    assert result.height == expected.height
+    if not expected.is_empty():
+        assert result.equals(expected)
+
+
+def test_annotate_promoters():
+    """Test the nearest promoter labels
+    Inside a region (also a nested one) the distance is 0,
+    before a region it is negative and after it positive
+    """
+    bed = be.pl.DataFrame({"chr": ["chr1", "chr1", "chr1", "chr1"],
+                           "start": [100, 150, 500, 900],
+                           "end": [400, 200, 600, 1000],
+                           "gene_name": ["A", "B", "C", "D"]})
+    cpgs = be.pl.DataFrame({"chr": ["chr1"] * 6 + ["chr2"],
+                            "start": [160, 300, 420, 480, 50, 2000, 10],
+                            "frac": [0.5] * 7, "valid": [3] * 7,
+                            "group_name": ["A53J1"] * 7}).with_columns(
+        (be.pl.col("start") + 1).alias("end")).select(["chr", "start", "end", "frac",
+                                                       "valid", "group_name"])
+    result = be.annotate_promoters(cpgs, bed)
+    assert result.select(cpgs.columns).equals(cpgs)
+    assert result["promoter"].cast(be.pl.String).to_list() == [
+        "chr1:100-400", "chr1:100-400", "chr1:100-400", "chr1:500-600",
+        "chr1:100-400", "chr1:900-1000", None]
+    assert result["promoter_distance"].to_list() == [0, 0, 21, -20, -50, 1001, None]
+
+
+@pytest.mark.parametrize(
+    "genes",
+    [
+        ["TP53", "BRCA1", "KIF26B"],
+        ["WASH7P", "MIR1302-2"],
+        ["not_a_gene"],
+    ]
+)
+def test_labelled_gene_filter(genes):
+    """Test the gene filter on labelled data
+    Should give the same rows as filtering on the promoter ranges
+
+    Parameters
+    ----------
+    genes: list
+        genes to filter on
+    """
+    annotated_bed = be.load_bed_file(config)
+    labelled = be.annotate_promoters(main_data, annotated_bed)
+    result = be.gene_plan(genes, labelled.lazy(), annotated_bed).collect()
+    expected = be.filter_genes(genes, main_data, annotated_bed)
+    result = result.drop(["promoter", "promoter_distance"])
+    assert result.height == expected.height
+    if not expected.is_empty():
+        assert result.sort(result.columns).equals(expected.sort(expected.columns))
+
+
+def test_encode_categories():
+    """Test the category encoding
+    The codes should point to the original values in the sorted labels
+    """
+    series = be.pl.Series("chr", ["chr2", "chr1", "chr2", "chrX"])
+    codes, labels = be.encode_categories(series)
+    assert codes.dtype == be.np.uint8
+    assert labels == ["chr1", "chr2", "chrX"]
+    assert [labels[code] for code in codes] == series.to_list()
+
+
+@pytest.mark.parametrize(
+    "positions",
+    [
+        pytest.param(be.np.arange(0, 100000, 7)),
+        pytest.param(be.np.array([500, 500, 500])),
+        pytest.param(be.np.array([42])),
+    ]
+)
+def test_binned_kde(positions):
+    """Test the binned density
+    The density should be a float32 curve that integrates to about 1
+
+    Parameters
+    ----------
+    positions: np.ndarray
+        genomic positions
+    """
+    grid, density = be.binned_kde(positions)
+    assert grid.dtype == be.np.float32 and density.dtype == be.np.float32
+    assert be.np.trapezoid(density, grid) == pytest.approx(1, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_plotting_binary():
+    """Tests the binary plots
+    The plot data should be numpy arrays, without a column with the group names
+    """
+    plots = await be.plot_plots(main_data.head(1000), True, binary=True)
+    scatter = dict(plots)["Scatter plot"]
+    for element in scatter:
+        assert set(element.data) == {"start", "chr"}
+        assert element.data["start"].dtype == be.np.uint32
+
+
+def test_downsample():
+    """Test the stratified downsampling
+    A small group should keep all of its points, the large group gets the rest
+    """
+    df = be.pl.DataFrame({"start": range(1010),
+                          "group_name": ["large"] * 1000 + ["small"] * 10})
+    sample = be.downsample(df, 100)
+    counts = dict(sample.group_by("group_name").len().iter_rows())
+    assert counts == {"large": 90, "small": 10}
+    assert sample["start"].is_sorted()
+    assert sample.equals(be.downsample(df, 100))
+
+
+@pytest.mark.asyncio
+async def test_plotting_max_points():
+    """Tests that oversized plots are sampled and say so in their title"""
+    plots = dict(await be.plot_plots(main_data, True, binary=True, max_points=100))
+    scatter = plots["Scatter plot"]
+    assert sum(len(element) for element in scatter) == 100
+    assert "sampled per group" in scatter.opts.get("plot").kwargs["title"]
+
+
+def test_read_bedmethyl(tmp_path):
+    """Tests that gzipped modkit bedMethyl files are read next to the old files
+    Only the 5mC rows are used, and contig names are not cut at the underscore
+    """
+    rows = ["chr1\t100\t101\tm\t20\t+\t100\t101\t255,0,0\t20\t25.00\t5\t15\t0\t0\t0\t0\t0",
+            "chr1\t100\t101\th\t20\t+\t100\t101\t255,0,0\t20\t10.00\t2\t18\t0\t0\t0\t0\t0",
+            "chrUn_KI270302v1\t7\t8\tm\t4\t+\t7\t8\t255,0,0\t4\t100.00\t4\t0\t0\t0\t0\t0\t0"]
+    # bgzip files are several gzip members after each other
+    (tmp_path / "barcode02.bed.gz").write_bytes(
+        b"".join(gzip.compress(f"{row}\n".encode()) for row in rows))
+    (tmp_path / "barcode1_cpg.csv").write_text("chr2_CG0\t5\t6\t0.5\t10\t.\n")
+    (tmp_path / "notes.txt").write_text("not data\n")
+    bed_config = configparser.ConfigParser()
+    bed_config.read_dict({"PATHS": {"data_folder": str(tmp_path),
+                                    "group_data": config.get("PATHS", "group_data")}})
+
+    assert be.core.data_file_format(str(tmp_path / "barcode02.bed.gz")) == "bedmethyl"
+    df = be.core.read_data(bed_config).sort("chr")
+
+    assert df.schema == be.core.READ_SCHEMA
+    assert df["chr"].to_list() == ["chr1", "chr2", "chrUn_KI270302v1"]
+    assert df["frac"].to_list() == [0.25, 0.5, 1.0]
+    assert df["valid"].to_list() == [20, 10, 4]
+    assert df["group_name"].n_unique() == 2
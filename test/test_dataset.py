@@ -0,0 +1,137 @@
+"""
+test_dataset.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the shared data snapshot
+
+run:
+python3 -m pytest
+"""
+
+import os
+import json
+import pytest
+from src import dataset as ds
+
+
+@pytest.fixture
+def snapshot_config(tmp_path):
+    """The config of the test data, with the snapshot in a temporary folder"""
+    config = ds.core.parse_config()
+    config.set("PATHS", "snapshot_folder", str(tmp_path / "snapshot"))
+    return config
+
+
+def test_snapshot_round_trip(snapshot_config):
+    """Tests that the memory mapped snapshot has the same data as the files"""
+    assert ds.read_snapshot(snapshot_config) is None
+
+    built = ds.build_dataset(snapshot_config)
+    ds.write_snapshot(built, snapshot_config)
+    loaded = ds.read_snapshot(snapshot_config)
+
+    for table in ds.SNAPSHOT_TABLES:
+        assert loaded[table].equals(built[table])
+
+
+def test_snapshot_folders(snapshot_config):
+    """Tests that every snapshot gets its own folder and only the newest two are kept"""
+    built = ds.build_dataset(snapshot_config)
+    folder = ds.snapshot_folder(snapshot_config)
+    for _ in range(3):
+        ds.write_snapshot(built, snapshot_config)
+    with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as manifest_file:
+        newest = json.load(manifest_file)["folder"]
+    folders = [entry.name for entry in os.scandir(folder) if entry.is_dir()]
+    assert len(folders) == 2 and newest in folders
+    assert ds.read_snapshot(snapshot_config)["block_index"].equals(built["block_index"])
+
+
+def test_pinned_store(tmp_path):
+    """Tests that a generation that is still used is not removed"""
+    pin = ds.pin_generation(str(tmp_path / "generation0"))
+    for number in range(4):
+        os.makedirs(tmp_path / f"generation{number}", exist_ok=True)
+        os.utime(tmp_path / f"generation{number}", ns=(number, number))
+    ds.remove_old_stores(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["generation0", "generation2", "generation3"]
+    pin.close()
+    ds.remove_old_stores(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["generation2", "generation3"]
+
+
+def test_outdated_snapshot(snapshot_config, tmp_path):
+    """Tests that a snapshot of changed files is not used"""
+    bed_copy = tmp_path / "annotated_bed.bed"
+    with open(snapshot_config.get("PATHS", "annotated_bed"), "rb") as bed:
+        bed_copy.write_bytes(bed.read())
+    snapshot_config.set("PATHS", "annotated_bed", str(bed_copy))
+
+    ds.write_snapshot(ds.build_dataset(snapshot_config), snapshot_config)
+    assert ds.read_snapshot(snapshot_config) is not None
+
+    os.utime(bed_copy, ns=(0, 0))
+    assert ds.read_snapshot(snapshot_config) is None
+
+
+def test_reload_new_files(snapshot_config, tmp_path):
+    """Tests that new barcode files are swapped in once they stopped changing"""
+    source_folder = snapshot_config.get("PATHS", "data_folder")
+    files = sorted(os.listdir(source_folder))
+    data_folder = tmp_path / "data"
+    data_folder.mkdir()
+    for file in files[:-1]:
+        with open(os.path.join(source_folder, file), "rb") as source:
+            (data_folder / file).write_bytes(source.read())
+    snapshot_config.set("PATHS", "data_folder", str(data_folder))
+
+    manager = ds.DatasetManager(snapshot_config)
+    first = manager.get()
+    assert not manager.reload_if_changed()
+
+    with open(os.path.join(source_folder, files[-1]), "rb") as source:
+        (data_folder / files[-1]).write_bytes(source.read())
+    # The first check only sees the change, the second one loads it
+    assert not manager.reload_if_changed()
+    assert manager.get() is first
+    assert manager.reload_if_changed()
+
+    second = manager.get()
+    assert second["generation"] != first["generation"]
+    assert second["main_data"].height > first["main_data"].height
+
+
+@pytest.mark.parametrize("spec", [
+    ds.core.make_filter_spec([], [], 0, 0, []),
+    ds.core.make_filter_spec(["chr1"], [], 20000, 40000, []),
+    ds.core.make_filter_spec([], ["A53J1"], 0, 0, [], min_coverage=20, frac_range=(0.2, 0.8)),
+])
+def test_region_store(snapshot_config, tmp_path, spec):
+    """Tests that queries on the region store give the same rows as the data in memory"""
+    built = ds.build_dataset(snapshot_config)
+    block_index = ds.core.write_region_store(snapshot_config, str(tmp_path / "store"),
+                                             block_size=50)
+    assert ds.core.data_bounds(block_index) == ds.core.data_bounds(built["block_index"])
+
+    expected = ds.core.apply_filter_spec(built["main_data"], built["block_index"],
+                                         built["annotated_bed"], spec)
+    result = ds.core.apply_filter_spec(None, block_index, built["annotated_bed"], spec)
+    assert result.sort(result.columns).equals(expected.sort(expected.columns))
+
+
+def test_indexed_backend(snapshot_config, tmp_path):
+    """Tests that the indexed backend keeps only the block index in the snapshot"""
+    snapshot_config.read_dict({"DATASET": {"backend": "indexed"},
+                               "PATHS": {"region_store": str(tmp_path / "store")}})
+    manager = ds.DatasetManager(snapshot_config)
+    dataset = manager.get()
+    assert dataset["main_data"] is None
+    assert os.listdir(tmp_path / "store") == [dataset["generation"]]
+    assert ds.read_snapshot(snapshot_config)["main_data"] is None
+    memory = ds.build_dataset(ds.core.parse_config())
+    for name in ("gene_ranking", "region_ranking"):
+        assert dataset[name].genes.equals(memory[name].genes)
+        assert (dataset[name].counts == memory[name].counts).all()
@@ -0,0 +1,108 @@
+"""
+test_differential.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the differential methylation engine
+
+run:
+python3 -m pytest
+"""
+
+import pytest
+import numpy as np
+import polars as pl
+from src import core, differential, site_matrix
+
+
+@pytest.fixture
+def methylation():
+    """Creates a small dataset with two CpGs on two chromosomes and three groups
+
+    Returns
+    -------
+    pl.DataFrame
+        Methylation data
+
+    """
+    return pl.DataFrame({"chr": ["chr1", "chr1", "chr1", "chr2", "chr2", "chr2"],
+                         "start": [100, 100, 100, 500, 500, 500],
+                         "end": [101, 101, 101, 501, 501, 501],
+                         "frac": [0.0, 1.0, 0.5, 0.2, 0.2, 0.9],
+                         "valid": [10, 30, 20, 10, 10, 10],
+                         "group_name": ["A1", "B1", "B2", "A1", "B1", "C1"]})
+
+
+def test_sites(methylation):
+    """Tests the per CpG delta, weighted on coverage"""
+    sites, _ = differential.differential_methylation(
+        methylation, pl.DataFrame(schema={"chr": pl.String, "start": pl.Int64,
+                                          "end": pl.Int64, "gene_name": pl.String}),
+        ["A1"], ["B1", "B2"])
+    site = sites.filter(pl.col("chr") == "chr1").row(0, named=True)
+    assert site["frac A"] == pytest.approx(0.0)
+    assert site["frac B"] == pytest.approx(40 / 50)
+    assert site["delta frac"] == pytest.approx(0.8)
+    assert site["p value"] < 0.001
+
+    same = sites.filter(pl.col("chr") == "chr2").row(0, named=True)
+    assert same["delta frac"] == pytest.approx(0.0)
+    assert same["p value"] == pytest.approx(1.0)
+
+
+def test_regions(methylation):
+    """Tests that CpGs are summed per promoter, overlapping promoters both count"""
+    promoters = pl.DataFrame({"chr": ["chr1", "chr1", "chr2"],
+                              "start": [50, 90, 1000],
+                              "end": [150, 200, 2000],
+                              "gene_name": ["GENE1", "GENE2", "GENE3"]})
+    _, regions = differential.differential_methylation(methylation, promoters,
+                                                       ["A1"], ["B1", "B2"])
+    assert sorted(regions["gene_name"].to_list()) == ["GENE1", "GENE2"]
+    assert regions["n CpGs"].to_list() == [1, 1]
+
+
+def test_overlapping_sets(methylation):
+    """Tests that a group can not be compared with itself"""
+    with pytest.raises(ValueError, match="B1"):
+        differential.differential_methylation(methylation, pl.DataFrame(), ["A1", "B1"], ["B1"])
+
+
+def test_benjamini_hochberg():
+    """Tests the q values against a hand calculated example"""
+    q_values = differential.benjamini_hochberg(np.array([0.01, 0.04, 0.03, 0.5]))
+    assert q_values == pytest.approx([0.04, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.5])
+
+
+@pytest.mark.parametrize("spec", [
+    core.make_filter_spec([], [], 0, 0, []),
+    core.make_filter_spec(["chr2"], [], 0, 0, []),
+    core.make_filter_spec([], [], 0, 0, [], min_coverage=15),
+    core.make_filter_spec([], [], 0, 0, [], frac_range=(0.1, 0.6)),
+])
+def test_site_matrix_counts(methylation, spec):
+    """Tests that the site matrix counts the same reads as the long data"""
+    matrix = site_matrix.build_site_matrix(methylation)
+    assert matrix.samples == ("A1", "B1", "B2", "C1")
+    assert matrix.frac.shape == (2, 4)
+
+    filtered = core.apply_filter_spec(*core.build_block_index(methylation), None, spec)
+    expected = (differential.chromosome_counts(filtered, ["A1"], ["B1", "B2"])
+                .sort(differential.SITE_KEYS))
+    counts = site_matrix.site_counts(matrix, spec, ["A1"], ["B1", "B2"])
+    assert counts.columns == expected.columns
+    assert counts.cast(expected.schema).equals(expected)
+
+
+def test_site_matrix_round_trip(methylation, tmp_path):
+    """Tests that the memory mapped matrix has the same values"""
+    matrix = site_matrix.build_site_matrix(methylation)
+    site_matrix.write_site_matrix(matrix, str(tmp_path))
+    loaded = site_matrix.read_site_matrix(str(tmp_path))
+    assert loaded.sites.equals(matrix.sites)
+    assert loaded.samples == matrix.samples
+    assert np.array_equal(loaded.frac, matrix.frac, equal_nan=True)
+    assert np.array_equal(loaded.valid, matrix.valid)
+    assert loaded.valid.flags.f_contiguous
@@ -0,0 +1,120 @@
+"""
+test_gene_ranking.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the gene ranking
+
+run:
+python3 -m pytest
+"""
+
+import numpy as np
+import polars as pl
+import pytest
+from src import core
+from src import gene_ranking as gr
+
+
+@pytest.fixture(scope="module")
+def loaded():
+    """The test data, the promoters and their ranking"""
+    config = core.parse_config()
+    main_data = core.read_data(config)
+    annotated_bed = core.load_bed_file(config)
+    ranking = gr.build_gene_ranking([gr.gene_sums(main_data, annotated_bed)])
+    return main_data, annotated_bed, ranking
+
+
+def test_metrics(loaded):
+    """Tests the metrics against a range join of every CpG with every promoter"""
+    main_data, annotated_bed, ranking = loaded
+    promoters = (annotated_bed
+                 .filter(pl.col("gene_name") != gr.UNKNOWN_GENE)
+                 .rename({"start": "promoter_start", "end": "promoter_end"})
+                 .partition_by("chr", as_dict=True))
+    expected = (pl.concat([cpgs.join_where(promoters[key].drop("chr"),
+                                           pl.col("start") >= pl.col("promoter_start"),
+                                           pl.col("end") <= pl.col("promoter_end"))
+                           for key, cpgs in main_data.partition_by("chr", as_dict=True).items()
+                           if key in promoters])
+                .unique(["gene_name", "chr", "start", "end", "group_name"])
+                .group_by(["gene_name", "chr"])
+                .agg(pl.col("start").std().alias("spread"), pl.col("frac").mean().alias("mean"),
+                     pl.len().alias("n")))
+    result = gr.gene_metrics(ranking).join(expected, on=["gene_name", "chr"])
+    assert result.height == expected.height == ranking.genes.height
+    assert np.allclose(result["position spread"], result["spread"], equal_nan=True)
+    assert np.allclose(result["mean frac"], result["mean"])
+    assert (result["n CpGs"] == result["n"]).all()
+
+
+@pytest.mark.parametrize("metric, k, groups, descending", [
+    ("position spread", 10, (), True),
+    ("frac variance", 5, ("A53C1", "A53D1", "A53J1"), True),
+    ("mean frac", 3, ("A53J1",), False),
+    ("n CpGs", 1000, (), True),
+])
+def test_top_genes(loaded, metric, k, groups, descending):
+    """Tests that the partial sort gives the same genes as sorting all of them"""
+    ranking = loaded[2]
+    result = gr.top_genes(ranking, metric, k, groups=groups, descending=descending)
+    expected = (gr.gene_metrics(ranking, groups=groups)
+                .fill_nan(None)
+                .sort(metric, descending=descending, nulls_last=True)
+                .head(k))
+    assert result.height == min(k, expected.height)
+    assert np.allclose(result[metric].fill_nan(None).to_numpy().astype(float),
+                       expected[metric].to_numpy().astype(float), equal_nan=True)
+
+
+def test_filters(loaded):
+    """Tests the chromosome and CpG count filters, and unknown metrics"""
+    ranking = loaded[2]
+    result = gr.top_genes(ranking, "position spread", 1000, chromosomes=("chr1",), min_cpgs=50)
+    assert (result["chr"] == "chr1").all() and (result["n CpGs"] >= 50).all()
+    assert gr.UNKNOWN_GENE not in ranking.genes["gene_name"]
+    assert not ranking.genes.is_duplicated().any()
+    assert gr.top_genes(ranking, k=10, chromosomes=("djdsjd",)).is_empty()
+    with pytest.raises(ValueError):
+        gr.top_genes(ranking, "not a metric")
+
+
+def test_parts_and_round_trip(loaded, tmp_path):
+    """Tests that counting per group gives the same ranking, also after writing it"""
+    main_data, annotated_bed, ranking = loaded
+    parts = gr.build_gene_ranking([gr.gene_sums(part, annotated_bed)
+                                   for part in main_data.partition_by("group_name")])
+    gr.write_gene_ranking(parts, str(tmp_path / "ranking"))
+    read = gr.read_gene_ranking(str(tmp_path / "ranking"))
+    assert read.genes.equals(ranking.genes) and read.samples == ranking.samples
+    for plane in gr.PLANES:
+        assert np.allclose(getattr(read, plane), getattr(ranking, plane))
+
+
+def test_labelled_sums(loaded):
+    """Tests that data labelled with the nearest promoters gives the same sums"""
+    main_data, annotated_bed, _ranking = loaded
+    labelled = core.annotate_promoters(main_data, annotated_bed)
+    columns = ["gene_name", "chr", "group_name"]
+    expected = gr.gene_sums(main_data, annotated_bed).sort(columns)
+    result = gr.gene_sums(labelled, annotated_bed).sort(columns)
+    assert result.select(columns + ["counts"]).equals(expected.select(columns + ["counts"]))
+    for plane in ("position_mean", "position_deviations", "frac_sum"):
+        assert np.allclose(result[plane], expected[plane])
+
+
+def test_region_ranking(loaded):
+    """Tests that a CpG is counted once for every distinct promoter region around it"""
+    main_data, annotated_bed, _ranking = loaded
+    regions = gr.region_bed(annotated_bed)
+    assert regions["gene_name"].is_unique().all()
+    ranking = gr.build_gene_ranking([gr.gene_sums(main_data, regions)])
+    assert ranking.genes["gene_name"].is_in(regions["gene_name"].implode()).all()
+    labelled = core.annotate_promoters(main_data, annotated_bed)
+    columns = ["gene_name", "chr", "group_name"]
+    expected = gr.gene_sums(main_data, regions).sort(columns)
+    result = gr.gene_sums(labelled, regions).sort(columns)
+    assert result.select(columns + ["counts"]).equals(expected.select(columns + ["counts"]))
@@ -0,0 +1,61 @@
+"""
+test_instrumentation.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the timing and metrics functions
+
+run:
+python3 -m pytest
+"""
+
+import configparser
+import polars as pl
+from src import instrumentation as instr
+
+
+def test_span_records_rows():
+    """Tests if a span ends up in the metrics with its row counts"""
+    with instr.span("test_step", rows_in=10) as record:
+        record["rows_out"] = 4
+
+    metrics = instr.render_metrics()
+    assert 'methylation_step_duration_seconds_count{step="test_step"} 1' in metrics
+    assert 'methylation_step_rows_in_total{step="test_step"} 10' in metrics
+    assert 'methylation_step_rows_out_total{step="test_step"} 4' in metrics
+
+
+def test_row_count():
+    """Tests that dataframes are counted and other results are not"""
+    assert instr.row_count(pl.DataFrame({"start": [1, 2, 3]})) == 3
+    assert instr.row_count({"rows": 3}) is None
+
+
+def test_track_cache():
+    """Tests if hits and misses are counted
+    A miss is when the body of the cached function calls cache_miss
+    """
+    def cached_function(hit):
+        if not hit:
+            instr.cache_miss()
+
+    with instr.track_cache("test_cache"):
+        cached_function(hit=False)
+    with instr.track_cache("test_cache"):
+        cached_function(hit=True)
+    with instr.track_cache("test_cache"):
+        cached_function(hit=True)
+
+    metrics = instr.render_metrics()
+    assert 'methylation_cache_requests_total{cache="test_cache",result="miss"} 1' in metrics
+    assert 'methylation_cache_requests_total{cache="test_cache",result="hit"} 2' in metrics
+
+
+def test_profile_disabled():
+    """Tests that nothing is profiled without a profiler in the config"""
+    config = configparser.ConfigParser()
+    with instr.profile_request(config, "test"):
+        pass
+    assert instr.start_metrics_server(config) is None
@@ -0,0 +1,45 @@
+"""
+test_plot_cache.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the plot cache that is shared between sessions
+
+run:
+python3 -m pytest
+"""
+
+import numpy as np
+import panel as pn
+from src import plot_cache
+
+
+def test_evicts_least_recently_used():
+    """Tests that the oldest unused entry is evicted when the bytes run out"""
+    cache = plot_cache.PlotCache(max_bytes=2500)
+    cache.put("a", np.zeros(1000, dtype=np.uint8))
+    cache.put("b", np.zeros(1000, dtype=np.uint8))
+    assert cache.get("a") is not None
+
+    cache.put("c", np.zeros(1000, dtype=np.uint8))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.current_bytes == 2000
+
+
+def test_too_large():
+    """Tests that an entry larger than the cache is not stored"""
+    cache = plot_cache.PlotCache(max_bytes=100)
+    assert not cache.put("a", np.zeros(1000, dtype=np.uint8))
+    assert len(cache) == 0
+
+
+def test_freeze_plots():
+    """Tests that markdown panes are stored as text and rebuilt"""
+    plots = [("Scatter plot", pn.pane.Markdown("# text"))]
+    frozen = plot_cache.freeze_plots(plots)
+    assert frozen == [("Scatter plot", "# text")]
+    assert plot_cache.thaw_plots(frozen)[0][1].object == "# text"
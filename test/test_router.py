@@ -0,0 +1,93 @@
+"""
+test_router.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the query router over chromosome shards
+
+run:
+python3 -m pytest
+"""
+
+import io
+import json
+import pytest
+import tornado.web
+import tornado.httpserver
+import tornado.testing
+import tornado.httpclient
+from src import router
+
+
+def test_split_spec():
+    """Tests that every shard only gets its own chromosomes"""
+    shards = [router.Shard("http://a", ("chr1", "chr2"), (), 10, "1"),
+              router.Shard("http://b", ("chr3",), (), 5, "2")]
+    spec = router.core.make_filter_spec(["chr2", "chr3", "chr9"], [], 0, 0, [])
+    parts = router.split_spec(spec, shards)
+    assert [(shard.url, part.chromosomes) for shard, part in parts] == [
+        ("http://a", ("chr2",)), ("http://b", ("chr3",))]
+
+    everything = router.core.make_filter_spec([], [], 0, 0, [])
+    assert len(router.split_spec(everything, shards)) == 2
+    missing = router.core.make_filter_spec(["chr9"], [], 0, 0, [])
+    assert [part for _shard, part in router.split_spec(missing, shards)] == [missing]
+
+    assert router.api.parse_spec(
+        {name: [str(item) for item in value] if isinstance(value, list) else [str(value)]
+         for name, value in router.spec_arguments(spec).items()}) == spec
+
+
+def serve(routes) -> tuple[tornado.httpserver.HTTPServer, str]:
+    """Serves routes on a free port"""
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application(routes))
+    server.add_sockets([sock])
+    return server, f"http://127.0.0.1:{port}"
+
+
+@pytest.mark.asyncio
+async def test_router(tmp_path):
+    """Tests that the merged answers of the shards are the answers of all data"""
+    config = router.core.parse_config()
+    config.set("PATHS", "snapshot_folder", str(tmp_path / "snapshot"))
+    dataset = router.api.ds.get_dataset(config)
+    # Two shards that hold every chromosome of the data together
+    chromosomes = sorted(dataset["main_data"]["chr"].unique())
+    half = len(chromosomes) // 2
+    servers, urls = [], []
+    for shard in (chromosomes[:half], chromosomes[half:]):
+        shard_config = router.core.parse_config()
+        shard_config.read_dict({"PATHS": {"snapshot_folder": str(tmp_path / "snapshot")},
+                                "DATASET": {"chromosomes": ",".join(shard)}})
+        server, url = serve(router.api.api_routes(shard_config))
+        servers.append(server)
+        urls.append(url)
+    config.read_dict({"ROUTER": {"shards": ",".join(urls)}})
+    server, url = serve(router.router_routes(config))
+    servers.append(server)
+
+    client = tornado.httpclient.AsyncHTTPClient()
+    try:
+        info = json.loads((await client.fetch(f"{url}/api/info")).body)
+        assert info["rows"] == dataset["main_data"].height
+        assert info["chromosomes"] == sorted(dataset["main_data"]["chr"].unique())
+
+        spec = router.core.make_filter_spec([], [], 0, 0, [], min_coverage=10)
+        expected = router.api.query_rows(dataset, spec)
+        response = await client.fetch(f"{url}/api/rows?min_coverage=10")
+        rows = router.pl.read_ipc_stream(io.BytesIO(response.body))
+        assert rows.sort(rows.columns).equals(expected.sort(expected.columns))
+
+        response = await client.fetch(f"{url}/api/counts?min_coverage=10&format=arrow")
+        counts = router.pl.read_ipc_stream(io.BytesIO(response.body))
+        assert counts.equals(router.api.query_counts(dataset, spec))
+
+        response = await client.fetch(f"{url}/api/summary?min_coverage=10&format=arrow")
+        summary = router.pl.read_ipc_stream(io.BytesIO(response.body))
+        assert summary.height == router.api.query_summary(dataset, spec).height
+    finally:
+        for server in servers:
+            server.stop()
@@ -0,0 +1,69 @@
+"""
+test_sample_overview.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the PCA and clustering of the samples
+
+run:
+python3 -m pytest
+"""
+
+import numpy as np
+import polars as pl
+import pytest
+from src import gene_ranking as gr
+from src import sample_overview as so
+
+
+@pytest.fixture
+def ranking():
+    """A ranking of 3 sets of 6 samples, the promoters differ between the sets"""
+    rng = np.random.default_rng(1)
+    n_genes, sets = 2000, np.repeat([0, 1, 2], 6)
+    counts = (rng.random((n_genes, sets.size)) < 0.4) * rng.integers(1, 20, (n_genes, sets.size))
+    fracs = np.clip(0.5 + rng.normal(0, 0.2, (n_genes, 3))[:, sets] +
+                    rng.normal(0, 0.05, counts.shape), 0, 1)
+    zeros = np.zeros(counts.shape, order="F")
+    return gr.GeneRanking(pl.DataFrame({"gene_name": [f"gene{i}" for i in range(n_genes)],
+                                        "chr": ["chr1", "chr2"] * (n_genes // 2)}),
+                          tuple(f"sample{i:02d}" for i in range(sets.size)),
+                          np.asfortranarray(counts.astype(np.uint32)), zeros, zeros,
+                          np.asfortranarray(fracs * counts))
+
+
+def test_sample_matrix(ranking):
+    """Tests that only the measured values are stored, centered per promoter"""
+    matrix, samples = so.sample_matrix(ranking, chromosomes=["chr1"], min_cpgs=2)
+    assert samples == ranking.samples
+    chr1 = ranking.counts[::2]
+    measured = chr1 >= 2
+    assert matrix.shape == (len(samples), int((measured.sum(axis=1) >= 2).sum()))
+    assert matrix.nnz <= measured.sum()
+    assert np.allclose(np.asarray(matrix.sum(axis=0)), 0)
+
+    _matrix, samples = so.sample_matrix(ranking, groups=["sample03", "sample01", "absent"])
+    assert samples == ("sample03", "sample01")
+
+
+def test_randomized_pca(ranking):
+    """Tests that the randomized PCA finds the variance of an exact PCA"""
+    matrix, _samples = so.sample_matrix(ranking)
+    coordinates, explained = so.randomized_pca(matrix, components=2)
+    dense = matrix.toarray()
+    singular = np.linalg.svd(dense, compute_uv=False)
+    assert np.allclose(explained, singular[:2] ** 2 / (dense ** 2).sum(), rtol=1e-3)
+    assert np.allclose(np.linalg.norm(coordinates, axis=0), singular[:2], rtol=1e-3)
+
+
+def test_sample_overview(ranking):
+    """Tests that the clusters are the sets of samples"""
+    overview = so.sample_overview(ranking, clusters=3)
+    assert overview.coordinates.shape == (18, 3)
+    assert len(set(overview.clusters)) == 3
+    for first in range(0, 18, 6):
+        assert len(set(overview.clusters[first:first + 6])) == 1
+
+    assert so.sample_overview(ranking, groups=["sample00", "sample01"]) is None
@@ -0,0 +1,77 @@
+"""
+test_scheduler.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the admission control of heavy queries
+
+run:
+python3 -m pytest
+"""
+
+import time
+import threading
+import configparser
+import pytest
+from src import scheduler
+
+
+def wait_for_queue(work_scheduler, length):
+    """Waits until a given amount of queries are waiting"""
+    deadline = time.perf_counter() + 5
+    while len(work_scheduler) < length and time.perf_counter() < deadline:
+        time.sleep(0.001)
+
+
+def test_sessions_take_turns():
+    """Tests that a session with many queued queries does not push other sessions back"""
+    work_scheduler = scheduler.Scheduler(heavy_slots=1, heavy_rows=10)
+    order = []
+
+    def query(session, name):
+        with work_scheduler.admit(100, session):
+            order.append(name)
+
+    threads = []
+    with work_scheduler.admit(100, "blocker"):
+        for session, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+            thread = threading.Thread(target=query, args=(session, name))
+            thread.start()
+            threads.append(thread)
+            wait_for_queue(work_scheduler, len(threads))
+    for thread in threads:
+        thread.join()
+
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_light_queries_skip_the_queue():
+    """Tests that cheap queries run even when all heavy slots are taken"""
+    work_scheduler = scheduler.Scheduler(heavy_slots=1, heavy_rows=10, queue_timeout=0.01)
+    with work_scheduler.admit(100):
+        with work_scheduler.admit(5):
+            pass
+        with pytest.raises(scheduler.SchedulerBusy):
+            with work_scheduler.admit(100):
+                pass
+    assert len(work_scheduler) == 0
+
+
+def test_full_queue_is_rejected():
+    """Tests that heavy queries are turned down when the queue is full"""
+    work_scheduler = scheduler.Scheduler(heavy_slots=1, heavy_rows=10, max_queue=0)
+    with work_scheduler.admit(100):
+        with pytest.raises(scheduler.SchedulerBusy):
+            with work_scheduler.admit(100):
+                pass
+
+
+def test_settings_split_over_workers():
+    """Tests that the cpus are split over the worker processes"""
+    config = configparser.ConfigParser()
+    config.read_dict({"SCHEDULER": {"num_procs": "4", "cpus": "16"}})
+    settings = scheduler.scheduler_settings(config)
+    assert settings["polars_threads"] == 4
+    assert settings["heavy_slots"] == 1
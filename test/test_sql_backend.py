@@ -0,0 +1,72 @@
+"""
+test_sql_backend.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the DuckDB query backend, it is skipped without duckdb
+
+run:
+python3 -m pytest
+"""
+
+import pytest
+from src import dataset as ds
+from src import sql_backend as sql
+
+pytest.importorskip("duckdb")
+
+SPECS = [
+    ds.core.make_filter_spec([], [], 0, 0, []),
+    ds.core.make_filter_spec(["chr1"], [], 20000, 40000, []),
+    ds.core.make_filter_spec(["chr1"], [], 30000, 0, []),
+    ds.core.make_filter_spec([], ["A53J1"], 0, 0, [], min_coverage=20, frac_range=(0.2, 0.8)),
+    ds.core.make_filter_spec([], [], 0, 0, ["TP53", "BRCA1", "WASH7P", "MIR1302-2"]),
+    ds.core.make_filter_spec(["chr1"], [], 0, 0, ["not_a_gene"]),
+]
+
+
+@pytest.fixture(scope="module")
+def built():
+    """The data of the test files, in memory"""
+    return ds.build_dataset(ds.core.parse_config())
+
+
+def same_rows(result, expected):
+    """Compares two frames without looking at the order of the rows"""
+    assert result.columns == expected.columns
+    assert result.height == expected.height
+    return result.sort(result.columns).equals(expected.sort(expected.columns))
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_filter_spec(built, spec):
+    """Tests that the SQL filters give the same rows as the polars filters"""
+    engine = sql.SqlEngine(built, ds.core.parse_config())
+    expected = ds.core.apply_filter_spec(built["main_data"], built["block_index"],
+                                         built["annotated_bed"], spec)
+    assert same_rows(engine.apply_filter_spec(spec), expected)
+
+    counts = engine.run(sql.count_methylation_data(sql.filter_plan(spec)))
+    assert same_rows(counts, ds.core.count_methylation_data(expected))
+
+
+def test_region_store(built, tmp_path):
+    """Tests that the SQL filters read the Parquet files of the region store"""
+    config = ds.core.parse_config()
+    block_index = ds.core.write_region_store(config, str(tmp_path / "store"), block_size=50)
+    engine = sql.SqlEngine(built | {"main_data": None, "block_index": block_index}, config)
+    for spec in SPECS:
+        expected = ds.core.apply_filter_spec(None, block_index, built["annotated_bed"], spec)
+        assert same_rows(engine.apply_filter_spec(spec), expected)
+
+
+def test_custom_query(built):
+    """Tests that analysts can join the tables themselves"""
+    engine = sql.SqlEngine(built, ds.core.parse_config())
+    result = engine.query("SELECT count(DISTINCT gene_name) AS genes FROM promoters "
+                          "WHERE chr = $chr", {"chr": "chr1"})
+    expected = built["annotated_bed"].filter(ds.core.pl.col("chr") == "chr1")
+    assert result["genes"][0] == expected["gene_name"].n_unique()
+    assert engine.query("SELECT * FROM groups").height > 0
@@ -0,0 +1,61 @@
+"""
+test_summary.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the summary statistics
+
+run:
+python3 -m pytest
+"""
+
+import pytest
+import polars as pl
+from src import summary
+
+
+def test_weighted_mean():
+    """Tests the coverage weighted fraction and the counts per group"""
+    df = pl.DataFrame({"chr": ["chr1", "chr1", "chr1"],
+                       "start": [1, 5, 9],
+                       "end": [2, 6, 10],
+                       "frac": [1.0, 0.0, 0.5],
+                       "valid": [3, 1, 2],
+                       "group_name": ["A", "A", "B"]})
+    result = summary.summarise_methylation(df)
+
+    group_a = result.filter(pl.col("group_name") == "A").row(0, named=True)
+    assert group_a["n CpGs"] == 2
+    assert group_a["weighted mean frac"] == pytest.approx(0.75)
+    assert group_a["mean frac"] == pytest.approx(0.5)
+    assert group_a["total coverage"] == 4
+    assert result.height == 2
+
+
+def test_gene_level():
+    """Tests that genes get their own rows when the data has genes"""
+    df = pl.DataFrame({"chr": ["chr1", "chr1"],
+                       "start": [1, 5],
+                       "end": [2, 6],
+                       "frac": [1.0, 0.0],
+                       "valid": [3, 1],
+                       "group_name": ["A", "A"],
+                       "gene_name": ["WASH7P", "OR4F5"]})
+    result = summary.summarise_methylation(df)
+    assert "gene_name" in result.columns
+    assert result.height == 2
+
+
+def test_summarise_plan():
+    """Tests that a lazy plan gives the same summary as the collected rows"""
+    df = pl.DataFrame({"chr": ["chr1", "chr1", "chr2"],
+                       "start": [1, 5, 9],
+                       "end": [2, 6, 10],
+                       "frac": [1.0, 0.0, 0.5],
+                       "valid": [3, 1, 2],
+                       "group_name": ["A", "A", "B"]})
+    plan = df.lazy().filter(pl.col("valid") > 1)
+    assert summary.summarise_methylation(plan).equals(
+        summary.summarise_methylation(plan.collect()))
@@ -0,0 +1,85 @@
+"""
+test_tiles.py
+Author: Ramon Reilman
+Version: 1.0
+Year: BFV2
+
+Usage:
+This script will test the region tiles
+
+run:
+python3 -m pytest
+"""
+
+import configparser
+import polars as pl
+from src import summary, tiles
+
+
+def methylation():
+    """Creates a small dataset
+
+    Returns
+    -------
+    pl.DataFrame
+        Methylation data
+
+    """
+    return pl.DataFrame({"chr": ["chr1", "chr1", "chr1", "chr2"],
+                         "start": [100, 1500, 1600, 100],
+                         "end": [101, 1501, 1601, 101],
+                         "frac": [1.0, 0.0, 0.5, 0.5],
+                         "valid": [10, 10, 30, 4],
+                         "group_name": ["A", "A", "A", "A"]})
+
+
+def test_window_tiles():
+    """Tests that CpGs end up in the right window with the right sums"""
+    result = tiles.build_window_tiles(methylation(), 1000)
+    second = result.filter((pl.col("chr") == "chr1") & (pl.col("tile_start") == 1000)).row(0, named=True)
+    assert second["n CpGs"] == 2
+    assert second["tile_end"] == 2000
+    assert second["mean frac"] == 15 / 40
+    assert result["n CpGs"].sum() == 4
+
+
+def test_promoter_tiles():
+    """Tests that only CpGs inside a promoter count, overlapping promoters both count"""
+    promoters = pl.DataFrame({"chr": ["chr1", "chr1", "chr3"],
+                              "start": [1000, 1550, 0],
+                              "end": [2000, 1700, 500],
+                              "gene_name": ["GENE1", "GENE2", "GENE3"]})
+    result = tiles.build_promoter_tiles(methylation(), promoters)
+    assert result["gene_name"].to_list() == ["GENE1", "GENE2"]
+    assert result["n CpGs"].to_list() == [2, 1]
+
+
+def test_pick_window():
+    """Tests that narrow spans use CpGs and wide spans the smallest fitting window"""
+    settings = {"windows": [1000, 10000, 100000], "zoom_threshold": 50000, "max_tiles": 100}
+    available = {"1000": None, "10000": None, "100000": None}
+    assert tiles.pick_window(40000, settings, available) is None
+    assert tiles.pick_window(900000, settings, available) == 10000
+    assert tiles.pick_window(10**9, settings, available) == 100000
+
+
+def test_tile_generation(tmp_path):
+    """Tests that tiles of another generation of the data are not used"""
+    config = configparser.ConfigParser()
+    config.read_dict({"PATHS": {"tile_folder": str(tmp_path)}, "TILES": {"windows": "1000"}})
+    assert tiles.load_tiles(config, "first") == {}
+
+    promoters = pl.DataFrame({"chr": ["chr1"], "start": [1000], "end": [2000],
+                              "gene_name": ["GENE1"]})
+    tiles.precompute_tiles(methylation(), promoters, config, "first")
+    assert tiles.tile_generation(config) == "first"
+    assert set(tiles.load_tiles(config, "first")) == {"1000", "promoters"}
+    assert tiles.load_tiles(config, "second") == {}
+
+
+def test_summarise_tiles():
+    """Tests that the summary of window tiles has the same sums as the summary of the CpGs"""
+    expected = summary.summarise_methylation(methylation()).sort("chr")
+    result = summary.summarise_tiles(tiles.build_window_tiles(methylation(), 1000)).sort("chr")
+    for column in ("n CpGs", "total coverage", "weighted mean frac"):
+        assert result[column].to_list() == expected[column].to_list()